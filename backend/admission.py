@@ -0,0 +1,193 @@
+"""
+Admission control for model inference
+Bounded worker pool with per-class priority queues, per-user concurrency
+limits and queue-time budgets; requests that cannot start within their
+budget fail fast with 429 instead of piling up
+"""
+
+import asyncio
+import functools
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger("SmartAgriNode.admission")
+
+# Lower value = served first
+PRIORITY_CLASSES = {
+    "interactive": 0,  # dashboard users waiting on a response
+    "device": 1,       # ESP32-CAM scan / stream frames
+    "batch": 2         # bulk and offline jobs
+}
+
+DEFAULT_BUDGETS = {
+    "interactive": float(os.getenv("ADMISSION_BUDGET_INTERACTIVE", "5")),
+    "device": float(os.getenv("ADMISSION_BUDGET_DEVICE", "15")),
+    "batch": float(os.getenv("ADMISSION_BUDGET_BATCH", "60"))
+}
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request cannot be admitted within its budget"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class InferenceAdmission:
+    """Priority admission layer in front of a dedicated inference thread pool"""
+
+    def __init__(
+        self,
+        workers: int = 1,
+        max_queue: int = 32,
+        per_user_limit: int = 2,
+        budgets: Optional[Dict[str, float]] = None
+    ):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self.budgets = dict(budgets or DEFAULT_BUDGETS)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._running = 0
+        self._queued = 0
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self._user_inflight: Dict[str, int] = defaultdict(int)
+        # Exponentially weighted mean service time, seeds queue-time estimates
+        self._service_time = 0.5
+        self.admitted = defaultdict(int)
+        self.rejected = defaultdict(int)
+
+    @classmethod
+    def from_env(cls) -> "InferenceAdmission":
+        """Build the admission layer from INFERENCE_WORKERS / ADMISSION_* environment variables"""
+        return cls(
+            workers=int(os.getenv("INFERENCE_WORKERS", "1")),
+            max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "32")),
+            per_user_limit=int(os.getenv("ADMISSION_PER_USER", "2"))
+        )
+
+    async def run(self, priority_class: str, user_key: Optional[str], fn: Callable, *args, **kwargs) -> Any:
+        """
+        Run a blocking inference call once admitted
+
+        Args:
+            priority_class: "interactive", "device" or "batch"
+            user_key: User or device id for per-user limits (None to skip)
+            fn: Blocking callable executed on the inference pool
+
+        Raises:
+            AdmissionRejected: Queue full, per-user limit hit or budget exceeded
+        """
+        priority = PRIORITY_CLASSES[priority_class]
+        budget = self.budgets[priority_class]
+
+        if user_key and self._user_inflight[user_key] >= self.per_user_limit:
+            self._reject(priority_class, "Too many concurrent inference requests", self._service_time)
+        if self._queued >= self.max_queue:
+            self._reject(priority_class, "Inference queue is full", self._estimate_wait(priority))
+
+        if user_key:
+            self._user_inflight[user_key] += 1
+        try:
+            await self._acquire(priority_class, priority, budget)
+            self.admitted[priority_class] += 1
+
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
+            future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+            # The slot is released when the thread finishes, even if the caller goes away
+            future.add_done_callback(lambda _: self._finish(time.perf_counter() - started))
+            return await asyncio.shield(future)
+        finally:
+            if user_key:
+                self._user_inflight[user_key] -= 1
+                if self._user_inflight[user_key] <= 0:
+                    del self._user_inflight[user_key]
+
+    async def _acquire(self, priority_class: str, priority: int, budget: float) -> None:
+        self._drop_cancelled()
+        if self._running < self.workers and not self._waiters:
+            self._running += 1
+            return
+
+        estimated = self._estimate_wait(priority)
+        if estimated > budget:
+            self._reject(priority_class, "Inference backlog exceeds queue-time budget", estimated)
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=budget)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                return
+            self._reject(priority_class, "Queue-time budget exceeded", self._estimate_wait(priority))
+        except asyncio.CancelledError:
+            if not self._abandon(waiter):
+                # Slot was granted just as we were cancelled; hand it on
+                self._release()
+            raise
+
+    def _abandon(self, waiter: asyncio.Future) -> bool:
+        """Withdraw a waiter; False if it had already been granted a slot"""
+        if waiter.done():
+            return False
+        waiter.cancel()
+        self._queued -= 1
+        return True
+
+    def _finish(self, elapsed: float) -> None:
+        self._service_time = 0.8 * self._service_time + 0.2 * elapsed
+        self._release()
+
+    def _release(self) -> None:
+        self._drop_cancelled()
+        if self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            self._queued -= 1
+            # Slot ownership moves straight to the next waiter
+            waiter.set_result(True)
+        else:
+            self._running -= 1
+
+    def _drop_cancelled(self) -> None:
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    def _estimate_wait(self, priority: int) -> float:
+        ahead = sum(1 for p, _, waiter in self._waiters if p <= priority and not waiter.done())
+        return (ahead + 1) * self._service_time / self.workers
+
+    def _reject(self, priority_class: str, reason: str, retry_after: float) -> None:
+        self.rejected[priority_class] += 1
+        logger.warning(f"Rejected {priority_class} inference: {reason}")
+        raise AdmissionRejected(reason, retry_after)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth, utilisation and admission counters"""
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "queued": self._queued,
+            "mean_service_seconds": round(self._service_time, 4),
+            "budgets_seconds": self.budgets,
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected)
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+inference_admission = InferenceAdmission.from_env()
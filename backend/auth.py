@@ -1,4 +1,6 @@
+import hmac
 import logging
+import os
 from typing import Optional
 from fastapi import Header, HTTPException
 from database import SupabaseDB
@@ -38,3 +40,15 @@ async def verify_supabase_token(authorization: Optional[str] = Header(None)) ->
     except Exception as e:
         logger.error(f"Token verification error: {str(e)}")
         raise HTTPException(status_code=401, detail="Invalid token or expired session")
+
+async def verify_admin_token(x_admin_token: Optional[str] = Header(None)) -> bool:
+    """
+    Verify the operator token (MODEL_ADMIN_TOKEN) for administrative endpoints
+    Endpoints are disabled when no token is configured
+    """
+    expected = os.getenv("MODEL_ADMIN_TOKEN")
+    if not expected:
+        raise HTTPException(status_code=403, detail="Administrative endpoints are disabled")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, expected):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+    return True
@@ -0,0 +1,271 @@
+"""
+CPU thread autotuner for inference
+Benchmarks the loaded weed and crop models across intra-op thread counts
+(the weed model's ONNX Runtime session, and torch), picks the count with the
+highest weed throughput whose p95 latency meets the target, and saves it to
+backend/instance/autotune.json
+
+Only the intra-op thread count is tuned. The ultralytics predictor holds a
+lock around each inference call, so extra threads sharing one model run one
+call at a time and the admission pool size is not a throughput knob.
+
+At startup (AUTOTUNE=auto) a saved result for the same CPU count and model
+versions is applied directly; otherwise the benchmark runs once before the
+app starts serving and its result is saved for later starts. Under gunicorn
+the master runs this CLI once with --if-stale for each worker's share of the
+CPUs (AUTOTUNE_CPUS), and workers start with AUTOTUNE=saved: they apply the
+saved result but never benchmark or write it. Explicit ORT_NUM_THREADS /
+TORCH_NUM_THREADS settings always take precedence.
+
+Usage (from backend/):
+    python autotune.py --target-p95-ms 800 --requests 32
+"""
+
+import argparse
+import glob
+import json
+import logging
+import os
+import time
+import warnings
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+import torch
+
+from metrics import percentile
+
+logger = logging.getLogger("SmartAgriNode.autotune")
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTOTUNE_PATH = os.getenv(
+    "AUTOTUNE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'autotune.json')
+)
+# "off" keeps the configured thread settings; "auto" applies (or produces) a tuned configuration;
+# "saved" only applies an existing one (gunicorn workers, after the master has tuned)
+AUTOTUNE = os.getenv("AUTOTUNE", "off").lower()
+AUTOTUNE_TARGET_P95_MS = float(os.getenv("AUTOTUNE_TARGET_P95_MS", "1000"))
+# Weed requests timed per configuration during a startup run
+AUTOTUNE_REQUESTS = int(os.getenv("AUTOTUNE_REQUESTS", "16"))
+TEST_IMAGES_DIR = os.path.join(BASE_DIR, 'test_images')
+CROP_REQUESTS = 200
+
+
+def detect_cpu_count() -> int:
+    """CPUs this process may run on (respects affinity masks / container cpusets)"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def tuning_cpu_count() -> int:
+    """CPUs one server process may use: AUTOTUNE_CPUS (gunicorn sets each worker's share) or all available"""
+    return int(os.getenv("AUTOTUNE_CPUS") or detect_cpu_count())
+
+
+def candidate_configs(cpu_count: int) -> List[Dict[str, int]]:
+    """Intra-op thread counts up to the CPU count: 1, powers of two and the count itself"""
+    thread_counts = sorted({1, cpu_count} | {2 ** i for i in range(1, cpu_count.bit_length()) if 2 ** i <= cpu_count})
+    return [{"intra_op_threads": threads} for threads in thread_counts]
+
+
+def load_frames(count: int = 4) -> List[np.ndarray]:
+    """Decoded test images, or noise frames when none are available"""
+    frames = []
+    for path in sorted(glob.glob(os.path.join(TEST_IMAGES_DIR, '*.jp*g')))[:count]:
+        img = cv2.imread(path, cv2.IMREAD_COLOR)
+        if img is not None:
+            frames.append(img)
+    if not frames:
+        rng = np.random.default_rng(0)
+        frames = [rng.integers(0, 255, (640, 640, 3), dtype=np.uint8) for _ in range(count)]
+    return frames
+
+
+def _run_sequential(fn, inputs: list) -> Dict[str, float]:
+    """Run fn over inputs one at a time, as the serving path does; per-call latency and throughput"""
+    latencies = []
+    start = time.perf_counter()
+    for item in inputs:
+        call_start = time.perf_counter()
+        fn(item)
+        latencies.append(time.perf_counter() - call_start)
+    wall = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "throughput_rps": round(len(inputs) / wall, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2)
+    }
+
+
+def benchmark_config(config: Dict[str, int], weed_model, crop_model, frames: List[np.ndarray], requests: int) -> Dict:
+    """Weed and crop latency/throughput for one configuration"""
+    from ml_utils import set_onnx_threads
+
+    torch.set_num_threads(config["intra_op_threads"])
+    if weed_model is not None:
+        set_onnx_threads(weed_model, config["intra_op_threads"])
+    result = dict(config)
+
+    if weed_model is not None:
+        inputs = [frames[i % len(frames)] for i in range(requests)]
+        # One untimed pass so the thread pool is spun up
+        _run_sequential(lambda img: weed_model(img, verbose=False), inputs[:1])
+        result["weed"] = _run_sequential(lambda img: weed_model(img, verbose=False), inputs)
+    if crop_model is not None:
+        rows = np.random.default_rng(0).uniform(0, 200, (CROP_REQUESTS, 7))
+        result["crop"] = _run_sequential(lambda row: crop_model.predict_proba(row[None, :]), list(rows))
+    return result
+
+
+def select(results: List[Dict], target_p95_ms: float) -> Dict:
+    """Highest weed throughput within the p95 target; the lowest p95 if none meets it"""
+    key = "weed" if any("weed" in r for r in results) else "crop"
+    within = [r for r in results if r[key]["p95_ms"] <= target_p95_ms]
+    if within:
+        return max(within, key=lambda r: (r[key]["throughput_rps"], -r[key]["p95_ms"]))
+    return min(results, key=lambda r: r[key]["p95_ms"])
+
+
+def tune(weed_model, crop_model, model_versions: Dict[str, Optional[str]], target_p95_ms: float = AUTOTUNE_TARGET_P95_MS,
+         requests: int = AUTOTUNE_REQUESTS, cpu_count: Optional[int] = None) -> Dict:
+    """Benchmark all candidate configurations and return the report (selected config included)"""
+    from ml_utils import set_onnx_threads, weed_onnx_threads
+
+    cpu_count = cpu_count or tuning_cpu_count()
+    frames = load_frames()
+    original_threads = torch.get_num_threads()
+    results = []
+    try:
+        for config in candidate_configs(cpu_count):
+            result = benchmark_config(config, weed_model, crop_model, frames, requests)
+            logger.info(f"Autotune {config}: {result.get('weed', result.get('crop'))}")
+            results.append(result)
+    finally:
+        torch.set_num_threads(original_threads)
+        if weed_model is not None:
+            set_onnx_threads(weed_model, weed_onnx_threads)
+
+    chosen = select(results, target_p95_ms)
+    return {
+        "cpu_count": cpu_count,
+        "model_versions": model_versions,
+        "target_p95_ms": target_p95_ms,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "selected": {"intra_op_threads": chosen["intra_op_threads"]},
+        "candidates": results
+    }
+
+
+def save(report: Dict, path: str = AUTOTUNE_PATH) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load(path: str = AUTOTUNE_PATH) -> Optional[Dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        logger.warning(f"Ignoring unreadable autotune result {path}")
+        return None
+
+
+def is_current(report: Optional[Dict], cpu_count: int, model_versions: Dict[str, Optional[str]]) -> bool:
+    """A saved result only applies to the same CPU count and model versions"""
+    return (
+        bool(report)
+        and report.get("cpu_count") == cpu_count
+        and report.get("model_versions") == model_versions
+        and "intra_op_threads" in report.get("selected", {})
+    )
+
+
+def tuned_config(weed_handle, crop_handle, mode: str = AUTOTUNE, path: str = AUTOTUNE_PATH) -> Optional[Dict[str, int]]:
+    """
+    Startup entry point (blocking; call via a thread)
+
+    Returns:
+        {"intra_op_threads"} to apply, or None when
+        autotuning is off (or, in "saved" mode, no current result exists)
+    """
+    if mode not in ("auto", "saved"):
+        return None
+    cpu_count = tuning_cpu_count()
+    versions = {
+        "weed": weed_handle.version if weed_handle else None,
+        "crop": crop_handle.version if crop_handle else None
+    }
+    report = load(path)
+    if not is_current(report, cpu_count, versions):
+        if mode == "saved":
+            logger.warning(f"No autotune result for {cpu_count} CPUs and the loaded models in {path}; keeping configured threads")
+            return None
+        logger.info(f"Autotuning inference threads for {cpu_count} CPUs (target p95 {AUTOTUNE_TARGET_P95_MS:g} ms)...")
+        report = tune(
+            weed_handle.model if weed_handle else None,
+            crop_handle.model if crop_handle else None,
+            versions,
+            cpu_count=cpu_count
+        )
+        save(report, path)
+    logger.info(f"Autotuned configuration: {report['selected']}")
+    return report["selected"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tune inference thread counts for this machine")
+    parser.add_argument("--target-p95-ms", type=float, default=AUTOTUNE_TARGET_P95_MS, help="Weed detection p95 latency target")
+    parser.add_argument("--requests", type=int, default=32, help="Weed requests timed per configuration")
+    parser.add_argument("--cpus", type=int, default=None,
+                        help="CPUs to tune for (default: AUTOTUNE_CPUS or all available; use the per-worker share under gunicorn)")
+    parser.add_argument("--output", default=AUTOTUNE_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="Print the report without saving it")
+    parser.add_argument("--if-stale", action="store_true",
+                        help="Skip the benchmark when --output already matches the CPU count and model versions")
+    args = parser.parse_args()
+
+    from ml_utils import model_registry
+
+    # The shipped crop model was fitted on a DataFrame; serving (and this benchmark) pass arrays
+    warnings.filterwarnings("ignore", message="X does not have valid feature names")
+    weed = model_registry.get("weed")
+    crop = model_registry.get("crop")
+    for handle in (weed, crop):
+        if handle is not None:
+            model_registry.warm_up(handle)
+    versions = {"weed": weed.version if weed else None, "crop": crop.version if crop else None}
+    cpu_count = args.cpus or tuning_cpu_count()
+    if args.if_stale and is_current(load(args.output), cpu_count, versions):
+        print(f"{args.output} is current for {cpu_count} CPUs; nothing to tune")
+        return
+    print(f"Tuning for {cpu_count} CPUs, {len(candidate_configs(cpu_count))} configurations")
+
+    report = tune(weed.model if weed else None, crop.model if crop else None, versions,
+                  target_p95_ms=args.target_p95_ms, requests=args.requests, cpu_count=cpu_count)
+
+    print(f"{'threads':>8}{'weed_rps':>10}{'weed_p95':>10}{'crop_rps':>10}{'crop_p95':>10}")
+    for r in report["candidates"]:
+        weed_stats, crop_stats = r.get("weed", {}), r.get("crop", {})
+        print(f"{r['intra_op_threads']:>8}"
+              f"{weed_stats.get('throughput_rps', '-'):>10}{weed_stats.get('p95_ms', '-'):>10}"
+              f"{crop_stats.get('throughput_rps', '-'):>10}{crop_stats.get('p95_ms', '-'):>10}")
+    print(f"\nSelected {report['selected']} (target p95 {args.target_p95_ms:g} ms)")
+
+    if not args.dry_run:
+        save(report, args.output)
+        print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
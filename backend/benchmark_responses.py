@@ -0,0 +1,115 @@
+"""
+Benchmark JSON serialization and response compression
+Compares FastAPI's default path (jsonable_encoder + stdlib json) with
+FastJSONResponse, and raw vs gzipped bytes on the wire, for payloads shaped
+like the history, weed-scan results and batch crop endpoints
+
+Usage (from backend/):
+    python benchmark_responses.py --frames 8 --batch 256 --repeats 50
+"""
+
+import argparse
+import base64
+import glob
+import gzip
+import os
+import time
+import uuid
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from compression import GZIP_LEVEL, GZIP_MIN_SIZE, is_compressible
+from serialization import ORJSON_AVAILABLE, FastJSONResponse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_IMAGES_DIR = os.path.join(BASE_DIR, 'test_images')
+CROPS = ["rice", "maize", "chickpea", "kidneybeans", "pigeonpeas", "mothbeans", "mungbean", "blackgram",
+         "lentil", "pomegranate", "banana", "mango", "grapes", "watermelon", "muskmelon", "apple"]
+
+
+def load_frames(count: int):
+    paths = sorted(glob.glob(os.path.join(TEST_IMAGES_DIR, '*.jp*g')))
+    if not paths:
+        raise SystemExit(f"No JPEG images in {TEST_IMAGES_DIR}")
+    frames = []
+    for i in range(count):
+        with open(paths[i % len(paths)], "rb") as f:
+            frames.append(f.read())
+    return frames
+
+
+def history_payload(rows: int):
+    now = datetime.now(timezone.utc).isoformat()
+    crops = [{
+        "id": str(uuid.uuid4()), "user_id": str(uuid.uuid4()),
+        "input_data": {"N": 40.0 + i, "P": 50.0, "K": 60.0, "temperature": 25.5, "humidity": 75.0, "ph": 6.5, "rainfall": 200.0},
+        "recommended_crop": CROPS[i % len(CROPS)], "confidence": 0.93, "model_version": "v1", "created_at": now
+    } for i in range(rows)]
+    weeds = [{
+        "id": str(uuid.uuid4()), "user_id": str(uuid.uuid4()), "image_filename": f"field_{i}.jpg",
+        "input_image_url": f"https://example.supabase.co/storage/v1/object/public/weed-images/{uuid.uuid4()}.jpg",
+        "output_image_url": f"https://example.supabase.co/storage/v1/object/public/weed-images/{uuid.uuid4()}.jpg",
+        "weed_count": i % 7, "model_version": "v1", "created_at": now
+    } for i in range(rows)]
+    return {"crop_recommendations": crops, "weed_detections": weeds}
+
+
+def scan_payload(frames):
+    results = [{"image": base64.b64encode(frame).decode('utf-8'), "weed_count": i % 5, "model_version": "v1"}
+               for i, frame in enumerate(frames)]
+    return {"count": len(results), "results": results}
+
+
+def batch_payload(items: int, top_k: int = 3):
+    results = []
+    for i in range(items):
+        ranked = [{"crop": CROPS[(i + j) % len(CROPS)], "probability": round(0.9 / (j + 1), 4)} for j in range(top_k)]
+        results.append({"recommended_crop": ranked[0]["crop"], "confidence": ranked[0]["probability"],
+                        "top_k": ranked, "model_version": "v1"})
+    return {"results": results, "model_version": "v1"}
+
+
+def time_per_call(fn, repeats: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark response serialization and compression")
+    parser.add_argument("--history-rows", type=int, default=10, help="Rows per history list (the endpoint's limit)")
+    parser.add_argument("--frames", type=int, default=8, help="Frames in the weed-scan results payload")
+    parser.add_argument("--batch", type=int, default=256, help="Items in the batch crop payload")
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames)
+    payloads = {
+        "history": history_payload(args.history_rows),
+        "weed_scan_results": scan_payload(frames),
+        "crop_batch": batch_payload(args.batch)
+    }
+
+    print(f"orjson available: {ORJSON_AVAILABLE}; gzip level {GZIP_LEVEL}, min size {GZIP_MIN_SIZE}B")
+    print(f"{'payload':<20}{'default_ms':>12}{'fast_ms':>10}{'speedup':>9}{'raw_bytes':>12}{'gzip_bytes':>12}{'gzip_ms':>9}")
+    for name, payload in payloads.items():
+        default_ms = time_per_call(lambda: JSONResponse(jsonable_encoder(payload)).body, args.repeats)
+        fast_ms = time_per_call(lambda: FastJSONResponse(payload).body, args.repeats)
+        body = FastJSONResponse(payload).body
+        gzip_ms = time_per_call(lambda: gzip.compress(body, GZIP_LEVEL, mtime=0), max(1, args.repeats // 5))
+        compressed = len(gzip.compress(body, GZIP_LEVEL, mtime=0))
+        print(f"{name:<20}{default_ms:>12.3f}{fast_ms:>10.3f}{default_ms / fast_ms:>8.1f}x"
+              f"{len(body):>12}{compressed:>12}{gzip_ms:>9.3f}")
+
+    # Why image/jpeg is skipped: a second compression pass saves almost nothing
+    jpeg = frames[0]
+    print(f"\nimage/jpeg frame: {len(jpeg)}B raw, {len(gzip.compress(jpeg, GZIP_LEVEL, mtime=0))}B gzipped "
+          f"(compressible={is_compressible('image/jpeg')})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+Benchmark tiled vs whole-frame weed detection
+Compares throughput (images/sec) and recall@IoU on a YOLO-format split
+
+Usage (from backend/):
+    python benchmark_tiling.py --split val --tile-sizes 640 480 --overlaps 0.1 0.2
+"""
+
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from boxes import box_iou
+from ml_utils import get_weed_model
+from tiling import detect_tiled
+
+DATASET_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'weeddataset')
+
+
+def load_labels(label_path: str, width: int, height: int):
+    """YOLO txt labels (class cx cy w h, normalized) -> (boxes xyxy, classes)"""
+    if not os.path.exists(label_path):
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+    rows = np.loadtxt(label_path, ndmin=2)
+    if rows.size == 0:
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+    cx, cy, w, h = rows[:, 1] * width, rows[:, 2] * height, rows[:, 3] * width, rows[:, 4] * height
+    boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1)
+    return boxes, rows[:, 0].astype(np.int64)
+
+
+def count_matches(pred_boxes, pred_scores, pred_classes, gt_boxes, gt_classes, iou_threshold: float) -> int:
+    """Ground-truth boxes matched by a same-class prediction (each GT box used at most once)"""
+    gt_used = np.zeros(len(gt_boxes), dtype=bool)
+    for i in np.argsort(-pred_scores):
+        candidates = np.where((gt_classes == pred_classes[i]) & ~gt_used)[0]
+        if not len(candidates):
+            continue
+        ious = box_iou(pred_boxes[i], gt_boxes[candidates])
+        best = int(np.argmax(ious))
+        if ious[best] >= iou_threshold:
+            gt_used[candidates[best]] = True
+    return int(gt_used.sum())
+
+
+def whole_frame(model, img):
+    boxes = model(img, verbose=False)[0].boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+    return boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy().astype(np.int64)
+
+
+def run_mode(model, samples, iou_threshold: float, tile_size=None, overlap=0.0) -> dict:
+    total_gt = 0
+    total_matched = 0
+    total_pred = 0
+    start = time.perf_counter()
+    for img, gt_boxes, gt_classes in samples:
+        if tile_size:
+            det = detect_tiled(model, img, tile_size=tile_size, overlap=overlap)
+            boxes, scores, classes = det["boxes"], det["scores"], det["classes"]
+        else:
+            boxes, scores, classes = whole_frame(model, img)
+        total_gt += len(gt_boxes)
+        total_pred += len(boxes)
+        total_matched += count_matches(boxes, scores, classes, gt_boxes, gt_classes, iou_threshold)
+    elapsed = time.perf_counter() - start
+    return {
+        "mode": f"tiled {tile_size}px / {overlap:g}" if tile_size else "whole-frame",
+        "images_per_sec": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "recall": round(total_matched / total_gt, 4) if total_gt else 0.0,
+        "precision": round(total_matched / total_pred, 4) if total_pred else 0.0,
+        "detections": total_pred
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark tiled vs whole-frame weed detection")
+    parser.add_argument("--split", default="val", help="Dataset split under data/weeddataset")
+    parser.add_argument("--tile-sizes", type=int, nargs="+", default=[640])
+    parser.add_argument("--overlaps", type=float, nargs="+", default=[0.2])
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU threshold for a recall match")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N images")
+    parser.add_argument("--json", dest="json_path", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    model = get_weed_model()
+    if not model:
+        raise SystemExit("Weed detection model not available")
+
+    image_dir = os.path.join(DATASET_DIR, args.split, 'images')
+    label_dir = os.path.join(DATASET_DIR, args.split, 'labels')
+    names = sorted(os.listdir(image_dir))[:args.limit]
+
+    samples = []
+    for name in names:
+        img = cv2.imread(os.path.join(image_dir, name))
+        if img is None:
+            continue
+        height, width = img.shape[:2]
+        gt_boxes, gt_classes = load_labels(os.path.join(label_dir, os.path.splitext(name)[0] + '.txt'), width, height)
+        samples.append((img, gt_boxes, gt_classes))
+    print(f"Loaded {len(samples)} images from {image_dir}")
+
+    # Warm-up so graph initialization is not billed to the first mode
+    model(samples[0][0], verbose=False)
+
+    rows = [run_mode(model, samples, args.iou)]
+    for tile_size in args.tile_sizes:
+        for overlap in args.overlaps:
+            rows.append(run_mode(model, samples, args.iou, tile_size=tile_size, overlap=overlap))
+
+    print(f"{'mode':<24}{'img/s':>8}{'recall':>9}{'precision':>11}{'dets':>7}")
+    for row in rows:
+        print(f"{row['mode']:<24}{row['images_per_sec']:>8}{row['recall']:>9}{row['precision']:>11}{row['detections']:>7}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"split": args.split, "images": len(samples), "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Bounding-box helpers shared by tiled inference and evaluation tools
+Boxes are float arrays of shape (N, 4) in absolute xyxy pixel coordinates
+"""
+
+import numpy as np
+
+
+def box_area(boxes: np.ndarray) -> np.ndarray:
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+
+def box_intersection(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """Intersection area of one box with each of `boxes`"""
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[2], boxes[:, 2])
+    y2 = np.minimum(box[3], boxes[:, 3])
+    return np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+
+def box_iou(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """IoU of one box with each of `boxes`"""
+    inter = box_intersection(box, boxes)
+    union = box_area(box[None, :])[0] + box_area(boxes) - inter
+    return inter / np.maximum(union, 1e-9)
+
+
+def box_ios(box: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """Intersection over the smaller box; matches a box cut at a tile edge to its full version"""
+    inter = box_intersection(box, boxes)
+    smaller = np.minimum(box_area(box[None, :])[0], box_area(boxes))
+    return inter / np.maximum(smaller, 1e-9)
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, threshold: float, metric: str = "iou") -> np.ndarray:
+    """
+    Greedy non-maximum suppression
+
+    Args:
+        boxes: (N, 4) xyxy boxes
+        scores: (N,) confidences
+        threshold: Overlap above which the lower-scored box is dropped
+        metric: "iou" or "ios" (intersection over smaller)
+
+    Returns:
+        Indices of kept boxes, highest score first
+    """
+    overlap = box_ios if metric == "ios" else box_iou
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        if order.size == 1:
+            break
+        rest = order[1:]
+        order = rest[overlap(boxes[i], boxes[rest]) <= threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+
+def batched_nms(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, threshold: float, metric: str = "iou") -> np.ndarray:
+    """Class-aware NMS: boxes of different classes never suppress each other"""
+    if boxes.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    # Shift each class into its own coordinate range so classes cannot overlap
+    offsets = classes.astype(np.float64)[:, None] * (boxes.max() + 1.0)
+    return nms(boxes + offsets, scores, threshold, metric)
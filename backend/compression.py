@@ -0,0 +1,98 @@
+"""
+Selective response compression
+Gzips text-like responses (JSON, HTML, JS, CSS) above a size threshold and
+leaves everything else untouched: JPEG/PNG frames and other already
+compressed media gain nothing from a second pass, and streamed responses
+(MJPEG, server-sent events) are never buffered.
+"""
+
+import asyncio
+import gzip
+import os
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+# Level 5 gets most of level 9's ratio on JSON at a fraction of the CPU
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+# Bodies larger than this are compressed off the event loop
+GZIP_THREAD_MIN_SIZE = 256 * 1024
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "application/xml",
+    "image/svg+xml",
+    "text/",
+)
+# Status codes whose bodies are empty or must not be re-encoded
+PASSTHROUGH_STATUSES = {204, 206, 304}
+
+
+def is_compressible(content_type: str) -> bool:
+    media_type = content_type.partition(";")[0].strip().lower()
+    return media_type.startswith(COMPRESSIBLE_TYPES)
+
+
+class SelectiveGZipMiddleware:
+    """ASGI middleware: gzip single-message text responses of at least `minimum_size` bytes"""
+
+    def __init__(self, app: ASGIApp, minimum_size: int = GZIP_MIN_SIZE, compresslevel: int = GZIP_LEVEL):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get("accept-encoding", ""):
+            await self.app(scope, receive, send)
+            return
+
+        initial: dict = {}
+        passthrough = False
+
+        async def send_compressed(message: Message) -> None:
+            nonlocal initial, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                passthrough = (
+                    "content-encoding" in headers
+                    or message["status"] in PASSTHROUGH_STATUSES
+                    or not is_compressible(headers.get("content-type", ""))
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    # Hold the headers until the body shows whether compression applies
+                    initial = message
+                return
+
+            if passthrough or message["type"] != "http.response.body" or not initial:
+                await send(message)
+                return
+
+            start, initial = initial, {}
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            headers.add_vary_header("Accept-Encoding")
+            if message.get("more_body"):
+                # Streaming response: forward as-is rather than buffering it
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            if len(body) < self.minimum_size:
+                await send(start)
+                await send(message)
+                return
+
+            if len(body) >= GZIP_THREAD_MIN_SIZE:
+                compressed = await asyncio.to_thread(gzip.compress, body, self.compresslevel, mtime=0)
+            else:
+                compressed = gzip.compress(body, self.compresslevel, mtime=0)
+            headers["Content-Encoding"] = "gzip"
+            headers["Content-Length"] = str(len(compressed))
+            await send(start)
+            await send({"type": "http.response.body", "body": compressed})
+
+        await self.app(scope, receive, send_compressed)
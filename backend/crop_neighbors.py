@@ -0,0 +1,161 @@
+"""
+Nearest historical samples for crop recommendations
+A KD-tree over the z-score normalized features of data/Crop_ds.csv, built
+once and persisted with joblib to backend/instance/crop_neighbors.joblib.
+The artifact is loaded memory-mapped (read-only), so gunicorn workers share
+its pages, and is rebuilt whenever the CSV changes.
+"""
+
+import hashlib
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+
+from ml_utils import CROP_FEATURES
+
+logger = logging.getLogger("SmartAgriNode.crop_neighbors")
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CROP_DATA_PATH = os.getenv("CROP_DATA_PATH", os.path.join(BASE_DIR, 'data', 'Crop_ds.csv'))
+CROP_INDEX_PATH = os.getenv(
+    "CROP_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'crop_neighbors.joblib')
+)
+CROP_INDEX_LEAF_SIZE = 16
+MAX_NEIGHBORS = 50
+# Bump when the artifact layout changes so old files are rebuilt
+INDEX_FORMAT = 1
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def build_index(csv_path: str = CROP_DATA_PATH, leaf_size: int = CROP_INDEX_LEAF_SIZE) -> Dict[str, Any]:
+    """
+    Normalize the dataset features and build the KD-tree
+
+    Returns:
+        Artifact dict: tree, mean, scale, raw features, labels and the CSV hash
+    """
+    df = pd.read_csv(csv_path)
+    features = df[list(CROP_FEATURES)].to_numpy(dtype=np.float64)
+    mean = features.mean(axis=0)
+    scale = features.std(axis=0)
+    # A constant column carries no distance information; avoid dividing by zero
+    scale[scale == 0] = 1.0
+    return {
+        "format": INDEX_FORMAT,
+        "source_sha256": file_sha256(csv_path),
+        "tree": KDTree((features - mean) / scale, leaf_size=leaf_size),
+        "mean": mean,
+        "scale": scale,
+        "features": features,
+        "labels": df["label"].to_numpy(dtype=str)
+    }
+
+
+class CropNeighborIndex:
+    """Loads (or builds) the persisted index and answers batched k-NN queries"""
+
+    def __init__(self, csv_path: str = CROP_DATA_PATH, index_path: str = CROP_INDEX_PATH):
+        self.csv_path = csv_path
+        self.index_path = index_path
+        self._artifact: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._artifact is not None
+
+    def load(self) -> int:
+        """
+        Memory-map the saved index, rebuilding it first if missing or stale
+        (blocking; call via a thread)
+
+        Returns:
+            Number of indexed samples (0 when the dataset is unavailable)
+        """
+        if not os.path.exists(self.csv_path):
+            logger.warning(f"Crop dataset {self.csv_path} not found; similar-field lookups disabled")
+            return 0
+        with self._lock:
+            source_hash = file_sha256(self.csv_path)
+            artifact = self._read(source_hash)
+            if artifact is None:
+                logger.info(f"Building crop neighbour index from {self.csv_path}...")
+                os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+                tmp_path = self.index_path + ".tmp"
+                joblib.dump(build_index(self.csv_path), tmp_path)
+                os.replace(tmp_path, self.index_path)
+                artifact = self._read(source_hash)
+            self._artifact = artifact
+            return len(artifact["labels"]) if artifact else 0
+
+    def _read(self, source_hash: str) -> Optional[Dict[str, Any]]:
+        if not os.path.exists(self.index_path):
+            return None
+        try:
+            artifact = joblib.load(self.index_path, mmap_mode="r")
+        except Exception:
+            logger.warning(f"Ignoring unreadable crop neighbour index {self.index_path}")
+            return None
+        if artifact.get("format") != INDEX_FORMAT or artifact.get("source_sha256") != source_hash:
+            return None
+        return artifact
+
+    def query(self, rows: Sequence[Sequence[float]], k: int = 5) -> List[List[Dict[str, Any]]]:
+        """
+        k nearest dataset samples for each feature row, closest first
+
+        Args:
+            rows: Feature rows in CROP_FEATURES order
+            k: Neighbours per row (capped at MAX_NEIGHBORS and the dataset size)
+
+        Returns:
+            Per row, a list of {"crop", "distance", "sample", "features"}; distance
+            is Euclidean in standard-deviation units
+        """
+        artifact = self._artifact
+        if artifact is None:
+            raise RuntimeError("Crop neighbour index not loaded")
+        labels, features = artifact["labels"], artifact["features"]
+        k = max(1, min(k, MAX_NEIGHBORS, len(labels)))
+        points = (np.asarray(rows, dtype=np.float64) - artifact["mean"]) / artifact["scale"]
+        distances, indices = artifact["tree"].query(points, k=k)
+        self.queries += len(points)
+
+        results = []
+        for row_distances, row_indices in zip(distances, indices):
+            results.append([
+                {
+                    "crop": str(labels[i]),
+                    "distance": round(float(d), 4),
+                    "sample": int(i),
+                    "features": dict(zip(CROP_FEATURES, features[i].tolist()))
+                }
+                for d, i in zip(row_distances, row_indices)
+            ])
+        return results
+
+    def stats(self) -> Dict[str, Any]:
+        artifact = self._artifact
+        return {
+            "loaded": artifact is not None,
+            "samples": len(artifact["labels"]) if artifact else 0,
+            "queries": self.queries
+        }
+
+
+crop_neighbor_index = CropNeighborIndex()
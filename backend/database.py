@@ -1,16 +1,27 @@
 """
 Supabase Database Integration
 Handles user data storage and retrieval
+
+STORAGE_BACKEND selects where history and images go: "supabase" (default)
+or "local" (SQLite + filesystem, see local_storage.py). Callers always go
+through SupabaseDB, which is the selected backend.
 """
 
+import hashlib
 import logging
 import os
-from typing import Any, Dict, Optional
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
 
 import httpx
 
 from dotenv import load_dotenv
-from supabase import Client, create_client
+from storage3.exceptions import StorageApiError
+from supabase import Client, ClientOptions, create_client
+
+from http_client import get_http_client, get_sync_client
 
 load_dotenv()
 
@@ -19,6 +30,8 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
 SUPABASE_ANON_KEY = os.getenv("SUPABASE_ANON_KEY")
 
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").lower()
+
 # Initialize Supabase client
 supabase: Optional[Client] = None
 
@@ -27,14 +40,189 @@ logger = logging.getLogger("SmartAgriNode.database")
 if SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY:
     try:
         # Use SERVICE_ROLE_KEY to bypass RLS
-        supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+        # Share one keep-alive pool across PostgREST, Storage and Auth admin calls
+        supabase = create_client(
+            SUPABASE_URL,
+            SUPABASE_SERVICE_ROLE_KEY,
+            options=ClientOptions(httpx_client=get_sync_client())
+        )
         logger.info("Supabase client initialized")
     except Exception:  # pragma: no cover - configuration issue
         logger.exception("Failed to initialize Supabase client")
 else:
     logger.warning("SUPABASE_URL or SUPABASE_SERVICE_ROLE_KEY not set")
 
-class SupabaseDB:
+# Storage buckets known to exist; creation is attempted once per bucket per process
+KNOWN_BUCKETS: set = set()
+
+def ensure_bucket(bucket_name: str) -> None:
+    """Create a public storage bucket unless this process already knows it exists"""
+    if bucket_name in KNOWN_BUCKETS:
+        return
+    try:
+        supabase.storage.create_bucket(bucket_name, options={"public": True})
+    except StorageApiError as e:
+        # 409 Conflict ("already exists") is the normal case; anything else is retried on the next upload
+        if str(e.status) != "409":
+            logger.warning(f"Could not create bucket {bucket_name}: {e}")
+            return
+    except Exception as e:
+        logger.warning(f"Could not create bucket {bucket_name}: {e}")
+        return
+    KNOWN_BUCKETS.add(bucket_name)
+
+# History tables found without the model_version column (schema not migrated yet)
+TABLES_WITHOUT_MODEL_VERSION: set = set()
+
+def insert_history(table: str, data: Dict[str, Any]):
+    """
+    Insert a history row; on a schema that predates the model_version column
+    the row is stored without it (and later rows skip it) instead of failing
+    """
+    if table in TABLES_WITHOUT_MODEL_VERSION:
+        data = {key: value for key, value in data.items() if key != "model_version"}
+    try:
+        return supabase.table(table).insert(data).execute()
+    except Exception as e:
+        if "model_version" not in data or "model_version" not in str(e):
+            raise
+        logger.warning(
+            f"{table} has no model_version column; run backend/migrations/001_model_version.sql. "
+            "Storing history without model versions until then"
+        )
+        TABLES_WITHOUT_MODEL_VERSION.add(table)
+        return supabase.table(table).insert({key: value for key, value in data.items() if key != "model_version"}).execute()
+
+# Images are stored under the hash of their bytes, so re-uploads of the same
+# image (camera retries, repeated scans, identical annotated outputs) reuse one object
+OBJECT_INDEX_SIZE = int(os.getenv("OBJECT_INDEX_SIZE", "65536"))
+
+
+def content_key(user_id: str, file_content: bytes, file_ext: str, content_hash: Optional[str] = None) -> str:
+    """
+    Content-addressed object key: <user_id>/objects/<hash[:2]>/<sha256>.<ext>
+
+    Objects stay under their owner's prefix (as before content addressing), so
+    a user's images can be listed and deleted per user; deduplication applies
+    to repeated uploads by the same user.
+    """
+    digest = content_hash or hashlib.sha256(file_content).hexdigest()
+    return f"{user_id}/objects/{digest[:2]}/{digest}.{file_ext}"
+
+
+class ObjectIndex:
+    """In-process LRU of (bucket, key) pairs known to exist in storage, with dedup counters"""
+
+    def __init__(self, max_entries: int = OBJECT_INDEX_SIZE):
+        self.max_entries = max_entries
+        self._known: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.deduplicated = 0
+        self.bytes_saved = 0
+
+    def contains(self, bucket: str, key: str) -> bool:
+        with self._lock:
+            if (bucket, key) not in self._known:
+                return False
+            self._known.move_to_end((bucket, key))
+            return True
+
+    def add(self, bucket: str, key: str) -> None:
+        with self._lock:
+            self._known[(bucket, key)] = None
+            self._known.move_to_end((bucket, key))
+            while len(self._known) > self.max_entries:
+                self._known.popitem(last=False)
+
+    def record(self, uploaded: bool, size: int) -> None:
+        with self._lock:
+            if uploaded:
+                self.uploads += 1
+            else:
+                self.deduplicated += 1
+                self.bytes_saved += size
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "known_objects": len(self._known),
+                "uploads": self.uploads,
+                "deduplicated": self.deduplicated,
+                "bytes_saved": self.bytes_saved
+            }
+
+
+object_index = ObjectIndex()
+
+class StorageBackend(ABC):
+    """
+    Interface for history, user metadata, field scans and image storage
+    Every method is a coroutine so backends can be swapped without touching callers;
+    a backend missing any abstract method fails at construction, not on first use
+    """
+
+    @abstractmethod
+    async def verify_jwt(self, token: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abstractmethod
+    async def store_user_metadata(self, user_id: str, email: str, username: Optional[str] = None) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def store_crop_recommendation(self, user_id: str, input_data: Dict[str, float], recommendation: str,
+                                        confidence: float, model_version: Optional[str] = None) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def store_weed_detection(self, user_id: str, filename: str, detections: int,
+                                   input_image_url: Optional[str] = None, output_image_url: Optional[str] = None,
+                                   model_version: Optional[str] = None) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def get_user_history(self, user_id: str, limit: int = 10) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def upload_weed_image(self, user_id: str, file_content: bytes, file_ext: str, bucket_name: str,
+                                content_hash: Optional[str] = None) -> str:
+        ...
+
+    @abstractmethod
+    async def upload_avatar(self, user_id: str, file_content: bytes, file_ext: str) -> str:
+        ...
+
+    @abstractmethod
+    async def clear_avatar_reference(self, user_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def delete_avatar_file(self, user_id: str) -> bool:
+        ...
+
+    async def delete_avatar(self, user_id: str) -> bool:
+        await self.delete_avatar_file(user_id)
+        return await self.clear_avatar_reference(user_id)
+
+    @abstractmethod
+    async def create_field_scan(self, user_id: str) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def update_field_scan(self, scan_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+        ...
+
+    @abstractmethod
+    async def get_latest_pending_scan(self, user_id: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    async def close(self) -> None:
+        """Flush and release resources on shutdown"""
+        return None
+
+class SupabaseBackend(StorageBackend):
     """Supabase database operations"""
     
     @staticmethod
@@ -75,19 +263,19 @@ class SupabaseDB:
         }
 
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(verify_url, headers=headers)
-                response.raise_for_status()
-                data = response.json()
-                if not data.get("id"):
-                    logger.warning("Supabase verification succeeded but missing user id")
-                    return None
-                return {
-                    "id": data.get("id"),
-                    "email": data.get("email"),
-                    "user_metadata": data.get("user_metadata", {}),
-                    "app_metadata": data.get("app_metadata", {})
-                }
+            # Pooled keep-alive client: no new TLS handshake per verification
+            response = await get_http_client().get(verify_url, headers=headers, timeout=5.0)
+            response.raise_for_status()
+            data = response.json()
+            if not data.get("id"):
+                logger.warning("Supabase verification succeeded but missing user id")
+                return None
+            return {
+                "id": data.get("id"),
+                "email": data.get("email"),
+                "user_metadata": data.get("user_metadata", {}),
+                "app_metadata": data.get("app_metadata", {})
+            }
         except httpx.HTTPStatusError as exc:
             if exc.response.status_code == 401:
                 logger.warning("Token verification failed: unauthorized (401)")
@@ -137,7 +325,8 @@ class SupabaseDB:
         user_id: str,
         input_data: Dict[str, float],
         recommendation: str,
-        confidence: float
+        confidence: float,
+        model_version: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Store crop recommendation history
@@ -147,6 +336,7 @@ class SupabaseDB:
             input_data: Input parameters (N, P, K, etc.)
             recommendation: Recommended crop
             confidence: Prediction confidence
+            model_version: Version of the model that produced the prediction
             
         Returns:
             Stored record
@@ -162,8 +352,10 @@ class SupabaseDB:
                 "recommended_crop": recommendation,
                 "confidence": confidence
             }
+            if model_version:
+                data["model_version"] = model_version
             
-            result = supabase.table("crop_recommendations").insert(data).execute()
+            result = insert_history("crop_recommendations", data)
             return result.data[0] if result.data else {}
         except Exception:
             logger.exception("Error storing crop recommendation")
@@ -175,7 +367,8 @@ class SupabaseDB:
         filename: str,
         detections: int,
         input_image_url: Optional[str] = None,
-        output_image_url: Optional[str] = None
+        output_image_url: Optional[str] = None,
+        model_version: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Store weed detection history
@@ -186,6 +379,7 @@ class SupabaseDB:
             detections: Number of weeds detected
             input_image_url: URL of the input image
             output_image_url: URL of the output image
+            model_version: Version of the model that produced the detections
             
         Returns:
             Stored record
@@ -202,8 +396,10 @@ class SupabaseDB:
                 "input_image_url": input_image_url,
                 "output_image_url": output_image_url
             }
+            if model_version:
+                data["model_version"] = model_version
             
-            result = supabase.table("weed_detections").insert(data).execute()
+            result = insert_history("weed_detections", data)
             return result.data[0] if result.data else {}
         except Exception as e:
             logger.exception("Error storing weed detection")
@@ -249,15 +445,18 @@ class SupabaseDB:
             return {"crop_recommendations": [], "weed_detections": []}
     
     @staticmethod
-    async def upload_weed_image(user_id: str, file_content: bytes, file_ext: str, bucket_name: str) -> str:
+    async def upload_weed_image(user_id: str, file_content: bytes, file_ext: str, bucket_name: str,
+                                content_hash: Optional[str] = None) -> str:
         """
         Upload weed detection image to storage and return public URL
+        Objects are keyed by owner and content hash; an image the user already stored is not transferred again
         
         Args:
             user_id: User ID
             file_content: Raw file content
             file_ext: File extension (jpg, png, etc.)
             bucket_name: Name of the bucket (input-images or output-images)
+            content_hash: SHA-256 hex digest of file_content, if already known
             
         Returns:
             Public URL of the uploaded image
@@ -265,25 +464,26 @@ class SupabaseDB:
         if not supabase:
             raise RuntimeError("Supabase not configured")
             
-        import uuid
-        filename = f"{user_id}/{uuid.uuid4()}.{file_ext}"
+        filename = content_key(user_id, file_content, file_ext, content_hash)
+        bucket = supabase.storage.from_(bucket_name)
         
         try:
-            # Ensure bucket exists (optional)
-            try:
-                supabase.storage.create_bucket(bucket_name, options={"public": True})
-            except Exception:
-                pass
+            # Ensure bucket exists (once per process)
+            ensure_bucket(bucket_name)
 
-            # Upload file
-            supabase.storage.from_(bucket_name).upload(
-                path=filename,
-                file=file_content,
-                file_options={"content-type": f"image/{file_ext}", "upsert": "true"}
-            )
+            # Skip the transfer when the object is known (or found with a HEAD request) to exist
+            exists = object_index.contains(bucket_name, filename) or bucket.exists(filename)
+            if not exists:
+                bucket.upload(
+                    path=filename,
+                    file=file_content,
+                    file_options={"content-type": f"image/{file_ext}", "upsert": "true"}
+                )
+            object_index.add(bucket_name, filename)
+            object_index.record(uploaded=not exists, size=len(file_content))
             
             # Get public URL
-            public_url = supabase.storage.from_(bucket_name).get_public_url(filename)
+            public_url = bucket.get_public_url(filename)
             return public_url
         except Exception as e:
             logger.exception(f"Error uploading image to {bucket_name}")
@@ -309,12 +509,8 @@ class SupabaseDB:
         bucket = "avatars"
         
         try:
-            # Ensure bucket exists (optional, but good practice)
-            # Note: create_bucket might fail if it already exists, which is fine
-            try:
-                supabase.storage.create_bucket(bucket, options={"public": True})
-            except Exception:
-                pass  # Bucket likely exists
+            # Ensure bucket exists (once per process)
+            ensure_bucket(bucket)
 
             # Upload file (upsert=True to overwrite)
             # Note: using 'upsert': 'true' as string for some versions, or bool for others. 
@@ -428,8 +624,8 @@ class SupabaseDB:
         Returns:
             True if successful
         """
-        await SupabaseDB.delete_avatar_file(user_id)
-        return await SupabaseDB.clear_avatar_reference(user_id)
+        await SupabaseBackend.delete_avatar_file(user_id)
+        return await SupabaseBackend.clear_avatar_reference(user_id)
 
     @staticmethod
     async def create_field_scan(user_id: str) -> Dict[str, Any]:
@@ -474,3 +670,13 @@ class SupabaseDB:
             logger.exception("Error fetching pending scan")
             return None
 
+def create_storage_backend() -> StorageBackend:
+    """Backend selected by STORAGE_BACKEND"""
+    if STORAGE_BACKEND == "local":
+        from local_storage import LocalStorageBackend
+        return LocalStorageBackend()
+    if STORAGE_BACKEND != "supabase":
+        logger.warning(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND!r}, using supabase")
+    return SupabaseBackend()
+
+SupabaseDB: StorageBackend = create_storage_backend()
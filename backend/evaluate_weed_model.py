@@ -0,0 +1,356 @@
+"""
+Weed model evaluation harness
+Measures per-class mAP and throughput together across inference engines,
+input sizes, batch sizes and thread counts on data/weeddataset/{val,test}
+
+Decoded, letterboxed images are cached per (split, input size) in a
+memory-mapped .npy under backend/instance/eval_cache, so repeated runs
+skip JPEG decoding and resizing entirely; the cache is rebuilt when the
+split's files change.
+
+Usage (from backend/):
+    python evaluate_weed_model.py --split val --engines ultralytics onnxruntime \
+        --imgsz 640 480 --batch-sizes 1 4 --threads 1 2 4 --json eval.json
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import yaml
+
+from benchmark_tiling import DATASET_DIR, load_labels
+from boxes import batched_nms, box_iou
+from ml_utils import weed_model_path
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'eval_cache')
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+LETTERBOX_COLOR = 114
+
+
+def load_class_names():
+    with open(os.path.join(DATASET_DIR, 'data.yaml'), "r") as f:
+        names = yaml.safe_load(f)["names"]
+    return list(names.values()) if isinstance(names, dict) else list(names)
+
+
+def letterbox(img, size: int):
+    """Resize keeping aspect ratio and pad to size x size; returns image, scale and (pad_x, pad_y)"""
+    height, width = img.shape[:2]
+    ratio = min(size / height, size / width)
+    new_w, new_h = int(round(width * ratio)), int(round(height * ratio))
+    resized = cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_LINEAR) if (new_w, new_h) != (width, height) else img
+    pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+    out = np.full((size, size, 3), LETTERBOX_COLOR, dtype=np.uint8)
+    out[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = resized
+    return out, ratio, (pad_x, pad_y)
+
+
+class PreprocessedSplit:
+    """
+    Letterboxed images of one split in a memory-mapped uint8 array
+
+    images[i] is (size, size, 3) BGR; ratios/pads map boxes back to the
+    original image, where the ground truth lives.
+    """
+
+    def __init__(self, split: str, size: int, limit=None):
+        self.split = split
+        self.size = size
+        image_dir = os.path.join(DATASET_DIR, split, 'images')
+        self.label_dir = os.path.join(DATASET_DIR, split, 'labels')
+        self.image_paths = [os.path.join(image_dir, name) for name in sorted(os.listdir(image_dir))[:limit]]
+
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        stem = os.path.join(CACHE_DIR, f"{split}_{size}_{len(self.image_paths)}")
+        self.array_path, self.meta_path = stem + ".npy", stem + ".json"
+        fingerprint = self._fingerprint()
+
+        meta = None
+        if os.path.exists(self.array_path) and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as f:
+                meta = json.load(f)
+            if meta.get("fingerprint") != fingerprint:
+                meta = None
+        if meta is None:
+            meta = self._build(fingerprint)
+            self.cached = False
+        else:
+            self.cached = True
+
+        self.images = np.load(self.array_path, mmap_mode="r")
+        self.ratios = np.asarray(meta["ratios"])
+        self.pads = np.asarray(meta["pads"], dtype=np.float64)
+        self.gt_boxes = [np.asarray(b, dtype=np.float64).reshape(-1, 4) for b in meta["gt_boxes"]]
+        self.gt_classes = [np.asarray(c, dtype=np.int64) for c in meta["gt_classes"]]
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def _fingerprint(self) -> str:
+        digest = hashlib.sha256()
+        for path in self.image_paths:
+            stat = os.stat(path)
+            digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    def _build(self, fingerprint: str) -> dict:
+        images = np.lib.format.open_memmap(
+            self.array_path, mode="w+", dtype=np.uint8, shape=(len(self.image_paths), self.size, self.size, 3)
+        )
+        meta = {"fingerprint": fingerprint, "ratios": [], "pads": [], "gt_boxes": [], "gt_classes": []}
+        for i, path in enumerate(self.image_paths):
+            img = cv2.imread(path)
+            if img is None:
+                raise SystemExit(f"Could not decode {path}")
+            height, width = img.shape[:2]
+            images[i], ratio, pad = letterbox(img, self.size)
+            label_path = os.path.join(self.label_dir, os.path.splitext(os.path.basename(path))[0] + '.txt')
+            boxes, classes = load_labels(label_path, width, height)
+            meta["ratios"].append(ratio)
+            meta["pads"].append(pad)
+            meta["gt_boxes"].append(boxes.tolist())
+            meta["gt_classes"].append(classes.tolist())
+        images.flush()
+        del images
+        with open(self.meta_path, "w") as f:
+            json.dump(meta, f)
+        return meta
+
+    def to_original(self, index: int, boxes: np.ndarray) -> np.ndarray:
+        """Letterboxed xyxy -> original image xyxy"""
+        pad_x, pad_y = self.pads[index]
+        return (boxes - np.array([pad_x, pad_y, pad_x, pad_y])) / self.ratios[index]
+
+
+# -- engines ---------------------------------------------------------------
+
+class UltralyticsEngine:
+    """The serving path: YOLO wrapper around Models/weed_detection_model.*"""
+
+    name = "ultralytics"
+
+    def __init__(self, model_path: str, size: int, threads: int, conf: float, iou: float):
+        import torch
+        from ultralytics import YOLO
+        torch.set_num_threads(threads)
+        self.model = YOLO(model_path, task='detect')
+        self.size, self.conf, self.iou = size, conf, iou
+
+    def supports(self, batch_size: int):
+        return None
+
+    def __call__(self, batch: np.ndarray):
+        results = self.model(list(batch), imgsz=self.size, conf=self.conf, iou=self.iou, verbose=False)
+        out = []
+        for result in results:
+            boxes = result.boxes
+            if boxes is None or len(boxes) == 0:
+                out.append((np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)))
+                continue
+            out.append((boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(), boxes.cls.cpu().numpy().astype(np.int64)))
+        return out
+
+
+class OnnxRuntimeEngine:
+    """Bare ONNX Runtime session with numpy pre/post-processing"""
+
+    name = "onnxruntime"
+
+    def __init__(self, model_path: str, size: int, threads: int, conf: float, iou: float):
+        import onnxruntime as ort
+        if not model_path.endswith(".onnx"):
+            raise SystemExit("onnxruntime engine needs an .onnx model")
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_shape = model_input.shape
+        self.size, self.conf, self.iou = size, conf, iou
+
+    def supports(self, batch_size: int):
+        """Reason a (batch, size) pair cannot run on this export, or None"""
+        batch_dim, _, height, width = self.input_shape
+        if isinstance(batch_dim, int) and batch_dim != batch_size:
+            return f"model exported with fixed batch {batch_dim}"
+        if isinstance(height, int) and (height, width) != (self.size, self.size):
+            return f"model exported with fixed input {height}x{width}"
+        return None
+
+    def __call__(self, batch: np.ndarray):
+        # BGR HWC uint8 -> RGB NCHW float32 in [0, 1]
+        tensor = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+        output = self.session.run(None, {self.input_name: tensor})[0]
+        return [self._decode(pred) for pred in output]
+
+    def _decode(self, pred: np.ndarray):
+        """YOLOv8 head (4 + nc, anchors) -> NMSed boxes, scores, classes"""
+        pred = pred.T
+        class_scores = pred[:, 4:]
+        classes = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(classes)), classes]
+        keep = scores >= self.conf
+        if not keep.any():
+            return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+        cx, cy, w, h = pred[keep, :4].T
+        boxes = np.stack([cx - w / 2, cy - h / 2, cx + w / 2, cy + h / 2], axis=1).astype(np.float64)
+        scores, classes = scores[keep].astype(np.float64), classes[keep]
+        kept = batched_nms(boxes, scores, classes, self.iou)
+        return boxes[kept], scores[kept], classes[kept]
+
+
+ENGINES = {engine.name: engine for engine in (UltralyticsEngine, OnnxRuntimeEngine)}
+
+
+# -- metrics ---------------------------------------------------------------
+
+def average_precision(recall: np.ndarray, precision: np.ndarray) -> float:
+    """COCO-style 101-point interpolated AP"""
+    precision = np.concatenate([[0.0], precision, [0.0]])
+    recall = np.concatenate([[0.0], recall, [1.0]])
+    # Precision envelope: best precision at any recall >= r
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    points = np.linspace(0, 1, 101)
+    indices = np.searchsorted(recall, points, side="left")
+    return float(np.mean(precision[np.clip(indices, 0, len(precision) - 1)]))
+
+
+def per_class_ap(predictions, gt_boxes, gt_classes, num_classes: int) -> np.ndarray:
+    """
+    AP per class and IoU threshold
+
+    Args:
+        predictions: Per image (boxes, scores, classes) in original coordinates
+        gt_boxes / gt_classes: Per image ground truth
+
+    Returns:
+        (num_classes, len(IOU_THRESHOLDS)) array; NaN for classes without ground truth
+    """
+    ap = np.full((num_classes, len(IOU_THRESHOLDS)), np.nan)
+    for cls in range(num_classes):
+        gts = [boxes[classes == cls] for boxes, classes in zip(gt_boxes, gt_classes)]
+        total_gt = sum(len(g) for g in gts)
+        if total_gt == 0:
+            continue
+        dets = [
+            (score, image, box)
+            for image, (boxes, scores, classes) in enumerate(predictions)
+            for box, score in zip(boxes[classes == cls], scores[classes == cls])
+        ]
+        dets.sort(key=lambda d: -d[0])
+        for t, threshold in enumerate(IOU_THRESHOLDS):
+            used = [np.zeros(len(g), dtype=bool) for g in gts]
+            tp = np.zeros(len(dets))
+            for i, (_, image, box) in enumerate(dets):
+                candidates = gts[image]
+                if not len(candidates):
+                    continue
+                ious = np.where(used[image], -1.0, box_iou(box, candidates))
+                best = int(np.argmax(ious))
+                if ious[best] >= threshold:
+                    used[image][best] = True
+                    tp[i] = 1
+            tp_cum = np.cumsum(tp)
+            recall = tp_cum / total_gt
+            precision = tp_cum / np.arange(1, len(dets) + 1) if len(dets) else np.zeros(0)
+            ap[cls, t] = average_precision(recall, precision)
+    return ap
+
+
+# -- runner ----------------------------------------------------------------
+
+def evaluate(engine, data: PreprocessedSplit, batch_size: int, names) -> dict:
+    # Warm-up so graph initialization is not billed to the first config
+    engine(np.asarray(data.images[:batch_size]))
+
+    predictions = []
+    inference_seconds = 0.0
+    for start in range(0, len(data), batch_size):
+        batch = np.asarray(data.images[start:start + batch_size])
+        if len(batch) < batch_size and engine.supports(len(batch)):
+            # Fixed-batch export: pad the last batch and drop the padding
+            batch = np.concatenate([batch, np.repeat(batch[-1:], batch_size - len(batch), axis=0)])
+        tick = time.perf_counter()
+        outputs = engine(batch)
+        inference_seconds += time.perf_counter() - tick
+        for offset, (boxes, scores, classes) in enumerate(outputs[:min(batch_size, len(data) - start)]):
+            keep = classes < len(names)
+            predictions.append((data.to_original(start + offset, boxes[keep]), scores[keep], classes[keep]))
+
+    ap = per_class_ap(predictions, data.gt_boxes, data.gt_classes, len(names))
+    return {
+        "images_per_sec": round(len(data) / inference_seconds, 2) if inference_seconds else 0.0,
+        "map50": round(float(np.nanmean(ap[:, 0])), 4) if not np.isnan(ap[:, 0]).all() else None,
+        "map50_95": round(float(np.nanmean(ap)), 4) if not np.isnan(ap).all() else None,
+        "per_class": {
+            name: {
+                "ap50": None if np.isnan(ap[i, 0]) else round(float(ap[i, 0]), 4),
+                "ap50_95": None if np.isnan(ap[i]).all() else round(float(np.nanmean(ap[i])), 4)
+            }
+            for i, name in enumerate(names)
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate weed model accuracy and throughput")
+    parser.add_argument("--model", default=weed_model_path, help="Model file (.onnx or .pt)")
+    parser.add_argument("--splits", nargs="+", default=["val"], choices=["val", "test"])
+    parser.add_argument("--engines", nargs="+", default=["ultralytics"], choices=sorted(ENGINES))
+    parser.add_argument("--imgsz", type=int, nargs="+", default=[640], help="Square input sizes")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1])
+    parser.add_argument("--conf", type=float, default=0.001, help="Confidence threshold (low, as for mAP)")
+    parser.add_argument("--iou", type=float, default=0.7, help="NMS IoU threshold")
+    parser.add_argument("--limit", type=int, default=None, help="Only use the first N images per split")
+    parser.add_argument("--json", dest="json_path", default=None, help="Write results to this JSON file")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        raise SystemExit(f"Model not found: {args.model}")
+    names = load_class_names()
+
+    rows = []
+    for split, size in itertools.product(args.splits, args.imgsz):
+        tick = time.perf_counter()
+        data = PreprocessedSplit(split, size, limit=args.limit)
+        source = "cache" if data.cached else "decoded"
+        print(f"{split} @ {size}px: {len(data)} images ({source}, {time.perf_counter() - tick:.2f}s)")
+
+        for engine_name, threads in itertools.product(args.engines, args.threads):
+            engine = ENGINES[engine_name](args.model, size, threads, args.conf, args.iou)
+            for batch_size in args.batch_sizes:
+                row = {"split": split, "engine": engine_name, "imgsz": size, "batch": batch_size, "threads": threads}
+                reason = engine.supports(batch_size)
+                if reason:
+                    row["skipped"] = reason
+                else:
+                    row.update(evaluate(engine, data, batch_size, names))
+                rows.append(row)
+
+    header = f"{'split':<6}{'engine':<13}{'imgsz':>6}{'batch':>6}{'thr':>5}{'img/s':>9}{'mAP50':>8}{'mAP50-95':>10}"
+    header += "".join(f"{'AP50 ' + name:>12}" for name in names)
+    print(header)
+    for row in rows:
+        line = f"{row['split']:<6}{row['engine']:<13}{row['imgsz']:>6}{row['batch']:>6}{row['threads']:>5}"
+        if "skipped" in row:
+            print(f"{line}  skipped: {row['skipped']}")
+            continue
+        line += f"{row['images_per_sec']:>9}{str(row['map50']):>8}{str(row['map50_95']):>10}"
+        line += "".join(f"{str(row['per_class'][name]['ap50']):>12}" for name in names)
+        print(line)
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"model": args.model, "classes": names, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Virtual ESP32 fleet for load testing the device API
+Runs hundreds of asyncio devices against a running server. Each device
+polls /api/device/check-command, posts readings to /update-sensors and
+uploads JPEG frames from test_images/ to /upload-image at its own jittered
+rate, and reacts to MEASURE_SENSORS / START_WEED_SCAN like the firmware.
+Reports per-endpoint latency, ingestion throughput and the server-side
+backlog sampled from /api/metrics.
+
+Usage (from backend/, with the server running):
+    python fleet_simulator.py --devices 200 --duration 60 --poll-interval 2 --sensor-interval 10 --image-interval 30
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import cv2
+import httpx
+import numpy as np
+
+from metrics import percentile
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_IMAGES_DIR = os.path.join(BASE_DIR, 'test_images')
+# Frames the turret captures per weed scan
+SCAN_FRAMES = 8
+
+
+class EndpointStats:
+    """Latency samples and outcome counters for one endpoint"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ok = 0
+        self.rejected = 0   # 429 from admission control / memory budget
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.bytes_sent = 0
+
+    def record(self, seconds: float, status: Optional[int], sent: int = 0) -> None:
+        self.latencies.append(seconds)
+        if status is not None and status < 400:
+            self.ok += 1
+            self.bytes_sent += sent
+        elif status == 429:
+            self.rejected += 1
+        else:
+            self.errors[str(status or "connection")] += 1
+
+    def report(self, elapsed: float) -> Dict:
+        values = sorted(self.latencies)
+        report = {
+            "requests": len(values),
+            "ok": self.ok,
+            "rejected": self.rejected,
+            "errors": dict(self.errors),
+            "throughput_rps": round(self.ok / elapsed, 2) if elapsed else 0.0,
+            "mbytes_per_s": round(self.bytes_sent / elapsed / 1024 / 1024, 3) if elapsed else 0.0
+        }
+        if values:
+            report.update({
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2)
+            })
+        return report
+
+
+class FrameSource:
+    """JPEG frames from test_images/, optionally made unique per upload to defeat the result cache"""
+
+    def __init__(self, images_dir: str, unique: bool):
+        paths = sorted(glob.glob(os.path.join(images_dir, '*.jp*g')))
+        if not paths:
+            raise SystemExit(f"No JPEG images in {images_dir}")
+        self.frames = []
+        for path in paths:
+            with open(path, "rb") as f:
+                self.frames.append(f.read())
+        self.unique = unique
+        self._decoded = [cv2.imdecode(np.frombuffer(frame, dtype=np.uint8), cv2.IMREAD_COLOR) for frame in self.frames] if unique else []
+
+    def _unique_frame(self, index: int) -> bytes:
+        img = self._decoded[index].copy()
+        # A random corner pixel changes the content hash without changing the scene
+        img[0, 0] = np.random.randint(0, 256, 3, dtype=np.uint8)
+        ok, buffer = cv2.imencode('.jpg', img)
+        return buffer.tobytes()
+
+    async def next(self) -> bytes:
+        index = random.randrange(len(self.frames))
+        if not self.unique:
+            return self.frames[index]
+        return await asyncio.to_thread(self._unique_frame, index)
+
+
+class VirtualDevice:
+    """One simulated sensor node + ESP32-CAM"""
+
+    def __init__(self, device_id: str, client: httpx.AsyncClient, stats: Dict[str, EndpointStats],
+                 frames: FrameSource, args: argparse.Namespace):
+        self.device_id = device_id
+        self.client = client
+        self.stats = stats
+        self.frames = frames
+        self.args = args
+        self.headers = {"X-Device-ID": device_id}
+        self.reading = {"N": random.uniform(30, 100), "P": random.uniform(20, 80),
+                        "K": random.uniform(20, 80), "ph": random.uniform(5.5, 7.5)}
+        self.commands: Dict[str, int] = defaultdict(int)
+
+    async def _request(self, name: str, method: str, path: str, sent: int = 0, headers: Optional[Dict[str, str]] = None,
+                       **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, path, headers={**self.headers, **(headers or {})}, **kwargs)
+        except httpx.HTTPError:
+            self.stats[name].record(time.perf_counter() - start, None)
+            return None
+        self.stats[name].record(time.perf_counter() - start, response.status_code, sent)
+        return response
+
+    async def _every(self, interval: float, action) -> None:
+        """Run `action` every `interval` seconds (+-20% jitter), starting at a random offset"""
+        if interval <= 0:
+            return
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            await action()
+            await asyncio.sleep(interval * random.uniform(0.8, 1.2))
+
+    async def poll_command(self) -> None:
+        response = await self._request("check-command", "GET", "/api/device/check-command")
+        if response is None or response.status_code != 200:
+            return
+        command = response.json()
+        if command == "MEASURE_SENSORS":
+            self.commands[command] += 1
+            await self.send_sensors()
+        elif command == "START_WEED_SCAN":
+            self.commands[command] += 1
+            for _ in range(SCAN_FRAMES):
+                await self.upload_frame()
+
+    async def send_sensors(self) -> None:
+        # Random walk, so consecutive readings look like a real field
+        for metric, spread in (("N", 2.0), ("P", 1.5), ("K", 1.5), ("ph", 0.05)):
+            self.reading[metric] = max(0.0, self.reading[metric] + random.gauss(0, spread))
+        await self._request("update-sensors", "POST", "/api/device/update-sensors", json=self.reading)
+
+    async def upload_frame(self) -> None:
+        frame = await self.frames.next()
+        await self._request("upload-image", "POST", "/api/device/upload-image", sent=len(frame),
+                            content=frame, headers={"Content-Type": "image/jpeg"})
+
+    async def run(self) -> None:
+        await asyncio.gather(
+            self._every(self.args.poll_interval, self.poll_command),
+            self._every(self.args.sensor_interval, self.send_sensors),
+            self._every(self.args.image_interval, self.upload_frame)
+        )
+
+
+async def sample_backlog(client: httpx.AsyncClient, interval: float, samples: List[Dict]) -> None:
+    """Record the server's inference, scan and memory-budget queues from /api/metrics"""
+    while True:
+        try:
+            response = await client.get("/api/metrics")
+            metrics = response.json()
+            samples.append({
+                "t": time.time(),
+                "admission_queued": metrics["admission"]["queued"],
+                "admission_running": metrics["admission"]["running"],
+                "scan_tasks_queued": metrics.get("scan_jobs", {}).get("tasks", {}).get("queued", 0),
+                "memory_waiting": metrics.get("image_memory_budget", {}).get("waiting", 0)
+            })
+        except (httpx.HTTPError, ValueError, KeyError):
+            pass
+        await asyncio.sleep(interval)
+
+
+def summarize_backlog(samples: List[Dict]) -> Dict:
+    if not samples:
+        return {}
+    summary = {}
+    for key in ("admission_queued", "admission_running", "scan_tasks_queued", "memory_waiting"):
+        values = [s[key] for s in samples]
+        summary[key] = {"mean": round(sum(values) / len(values), 2), "max": max(values), "last": values[-1]}
+    summary["samples"] = len(samples)
+    return summary
+
+
+async def run_fleet(args: argparse.Namespace) -> Dict:
+    frames = FrameSource(args.images_dir, args.unique_frames)
+    stats: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+    limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+    backlog: List[Dict] = []
+
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        devices = [VirtualDevice(f"{args.device_prefix}-{i:04d}", client, stats, frames, args) for i in range(args.devices)]
+
+        async def start(index: int, device: VirtualDevice) -> None:
+            # Spread device boot over the ramp-up period
+            await asyncio.sleep(args.ramp_up * index / max(1, len(devices)))
+            await device.run()
+
+        tasks = [asyncio.create_task(start(i, d)) for i, d in enumerate(devices)]
+        tasks.append(asyncio.create_task(sample_backlog(client, args.metrics_interval, backlog)))
+        started = time.perf_counter()
+        try:
+            await asyncio.sleep(args.duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.perf_counter() - started
+
+    commands: Dict[str, int] = defaultdict(int)
+    for device in devices:
+        for command, count in device.commands.items():
+            commands[command] += count
+    return {
+        "devices": args.devices,
+        "duration_s": round(elapsed, 2),
+        "endpoints": {name: endpoint.report(elapsed) for name, endpoint in sorted(stats.items())},
+        "commands_received": dict(commands),
+        "server_backlog": summarize_backlog(backlog)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the device API with a fleet of virtual ESP32 nodes")
+    parser.add_argument("--base-url", default="http://localhost:5000", help="Server to load (main.py and gunicorn listen on 5000)")
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run after the first device starts")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which devices come online")
+    parser.add_argument("--poll-interval", type=float, default=2, help="Seconds between check-command polls (0 disables)")
+    parser.add_argument("--sensor-interval", type=float, default=10, help="Seconds between sensor readings (0 disables)")
+    parser.add_argument("--image-interval", type=float, default=30, help="Seconds between frame uploads (0 disables)")
+    parser.add_argument("--images-dir", default=TEST_IMAGES_DIR)
+    parser.add_argument("--unique-frames", action="store_true",
+                        help="Perturb every frame so the server's result cache cannot serve it")
+    parser.add_argument("--device-prefix", default="sim")
+    parser.add_argument("--max-connections", type=int, default=200)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--metrics-interval", type=float, default=2, help="Seconds between /api/metrics samples")
+    parser.add_argument("--json", dest="json_path", default=None, help="Also write the report to this file")
+    args = parser.parse_args()
+
+    print(f"Simulating {args.devices} devices against {args.base_url} for {args.duration:g}s")
+    report = asyncio.run(run_fleet(args))
+
+    print(f"\n{'endpoint':<16}{'requests':>9}{'ok':>8}{'429':>6}{'errors':>8}{'ok_rps':>9}{'p50_ms':>9}{'p95_ms':>9}{'p99_ms':>9}")
+    for name, r in report["endpoints"].items():
+        print(f"{name:<16}{r['requests']:>9}{r['ok']:>8}{r['rejected']:>6}{sum(r['errors'].values()):>8}"
+              f"{r['throughput_rps']:>9}{r.get('p50_ms', '-'):>9}{r.get('p95_ms', '-'):>9}{r.get('p99_ms', '-'):>9}")
+    uploads = report["endpoints"].get("upload-image")
+    if uploads:
+        print(f"\nFrame ingestion: {uploads['throughput_rps']} frames/s, {uploads['mbytes_per_s']} MB/s")
+    if report["commands_received"]:
+        print(f"Commands received: {report['commands_received']}")
+    for key, values in report["server_backlog"].items():
+        if key != "samples":
+            print(f"Server {key}: mean {values['mean']}, max {values['max']}, last {values['last']}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
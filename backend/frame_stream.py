@@ -0,0 +1,258 @@
+"""
+Continuous frame-stream ingestion for ESP32-CAM devices
+Splits an MJPEG / chunked JPEG stream into frames, drops near-duplicates with
+a perceptual hash, skips frames adaptively while inference is backlogged and
+keeps rolling per-device weed counts. Device ids come from an unauthenticated
+header, so idle streams are evicted and the number of streams is capped
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from admission import AdmissionRejected, inference_admission
+from memory_budget import estimate_image_bytes, image_memory_budget
+from ml_utils import model_registry, run_weed_detection
+from uploads import image_dimensions
+from weed_stats import weed_stats
+
+logger = logging.getLogger("SmartAgriNode.stream")
+
+JPEG_SOI = b"\xff\xd8\xff"
+JPEG_EOI = b"\xff\xd9"
+
+STREAM_MAX_FRAME_BYTES = int(os.getenv("STREAM_MAX_FRAME_BYTES", str(4 * 1024 * 1024)))
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "4"))
+# Hamming distance (out of 64 bits) at or below which a frame is a near-duplicate
+STREAM_DUPLICATE_DISTANCE = int(os.getenv("STREAM_DUPLICATE_DISTANCE", "4"))
+STREAM_WINDOW_SECONDS = float(os.getenv("STREAM_WINDOW_SECONDS", "60"))
+# Streams kept per process; idle ones (no connection or queued work) are evicted after STREAM_IDLE_SECONDS
+STREAM_MAX_DEVICES = int(os.getenv("STREAM_MAX_DEVICES", "64"))
+STREAM_IDLE_SECONDS = float(os.getenv("STREAM_IDLE_SECONDS", "600"))
+
+
+class StreamCapacityError(Exception):
+    """STREAM_MAX_DEVICES streams are active and none is idle enough to evict"""
+
+
+class MJPEGFrameSplitter:
+    """
+    Incremental JPEG frame extractor
+
+    Works on multipart/x-mixed-replace MJPEG as well as raw concatenated
+    JPEGs: anything between an EOI and the next SOI (part boundaries and
+    headers) is discarded.
+    """
+
+    def __init__(self, max_frame_bytes: int = STREAM_MAX_FRAME_BYTES):
+        self.max_frame_bytes = max_frame_bytes
+        self._buffer = bytearray()
+        self.oversized = 0
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        self._buffer.extend(chunk)
+        frames = []
+        while True:
+            start = self._buffer.find(JPEG_SOI)
+            if start < 0:
+                # Keep a possible partial marker at the tail
+                del self._buffer[:max(0, len(self._buffer) - 2)]
+                break
+            if start:
+                del self._buffer[:start]
+            end = self._buffer.find(JPEG_EOI, len(JPEG_SOI))
+            if end < 0:
+                if len(self._buffer) > self.max_frame_bytes:
+                    # Runaway frame: drop it and resync on the next SOI
+                    self.oversized += 1
+                    del self._buffer[:len(JPEG_SOI)]
+                    continue
+                break
+            frames.append(bytes(self._buffer[:end + len(JPEG_EOI)]))
+            del self._buffer[:end + len(JPEG_EOI)]
+        return frames
+
+
+def dhash(jpeg_bytes: bytes) -> Optional[int]:
+    """64-bit difference hash; decodes at 1/8 scale so it costs far less than inference"""
+    img = cv2.imdecode(np.frombuffer(jpeg_bytes, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None:
+        return None
+    small = cv2.resize(img, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class DeviceStream:
+    """Per-device stream state: inference queue, frame skipping and rolling stats"""
+
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self.queue: "asyncio.Queue[bytes]" = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+        self.worker: Optional[asyncio.Task] = None
+        self.last_hash: Optional[int] = None
+        self.frames_since_accept = 0
+        self.received = 0
+        self.processed = 0
+        self.skipped_backlog = 0
+        self.skipped_duplicate = 0
+        self.failed = 0
+        self.window: Deque[Tuple[float, int]] = deque()
+        self.latest: Optional[Dict[str, Any]] = None
+        self.connections = 0
+        self.last_active = time.monotonic()
+
+    def idle(self, now: float) -> bool:
+        """No open connection, no running worker and nothing received for STREAM_IDLE_SECONDS"""
+        return (
+            self.connections == 0
+            and (self.worker is None or self.worker.done())
+            and now - self.last_active > STREAM_IDLE_SECONDS
+        )
+
+    async def offer(self, frame: bytes) -> str:
+        """
+        Decide whether a frame reaches the inference engine
+
+        Returns:
+            "queued", "skipped_backlog", "skipped_duplicate" or "invalid"
+        """
+        self.last_active = time.monotonic()
+        self.received += 1
+        self.frames_since_accept += 1
+
+        # Adaptive skipping: with k frames waiting, only every (k+1)-th frame is considered
+        stride = 1 + self.queue.qsize()
+        if self.frames_since_accept < stride or self.queue.full():
+            self.skipped_backlog += 1
+            return "skipped_backlog"
+
+        # Decoding stays off the event loop, which serves every other connection meanwhile
+        frame_hash = await asyncio.to_thread(dhash, frame)
+        if frame_hash is None:
+            self.failed += 1
+            return "invalid"
+        if self.last_hash is not None and hamming(frame_hash, self.last_hash) <= STREAM_DUPLICATE_DISTANCE:
+            self.skipped_duplicate += 1
+            return "skipped_duplicate"
+
+        if self.queue.full():
+            # Another connection for this device filled the queue while hashing
+            self.skipped_backlog += 1
+            return "skipped_backlog"
+
+        self.last_hash = frame_hash
+        self.frames_since_accept = 0
+        self.queue.put_nowait(frame)
+        self.ensure_worker()
+        return "queued"
+
+    def ensure_worker(self) -> None:
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                frame = await asyncio.wait_for(self.queue.get(), timeout=STREAM_WINDOW_SECONDS)
+            except asyncio.TimeoutError:
+                return
+            try:
+                with model_registry.acquire("weed") as handle:
+                    if handle is None:
+                        raise RuntimeError("Weed detection model not available")
+                    # Same memory budget as single uploads; the frame is dropped if it cannot fit in time
+                    dimensions = image_dimensions(frame) or (0, 0)
+                    async with image_memory_budget.reserve(estimate_image_bytes(len(frame), *dimensions)):
+                        detection = await inference_admission.run("device", self.device_id, run_weed_detection, handle.model, frame)
+                self.record(detection["detections"], detection["annotated_jpeg"])
+                weed_stats.record(detection["detections"], detection["classes"], detection["confidences"], device_id=self.device_id)
+            except AdmissionRejected:
+                # Overloaded (admission queue or memory budget): drop the frame, the stream will deliver fresher ones
+                self.skipped_backlog += 1
+            except Exception as e:
+                self.failed += 1
+                logger.warning(f"Stream frame from {self.device_id} failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def shutdown(self) -> None:
+        """Cancel the inference worker and wait for it to exit; queued frames are dropped"""
+        worker, self.worker = self.worker, None
+        if worker is not None and not worker.done():
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+
+    def record(self, weed_count: int, annotated_jpeg: bytes) -> None:
+        now = time.time()
+        self.processed += 1
+        self.window.append((now, weed_count))
+        self.latest = {"timestamp": now, "weed_count": weed_count, "annotated_jpeg": annotated_jpeg}
+        self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        while self.window and now - self.window[0][0] > STREAM_WINDOW_SECONDS:
+            self.window.popleft()
+
+    def stats(self) -> Dict[str, Any]:
+        self._trim(time.time())
+        counts = [count for _, count in self.window]
+        return {
+            "device_id": self.device_id,
+            "frames_received": self.received,
+            "frames_processed": self.processed,
+            "frames_skipped_backlog": self.skipped_backlog,
+            "frames_skipped_duplicate": self.skipped_duplicate,
+            "frames_failed": self.failed,
+            "backlog": self.queue.qsize(),
+            "window_seconds": STREAM_WINDOW_SECONDS,
+            "window_frames": len(counts),
+            "window_weed_count": sum(counts),
+            "window_mean_weeds_per_frame": round(sum(counts) / len(counts), 3) if counts else 0.0,
+            "latest_weed_count": self.latest["weed_count"] if self.latest else None
+        }
+
+
+# Map: device_id -> DeviceStream
+DEVICE_STREAMS: Dict[str, DeviceStream] = {}
+
+
+def evict_idle_streams() -> int:
+    """Drop idle streams; returns how many were removed"""
+    now = time.monotonic()
+    idle = [device_id for device_id, stream in DEVICE_STREAMS.items() if stream.idle(now)]
+    for device_id in idle:
+        del DEVICE_STREAMS[device_id]
+    return len(idle)
+
+
+def get_device_stream(device_id: str) -> DeviceStream:
+    """
+    Stream state for a device, created on first use
+
+    Raises:
+        StreamCapacityError: the device is new and STREAM_MAX_DEVICES busy streams exist
+    """
+    stream = DEVICE_STREAMS.get(device_id)
+    if stream is None:
+        evict_idle_streams()
+        if len(DEVICE_STREAMS) >= STREAM_MAX_DEVICES:
+            raise StreamCapacityError(f"{STREAM_MAX_DEVICES} device streams are already active")
+        stream = DeviceStream(device_id)
+        DEVICE_STREAMS[device_id] = stream
+    return stream
+
+
+async def shutdown_streams() -> None:
+    """Stop every device stream's inference worker (lifespan shutdown)"""
+    await asyncio.gather(*(stream.shutdown() for stream in list(DEVICE_STREAMS.values())))
@@ -0,0 +1,98 @@
+"""
+Gunicorn configuration for production
+Preloads the app and models in the master so workers share weights
+copy-on-write, and splits CPU threads between workers. Defaults to a single
+worker because device state is per-process (see `workers` below)
+
+Run from backend/:
+    gunicorn -c gunicorn_conf.py main:app
+
+Rolling restarts:
+    kill -HUP <master pid>     # start fresh workers, then gracefully stop old ones
+    max_requests (+ jitter)    # workers are recycled one at a time, never all at once
+"""
+
+import gc
+import itertools
+import multiprocessing
+import os
+import subprocess
+import sys
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', '5000')}")
+# One worker by default: device commands, latest readings, scan results, live
+# streams and chunked upload sessions live in per-process memory, so with
+# several workers an ESP32 polling one worker never sees a command queued on
+# another. Only raise WEB_CONCURRENCY behind a load balancer that pins each
+# device and dashboard session to a single worker.
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Import main:app (and load models) once in the master before forking
+preload_app = True
+
+# Graceful shutdown/restart windows
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+keepalive = 5
+
+# Staggered recycling bounds slow memory growth without a full restart
+max_requests = int(os.getenv("MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "200"))
+
+# Intra-op threads per worker, so workers x threads does not oversubscribe the CPU.
+# Exported before main is imported; lifespan applies it to torch and ml_utils to
+# the weed model's ONNX Runtime session.
+cpus_per_worker = max(1, cpu_count // workers)
+threads_per_worker = int(os.getenv("TORCH_NUM_THREADS") or cpus_per_worker)
+for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(var, str(threads_per_worker))
+
+# AUTOTUNE=auto: the master tunes once for one worker's share of the CPUs (on_starting);
+# workers only apply the saved result, so they neither benchmark against each other
+# nor race to write autotune.json
+autotune_in_master = os.getenv("AUTOTUNE", "off").lower() == "auto"
+os.environ.setdefault("AUTOTUNE_CPUS", str(cpus_per_worker))
+if autotune_in_master:
+    os.environ["AUTOTUNE"] = "saved"
+else:
+    os.environ["TORCH_NUM_THREADS"] = str(threads_per_worker)
+    os.environ.setdefault("ORT_NUM_THREADS", str(threads_per_worker))
+
+
+def on_starting(server):
+    """Tune thread counts if needed and load models in the master; workers inherit them after fork"""
+    if autotune_in_master:
+        # A separate process, so no ONNX Runtime session is created in the master
+        backend_dir = os.path.dirname(os.path.abspath(__file__))
+        result = subprocess.run([sys.executable, os.path.join(backend_dir, "autotune.py"), "--if-stale"], cwd=backend_dir)
+        if result.returncode != 0:
+            server.log.warning("Autotuning failed; workers keep the configured thread settings")
+
+    # Imported here so the thread environment above is in place first
+    from ml_utils import get_crop_model, get_weed_model
+
+    get_crop_model()
+    # ONNX Runtime sessions are created lazily on first predict, i.e. in each
+    # worker's warm-up, since they are not safe to share across fork
+    get_weed_model()
+    server.log.info(
+        f"Preloaded models; {workers} workers x {threads_per_worker} threads on {cpu_count} CPUs"
+    )
+
+
+def pre_fork(server, worker):
+    # Move preloaded objects out of the collector's reach so GC passes in the
+    # workers don't touch (and copy) their pages
+    gc.freeze()
+    # Lowest slot no live worker holds, so a recycled worker's replacement takes
+    # over its telemetry and weed statistics files (see worker_slot.py)
+    taken = {getattr(other, "slot", None) for other in server.WORKERS.values()}
+    worker.slot = next(slot for slot in itertools.count() if slot not in taken)
+
+
+def post_fork(server, worker):
+    os.environ["WORKER_SLOT"] = str(worker.slot)
+
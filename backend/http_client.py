@@ -0,0 +1,72 @@
+"""
+Shared HTTP connection pools
+One keep-alive pool for async REST calls (token verification) and one for
+the synchronous Supabase client (PostgREST, Storage, Auth admin), so
+requests reuse TLS connections instead of opening a new one per call.
+HTTP/2 is used when the h2 package is installed.
+"""
+
+import importlib.util
+import logging
+import os
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger("SmartAgriNode.http")
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+HTTP_POOL_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", "50")),
+    max_keepalive_connections=int(os.getenv("HTTP_POOL_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.getenv("HTTP_POOL_KEEPALIVE_EXPIRY", "30"))
+)
+HTTP_TIMEOUT = httpx.Timeout(float(os.getenv("HTTP_TIMEOUT", "10")), connect=5.0)
+# Storage uploads carry full images; give them the Supabase client's default budget
+STORAGE_TIMEOUT = httpx.Timeout(20.0, connect=5.0)
+
+_async_client: Optional[httpx.AsyncClient] = None
+_sync_client: Optional[httpx.Client] = None
+
+
+async def start_http_client() -> httpx.AsyncClient:
+    """Create the shared async client (called from the app lifespan)"""
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+        logger.info(f"HTTP client pool ready (http2={HTTP2_AVAILABLE}, max_connections={HTTP_POOL_LIMITS.max_connections})")
+    return _async_client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Shared async client
+
+    Falls back to creating it on first use when the lifespan has not run
+    (scripts, tests).
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(http2=HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=HTTP_TIMEOUT)
+    return _async_client
+
+
+def get_sync_client() -> httpx.Client:
+    """Pooled client handed to the synchronous Supabase client"""
+    global _sync_client
+    if _sync_client is None or _sync_client.is_closed:
+        _sync_client = httpx.Client(http2=HTTP2_AVAILABLE, limits=HTTP_POOL_LIMITS, timeout=STORAGE_TIMEOUT)
+    return _sync_client
+
+
+async def close_http_client() -> None:
+    """
+    Close the async pool on shutdown
+
+    The sync pool lives as long as the module-level Supabase client that holds it.
+    """
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
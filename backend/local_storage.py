@@ -0,0 +1,421 @@
+"""
+Local storage backend for edge installs
+SQLite in WAL mode for history and user metadata, the filesystem for images.
+Writes are queued to a single writer thread that commits them in batches;
+reads run on per-thread connections concurrently with the writer.
+Selected with STORAGE_BACKEND=local.
+"""
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import uuid
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import jwt
+
+from database import StorageBackend, SupabaseBackend, content_key, object_index
+
+logger = logging.getLogger("SmartAgriNode.local_storage")
+
+INSTANCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance')
+# Its own file: instance/users.db is the tracked legacy database, not runtime state
+LOCAL_DB_PATH = os.getenv("LOCAL_DB_PATH") or os.path.join(INSTANCE_DIR, 'local_storage.db')
+LOCAL_IMAGE_DIR = os.getenv("LOCAL_IMAGE_DIR") or os.path.join(INSTANCE_DIR, 'images')
+# Images are served by the app under /media (see main.py)
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "http://localhost:5000").rstrip("/")
+# HS256 secret from the Supabase project settings; enables offline token checks
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+WRITER_BATCH_SIZE = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    username TEXT,
+    avatar_url TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS crop_recommendations (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    input_data TEXT NOT NULL,
+    recommended_crop TEXT NOT NULL,
+    confidence REAL NOT NULL,
+    model_version TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_crop_recs_user_time ON crop_recommendations(user_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS weed_detections (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    image_filename TEXT NOT NULL,
+    input_image_url TEXT,
+    output_image_url TEXT,
+    weed_count INTEGER NOT NULL,
+    model_version TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_weed_dets_user_time ON weed_detections(user_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS field_scans (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    data TEXT NOT NULL DEFAULT '{}',
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_field_scans_user_status_time ON field_scans(user_id, status, created_at DESC);
+"""
+
+FIELD_SCAN_COLUMNS = ("user_id", "status")
+
+
+def utc_now() -> str:
+    # Fixed-width ISO timestamps sort correctly as text
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f+00:00")
+
+
+def connect(path: str, autocommit: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None if autocommit else "")
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    # WAL + NORMAL: durable across application crashes, fsync only at checkpoints
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+class SQLiteWriter:
+    """
+    Single writer thread: statements from all requests are committed together,
+    one transaction per batch, so concurrent writers never contend for the lock
+    """
+
+    def __init__(self, path: str, batch_size: int = WRITER_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[Optional[Tuple[str, tuple, Future]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, sql: str, params: tuple = ()) -> Future:
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+                self._thread.start()
+        future: Future = Future()
+        self._queue.put((sql, params, future))
+        return future
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Queue a write and wait for its batch to commit; returns the affected row count"""
+        return await asyncio.wrap_future(self.submit(sql, params))
+
+    def _run(self) -> None:
+        # Autocommit mode: transactions are opened and closed explicitly per batch
+        conn = connect(self.path, autocommit=True)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._commit(conn, batch)
+        conn.close()
+
+    def _commit(self, conn: sqlite3.Connection, batch: List[Tuple[str, tuple, Future]]) -> None:
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for sql, params, future in batch:
+                # One failing statement must not roll back its neighbours
+                conn.execute("SAVEPOINT stmt")
+                try:
+                    results.append((future, conn.execute(sql, params).rowcount, None))
+                    conn.execute("RELEASE stmt")
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO stmt")
+                    conn.execute("RELEASE stmt")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for future, rowcount, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(rowcount)
+
+    def close(self) -> None:
+        """Commit everything queued so far, then stop the thread"""
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                return
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+
+
+class LocalStorageBackend(StorageBackend):
+    """SQLite + filesystem implementation of the storage backend"""
+
+    def __init__(self, db_path: str = LOCAL_DB_PATH, image_dir: str = LOCAL_IMAGE_DIR):
+        self.db_path = db_path
+        self.image_dir = image_dir
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        os.makedirs(image_dir, exist_ok=True)
+        conn = connect(db_path, autocommit=True)
+        conn.executescript(SCHEMA)
+        conn.close()
+        self._local = threading.local()
+        self.writer = SQLiteWriter(db_path)
+        logger.info(f"Local storage backend: {db_path}, images in {image_dir}")
+
+    # -- helpers ----------------------------------------------------------
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    def _fetch(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        return [dict(row) for row in self._reader().execute(sql, params).fetchall()]
+
+    async def fetch(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        return await asyncio.to_thread(self._fetch, sql, params)
+
+    def _image_path(self, bucket: str, filename: str) -> str:
+        path = os.path.abspath(os.path.join(self.image_dir, bucket, filename))
+        if not path.startswith(os.path.abspath(self.image_dir) + os.sep):
+            raise ValueError("Invalid image path")
+        return path
+
+    def public_url(self, bucket: str, filename: str) -> str:
+        return f"{PUBLIC_BASE_URL}/media/{bucket}/{filename}"
+
+    def _write_file(self, path: str, content: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _decode_scan(row: Dict[str, Any]) -> Dict[str, Any]:
+        data = json.loads(row.pop("data") or "{}")
+        return {**data, **row}
+
+    # -- auth -------------------------------------------------------------
+
+    async def verify_jwt(self, token: str) -> Optional[Dict[str, Any]]:
+        """
+        Verify a Supabase access token locally when SUPABASE_JWT_SECRET is set,
+        otherwise fall back to the Supabase auth API
+        """
+        if not SUPABASE_JWT_SECRET:
+            return await SupabaseBackend.verify_jwt(token)
+        if not token:
+            return None
+        try:
+            payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=["HS256"], audience="authenticated")
+        except jwt.PyJWTError as e:
+            logger.warning(f"Local token verification failed: {e}")
+            return None
+        if not payload.get("sub"):
+            return None
+        return {
+            "id": payload["sub"],
+            "email": payload.get("email"),
+            "user_metadata": payload.get("user_metadata", {}),
+            "app_metadata": payload.get("app_metadata", {})
+        }
+
+    # -- history ----------------------------------------------------------
+
+    async def store_user_metadata(self, user_id: str, email: str, username: Optional[str] = None) -> Dict[str, Any]:
+        now = utc_now()
+        username = username or email.split('@')[0]
+        try:
+            await self.writer.execute(
+                "INSERT INTO users (user_id, email, username, created_at, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET email = excluded.email, username = excluded.username, "
+                "updated_at = excluded.updated_at",
+                (user_id, email, username, now, now)
+            )
+        except Exception:
+            logger.exception("Error storing user metadata")
+        return {"user_id": user_id, "email": email, "username": username}
+
+    async def store_crop_recommendation(self, user_id: str, input_data: Dict[str, float], recommendation: str,
+                                        confidence: float, model_version: Optional[str] = None) -> Dict[str, Any]:
+        record = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "input_data": input_data,
+            "recommended_crop": recommendation,
+            "confidence": confidence,
+            "model_version": model_version,
+            "created_at": utc_now()
+        }
+        try:
+            await self.writer.execute(
+                "INSERT INTO crop_recommendations (id, user_id, input_data, recommended_crop, confidence, "
+                "model_version, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (record["id"], user_id, json.dumps(input_data), recommendation, confidence, model_version,
+                 record["created_at"])
+            )
+            return record
+        except Exception:
+            logger.exception("Error storing crop recommendation")
+            return {}
+
+    async def store_weed_detection(self, user_id: str, filename: str, detections: int,
+                                   input_image_url: Optional[str] = None, output_image_url: Optional[str] = None,
+                                   model_version: Optional[str] = None) -> Dict[str, Any]:
+        record = {
+            "id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "image_filename": filename,
+            "weed_count": int(detections),
+            "input_image_url": input_image_url,
+            "output_image_url": output_image_url,
+            "model_version": model_version,
+            "created_at": utc_now()
+        }
+        try:
+            await self.writer.execute(
+                "INSERT INTO weed_detections (id, user_id, image_filename, input_image_url, output_image_url, "
+                "weed_count, model_version, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (record["id"], user_id, filename, input_image_url, output_image_url, record["weed_count"],
+                 model_version, record["created_at"])
+            )
+            return record
+        except Exception:
+            logger.exception("Error storing weed detection")
+            return {}
+
+    async def get_user_history(self, user_id: str, limit: int = 10) -> Dict[str, Any]:
+        try:
+            # Both queries are served by the (user_id, created_at DESC) indexes
+            crop_recs = await self.fetch(
+                "SELECT * FROM crop_recommendations WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                (user_id, limit)
+            )
+            for rec in crop_recs:
+                rec["input_data"] = json.loads(rec["input_data"])
+            weed_dets = await self.fetch(
+                "SELECT * FROM weed_detections WHERE user_id = ? ORDER BY created_at DESC LIMIT ?",
+                (user_id, limit)
+            )
+            return {"crop_recommendations": crop_recs, "weed_detections": weed_dets}
+        except Exception:
+            logger.exception("Error fetching user history")
+            return {"crop_recommendations": [], "weed_detections": []}
+
+    # -- images -----------------------------------------------------------
+
+    async def upload_weed_image(self, user_id: str, file_content: bytes, file_ext: str, bucket_name: str,
+                                content_hash: Optional[str] = None) -> str:
+        filename = content_key(user_id, file_content, file_ext, content_hash)
+        path = self._image_path(bucket_name, filename)
+        exists = object_index.contains(bucket_name, filename) or os.path.exists(path)
+        if not exists:
+            await asyncio.to_thread(self._write_file, path, file_content)
+        object_index.add(bucket_name, filename)
+        object_index.record(uploaded=not exists, size=len(file_content))
+        return self.public_url(bucket_name, filename)
+
+    async def upload_avatar(self, user_id: str, file_content: bytes, file_ext: str) -> str:
+        await self.delete_avatar_file(user_id)
+        filename = f"{user_id}.{file_ext}"
+        await asyncio.to_thread(self._write_file, self._image_path("avatars", filename), file_content)
+        public_url = self.public_url("avatars", filename)
+        await self.writer.execute(
+            "UPDATE users SET avatar_url = ?, updated_at = ? WHERE user_id = ?",
+            (public_url, utc_now(), user_id)
+        )
+        return public_url
+
+    async def clear_avatar_reference(self, user_id: str) -> bool:
+        await self.writer.execute(
+            "UPDATE users SET avatar_url = NULL, updated_at = ? WHERE user_id = ?",
+            (utc_now(), user_id)
+        )
+        return True
+
+    async def delete_avatar_file(self, user_id: str) -> bool:
+        pattern = os.path.join(glob.escape(os.path.join(self.image_dir, "avatars")), glob.escape(user_id) + ".*")
+        for path in glob.glob(pattern):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    # -- field scans ------------------------------------------------------
+
+    async def create_field_scan(self, user_id: str) -> Dict[str, Any]:
+        now = utc_now()
+        scan = {"id": str(uuid.uuid4()), "user_id": user_id, "status": "pending", "created_at": now, "updated_at": now}
+        try:
+            await self.writer.execute(
+                "INSERT INTO field_scans (id, user_id, status, data, created_at, updated_at) VALUES (?, ?, ?, '{}', ?, ?)",
+                (scan["id"], user_id, "pending", now, now)
+            )
+            return scan
+        except Exception:
+            logger.exception("Error creating field scan")
+            return {}
+
+    async def update_field_scan(self, scan_id: str, updates: Dict[str, Any]) -> Dict[str, Any]:
+        """Known columns are updated in place; any other keys are merged into the scan's JSON data"""
+        columns = {k: v for k, v in updates.items() if k in FIELD_SCAN_COLUMNS}
+        extra = {k: v for k, v in updates.items() if k not in FIELD_SCAN_COLUMNS and k != "id"}
+        assignments = [f"{column} = ?" for column in columns] + ["data = json_patch(data, ?)", "updated_at = ?"]
+        params = tuple(columns.values()) + (json.dumps(extra), utc_now(), scan_id)
+        try:
+            await self.writer.execute(f"UPDATE field_scans SET {', '.join(assignments)} WHERE id = ?", params)
+            rows = await self.fetch("SELECT * FROM field_scans WHERE id = ?", (scan_id,))
+            return self._decode_scan(rows[0]) if rows else {}
+        except Exception:
+            logger.exception("Error updating field scan")
+            return {}
+
+    async def get_latest_pending_scan(self, user_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            rows = await self.fetch(
+                "SELECT * FROM field_scans WHERE user_id = ? AND status = 'pending' ORDER BY created_at DESC LIMIT 1",
+                (user_id,)
+            )
+            return self._decode_scan(rows[0]) if rows else None
+        except Exception:
+            logger.exception("Error fetching pending scan")
+            return None
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self.writer.close)
@@ -3,27 +3,42 @@ SmartAgriNode FastAPI Backend
 AI-powered agriculture dashboard with crop recommendation and weed detection
 """
 
+import asyncio
 import base64
 import logging
 import os
-import tempfile
-from contextlib import asynccontextmanager
-from typing import Optional
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import List, Optional
 import torch
 
 import cv2
 import joblib
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, File, Header, HTTPException, UploadFile, BackgroundTasks
+from fastapi import Depends, FastAPI, File, Header, HTTPException, Query, UploadFile, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from ultralytics import YOLO
 
-from database import SupabaseDB
-from ml_utils import get_crop_model, get_weed_model
-from routers import device
+from admission import AdmissionRejected, inference_admission
+from autotune import tuned_config
+from database import STORAGE_BACKEND, SupabaseDB, object_index
+from frame_stream import shutdown_streams
+from http_client import close_http_client, start_http_client
+from memory_budget import estimate_image_bytes, image_memory_budget, memory_profiler
+from metrics import latency_tracker
+from ml_utils import crop_prediction_cache, get_crop_model, get_weed_model, model_registry, model_status, recommend_crops, run_weed_detection, set_weed_threads, warm_up_models
+from result_cache import WeedResultCache, weed_result_cache
+from routers import device, models
+from scan_jobs import scan_orchestrator
+from telemetry_store import telemetry_store
+from tiling import DEFAULT_TILE_OVERLAP, DEFAULT_TILE_SIZE, MAX_TILES, tile_count
+from uploads import MULTIPART_OVERHEAD, BodySizeLimitMiddleware, read_upload
+from weed_stats import WEED_STATS_DAYS, weed_stats
 from auth import verify_supabase_token
+from compression import SelectiveGZipMiddleware
+from crop_neighbors import MAX_NEIGHBORS, crop_neighbor_index
+from serialization import FastJSONResponse
 
 logger = logging.getLogger("SmartAgriNode.backend")
 
@@ -72,26 +87,79 @@ model_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'Models')
 upload_dir = os.path.join(os.path.dirname(__file__), 'uploads')
 os.makedirs(upload_dir, exist_ok=True)
 
+# Upload limits for the multipart image endpoints
+WEED_UPLOAD_MAX_BYTES = 16 * 1024 * 1024
+AVATAR_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+
 crop_model_path = os.path.join(model_dir, 'crop_recommendation_model.pkl')
 weed_model_path = os.path.join(model_dir, 'weed_detection_model.onnx')
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Shared keep-alive pool for Supabase REST calls
+    await start_http_client()
+
     # Load models on startup
     logger.info("Loading models...")
     
-    # Optimize PyTorch for CPU execution (crucial for Render free tier)
+    # Optimize PyTorch for CPU execution (crucial for Render free tier).
+    # TORCH_NUM_THREADS is set per worker by gunicorn_conf.py in production.
     try:
-        torch.set_num_threads(1)
+        torch.set_num_threads(int(os.getenv("TORCH_NUM_THREADS", "1")))
         torch.set_num_interop_threads(1)
     except Exception as e:
         logger.warning(f"Could not set torch threads: {e}")
         
     get_crop_model()
     get_weed_model()
+
+    # Warm up before serving so readiness only flips once both models have run once
+    await asyncio.to_thread(warm_up_models)
+
+    # AUTOTUNE=auto: apply the saved (or freshly benchmarked) thread configuration
+    try:
+        tuned = await asyncio.to_thread(tuned_config, model_registry.get("weed"), model_registry.get("crop"))
+    except Exception:
+        logger.exception("Autotuning failed; keeping configured thread settings")
+        tuned = None
+    if tuned:
+        if not os.getenv("ORT_NUM_THREADS") and not os.getenv("TORCH_NUM_THREADS"):
+            torch.set_num_threads(tuned["intra_op_threads"])
+            # The weed model runs on ONNX Runtime, which has its own thread pool
+            await asyncio.to_thread(set_weed_threads, tuned["intra_op_threads"])
+        logger.info(f"Inference: {torch.get_num_threads()} threads x {inference_admission.workers} workers")
+
+    # Optionally watch Models/ for new versions and hot-reload them
+    model_registry.start_watcher(float(os.getenv("MODEL_WATCH_INTERVAL", "0")))
+
+    # Restore sensor history and persist it periodically
+    devices = await asyncio.to_thread(telemetry_store.load)
+    logger.info(f"Loaded telemetry for {devices} devices")
+    telemetry_store.start_persistence()
+    scopes = await asyncio.to_thread(weed_stats.load)
+    logger.info(f"Loaded weed statistics for {scopes} scopes")
+    weed_stats.start_persistence()
+
+    # Similar-field index over data/Crop_ds.csv (memory-mapped; rebuilt if the CSV changed)
+    try:
+        samples = await asyncio.to_thread(crop_neighbor_index.load)
+        logger.info(f"Crop neighbour index ready with {samples} samples")
+    except Exception:
+        logger.exception("Failed to load crop neighbour index")
+
+    # Resume scan frames queued before the last shutdown
+    await scan_orchestrator.start()
     yield
     # Clean up resources if needed
     logger.info("Shutting down...")
+    await model_registry.stop_watcher()
+    await scan_orchestrator.stop()
+    await shutdown_streams()
+    await telemetry_store.stop_persistence()
+    await weed_stats.stop_persistence()
+    await close_http_client()
+    await SupabaseDB.close()
+    inference_admission.shutdown()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -106,6 +174,20 @@ app = FastAPI(
 
 # Include routers
 app.include_router(device.router)
+app.include_router(models.router)
+
+if STORAGE_BACKEND == "local":
+    # Serve locally stored images at the URLs the local backend hands out
+    from fastapi.staticfiles import StaticFiles
+    from local_storage import LOCAL_IMAGE_DIR
+    app.mount("/media", StaticFiles(directory=LOCAL_IMAGE_DIR), name="media")
+
+# Reject oversized multipart uploads before Starlette spools the whole body
+# (added first so CORS headers still wrap the 413)
+app.add_middleware(BodySizeLimitMiddleware, limits={
+    "/api/weed-detection": WEED_UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD,
+    "/api/upload-avatar": AVATAR_UPLOAD_MAX_BYTES + MULTIPART_OVERHEAD
+})
 
 # CORS configuration
 app.add_middleware(
@@ -116,6 +198,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Gzip JSON/text responses; images and streams pass through untouched
+app.add_middleware(SelectiveGZipMiddleware)
+
 # Pydantic models for request validation
 class CropRecommendationInput(BaseModel):
     """Input model for crop recommendation"""
@@ -140,10 +225,38 @@ class CropRecommendationInput(BaseModel):
             }
         }
 
+class CropRecommendationBatchInput(BaseModel):
+    """Input model for batched crop recommendation"""
+    items: List[CropRecommendationInput] = Field(..., min_length=1, max_length=256)
+
+class CropProbability(BaseModel):
+    """One ranked crop with its class probability"""
+    crop: str
+    probability: float
+
 class CropRecommendationResponse(BaseModel):
     """Response model for crop recommendation"""
     recommended_crop: str
-    confidence: float
+    confidence: float = Field(..., description="Model probability of the recommended crop")
+    top_k: List[CropProbability] = Field(default_factory=list, description="Highest-probability crops, best first")
+    model_version: Optional[str] = None
+
+class CropRecommendationBatchResponse(BaseModel):
+    """Response model for batched crop recommendation"""
+    results: List[CropRecommendationResponse]
+    model_version: Optional[str] = None
+
+class CropNeighbor(BaseModel):
+    """One historical dataset sample near the queried conditions"""
+    crop: str
+    distance: float = Field(..., description="Euclidean distance over normalized features (standard deviations)")
+    sample: int = Field(..., description="Row index in data/Crop_ds.csv")
+    features: dict
+
+class CropNeighborsResponse(BaseModel):
+    """Response model for similar-field lookups, one neighbour list per input"""
+    results: List[List[CropNeighbor]]
+    k: int
 
 class WeedDetectionResponse(BaseModel):
     """Response model for weed detection"""
@@ -152,6 +265,7 @@ class WeedDetectionResponse(BaseModel):
     message: str
     input_image_url: Optional[str] = None
     output_image_url: Optional[str] = None
+    model_version: Optional[str] = None
 
 class HealthResponse(BaseModel):
     """Response model for health check"""
@@ -159,6 +273,8 @@ class HealthResponse(BaseModel):
     crop_model_loaded: bool
     weed_model_loaded: bool
     models_loaded: bool
+    models_warm: bool = False
+    inference_latency: dict = Field(default_factory=dict, description="Rolling latency percentiles per operation (ms)")
 
 class ErrorResponse(BaseModel):
     """Error response model"""
@@ -174,6 +290,10 @@ class AvatarResponse(BaseModel):
     avatar_url: str
     message: str
 
+def crop_features(data: CropRecommendationInput) -> list:
+    """Feature row in the order the crop model was trained on"""
+    return [data.N, data.P, data.K, data.temperature, data.humidity, data.ph, data.rainfall]
+
 # API Routes
 
 @app.get("/")
@@ -190,15 +310,58 @@ async def root():
 async def health_check():
     """
     Health check endpoint
-    Returns status of the API and ML models
+    Returns status of the API and ML models, based on what is actually loaded and warmed up
     """
+    state = model_status()
+    models_loaded = state["crop_model_loaded"] and state["weed_model_loaded"]
+    models_warm = state["crop_model_warm"] and state["weed_model_warm"]
     return HealthResponse(
-        status="healthy",
-        crop_model_loaded=os.path.exists(crop_model_path),
-        weed_model_loaded=os.path.exists(weed_model_path),
-        models_loaded=os.path.exists(crop_model_path) and os.path.exists(weed_model_path)
+        status="healthy" if models_warm else "degraded",
+        crop_model_loaded=state["crop_model_loaded"],
+        weed_model_loaded=state["weed_model_loaded"],
+        models_loaded=models_loaded,
+        models_warm=models_warm,
+        inference_latency=latency_tracker.snapshot()
     )
 
+@app.get("/api/health/live")
+async def liveness_check():
+    """
+    Liveness probe: the process is up and the event loop is responsive
+    """
+    return {"status": "alive"}
+
+@app.get("/api/health/ready")
+async def readiness_check():
+    """
+    Readiness probe: 200 only once both models are loaded and warmed up, 503 otherwise
+    so load balancers route traffic to warm instances only
+    """
+    state = model_status()
+    ready = state["crop_model_warm"] and state["weed_model_warm"]
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not_ready", **state}
+    )
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """
+    Runtime metrics: inference latency percentiles, admission queue, cache and scan queue counters, memory use per image stage
+    """
+    return {
+        "inference_latency": latency_tracker.snapshot(),
+        "admission": inference_admission.stats(),
+        "weed_result_cache": weed_result_cache.stats(),
+        "crop_prediction_cache": crop_prediction_cache.stats(),
+        "scan_jobs": await scan_orchestrator.stats(),
+        "image_memory_budget": image_memory_budget.stats(),
+        "storage_dedup": object_index.stats(),
+        "weed_stats": weed_stats.stats(),
+        "crop_neighbors": crop_neighbor_index.stats(),
+        "memory": memory_profiler.snapshot()
+    }
+
 @app.get(
     "/api/history",
     response_model=HistoryResponse,
@@ -213,21 +376,66 @@ async def get_history(user: dict = Depends(verify_supabase_token)):
     """
     try:
         history = await SupabaseDB.get_user_history(user_id=user.get("user_id"), limit=10)
-        return history
+        return FastJSONResponse(history)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch history: {str(e)}")
 
+@app.get(
+    "/api/weed-stats",
+    responses={
+        400: {"model": ErrorResponse},
+        401: {"model": ErrorResponse},
+        404: {"model": ErrorResponse}
+    }
+)
+async def get_weed_stats(
+    scope: str = Query("user", description="user, device, scan or global"),
+    scope_id: Optional[str] = Query(None, alias="id", description="Device or scan id (user scope always uses the caller)"),
+    days: int = Query(30, ge=0, le=WEED_STATS_DAYS, description="Daily rollups to include"),
+    user: dict = Depends(verify_supabase_token)
+):
+    """
+    Running weed statistics: frame and weed counts, weeds per frame, per-class
+    confidence histograms and daily rollups, read from the incremental aggregates
+    Device and scan statistics are limited to the caller's own devices and scans
+    """
+    if scope == "user":
+        scope_id = user.get("user_id")
+        if not scope_id:
+            raise HTTPException(status_code=400, detail="User statistics require a signed-in user")
+    elif scope == "global":
+        scope_id = "all"
+    elif scope not in ("device", "scan"):
+        raise HTTPException(status_code=400, detail="scope must be one of user, device, scan, global")
+    elif not scope_id:
+        raise HTTPException(status_code=400, detail=f"id is required for {scope} statistics")
+    else:
+        # Someone else's device or scan looks the same as an unknown one
+        user_id = user.get("user_id")
+        if scope == "scan":
+            job = await asyncio.to_thread(scan_orchestrator.store.get_job, scope_id)
+            owned = job is not None and user_id is not None and job["user_id"] == user_id
+        else:
+            owned = user_id is not None and await asyncio.to_thread(
+                scan_orchestrator.store.device_scanned_by, scope_id, user_id
+            )
+        if not owned:
+            raise HTTPException(status_code=404, detail=f"No {scope} {scope_id} for this user")
+    return weed_stats.summary(scope, scope_id, days)
+
 @app.post(
     "/api/crop-recommendation",
     response_model=CropRecommendationResponse,
     responses={
         400: {"model": ErrorResponse},
         401: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
         500: {"model": ErrorResponse}
     }
 )
 async def crop_recommendation(
     data: CropRecommendationInput,
+    top_k: int = Query(3, ge=1, le=25, description="Number of ranked crops to return"),
     user: dict = Depends(verify_supabase_token)
 ):
     """
@@ -249,19 +457,16 @@ async def crop_recommendation(
             except Exception as e:
                 logger.warning(f"Failed to upsert user metadata: {e}")
 
-        # Extract features in the correct order
-        features = [
-            data.N,
-            data.P,
-            data.K,
-            data.temperature,
-            data.humidity,
-            data.ph,
-            data.rainfall
-        ]
-        
-        # Make prediction
-        prediction = model.predict([features])[0]
+        # Class probabilities and top-k from one predict_proba pass, against a pinned model version;
+        # admitted like the batch path so predict_proba runs on the inference pool, not the event loop
+        with model_registry.acquire("crop") as handle:
+            if handle is None:
+                raise RuntimeError("Crop recommendation model not available")
+            model_version = handle.version
+            results = await inference_admission.run(
+                "interactive", user.get("user_id"), recommend_crops, handle, [crop_features(data)], top_k=top_k
+            )
+            result = results[0]
         
         # Store in history (optional, non-blocking)
         if user.get("user_id"):
@@ -269,20 +474,87 @@ async def crop_recommendation(
                 await SupabaseDB.store_crop_recommendation(
                     user_id=user.get("user_id"),
                     input_data=data.dict(),
-                    recommendation=str(prediction),
-                    confidence=0.95
+                    recommendation=result["recommended_crop"],
+                    confidence=result["confidence"],
+                    model_version=model_version
                 )
             except Exception as e:
                 logger.warning(f"Failed to store crop recommendation history: {e}")
         
-        return CropRecommendationResponse(
-            recommended_crop=str(prediction),
-            confidence=0.95  # Mock confidence score
-        )
+        return CropRecommendationResponse(**result, model_version=model_version)
     
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Prediction failed: {str(e)}")
+
+@app.post(
+    "/api/crop-recommendation/batch",
+    response_model=CropRecommendationBatchResponse,
+    responses={
+        400: {"model": ErrorResponse},
+        401: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        500: {"model": ErrorResponse}
+    }
+)
+async def crop_recommendation_batch(
+    data: CropRecommendationBatchInput,
+    top_k: int = Query(3, ge=1, le=25, description="Number of ranked crops to return per item"),
+    user: dict = Depends(verify_supabase_token)
+):
+    """
+    Crop recommendations for many inputs in one vectorized model call
+    Results are returned in input order and are not stored in history
+    Requires authentication
+    """
+    if not get_crop_model():
+        raise HTTPException(status_code=500, detail="Crop recommendation model not available")
+
+    try:
+        with model_registry.acquire("crop") as handle:
+            if handle is None:
+                raise RuntimeError("Crop recommendation model not available")
+            model_version = handle.version
+            rows = [crop_features(item) for item in data.items]
+            results = await inference_admission.run(
+                "batch", user.get("user_id"), recommend_crops, handle, rows, top_k=top_k
+            )
+
+        # Plain dicts rendered by orjson; the response model documents the shape
+        return FastJSONResponse({
+            "results": [{**result, "model_version": model_version} for result in results],
+            "model_version": model_version
+        })
+
+    except AdmissionRejected:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Prediction failed: {str(e)}")
 
+@app.post(
+    "/api/crop-recommendation/neighbors",
+    response_model=CropNeighborsResponse,
+    responses={
+        401: {"model": ErrorResponse},
+        500: {"model": ErrorResponse}
+    }
+)
+async def crop_neighbor_lookup(
+    data: CropRecommendationBatchInput,
+    k: int = Query(5, ge=1, le=MAX_NEIGHBORS, description="Historical samples to return per item"),
+    user: dict = Depends(verify_supabase_token)
+):
+    """
+    Closest samples in data/Crop_ds.csv to each input, with their crop labels
+    One KD-tree query over the normalized features answers the whole batch
+    Requires authentication
+    """
+    if not crop_neighbor_index.ready:
+        raise HTTPException(status_code=500, detail="Crop neighbour index not available")
+    results = crop_neighbor_index.query([crop_features(item) for item in data.items], k=k)
+    return FastJSONResponse({"results": results, "k": min(k, len(results[0]))})
+
 @app.post(
     "/api/weed-detection",
     response_model=WeedDetectionResponse,
@@ -294,12 +566,16 @@ async def crop_recommendation(
 )
 async def weed_detection(
     image: UploadFile = File(...),
+    tiled: bool = Query(False, description="Run tiled inference for high-resolution images"),
+    tile_size: int = Query(DEFAULT_TILE_SIZE, ge=160, le=2048, description="Tile edge length in pixels"),
+    tile_overlap: float = Query(DEFAULT_TILE_OVERLAP, ge=0.0, le=0.5, description="Overlap fraction between tiles"),
     user: dict = Depends(verify_supabase_token)
 ):
     """
     Detect weeds in uploaded image
     Requires authentication
     Accepts JPG, PNG, JPEG formats (max 16MB)
+    With tiled=true, large images are split into overlapping tiles so small weeds are not lost to downscaling
     """
     model = get_weed_model()
     if not model:
@@ -311,118 +587,153 @@ async def weed_detection(
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="Invalid file format. Only JPG, PNG, JPEG allowed")
     
-    # Validate file size (16MB max)
-    max_size = 16 * 1024 * 1024
-    contents = await image.read()
-    if len(contents) > max_size:
-        raise HTTPException(status_code=400, detail="File size exceeds 16MB limit")
-    
-    try:
-        # Ensure user metadata exists (idempotent upsert)
-        if user.get("user_id"):
-            try:
-                await SupabaseDB.store_user_metadata(
-                    user_id=user.get("user_id"),
-                    email=user.get("email")
-                )
-            except Exception as e:
-                logger.warning(f"Failed to upsert user metadata: {e}")
-
-        # Upload input image to Supabase Storage
-        input_image_url = None
-        if user.get("user_id"):
-            try:
-                input_image_url = await SupabaseDB.upload_weed_image(
-                    user_id=user.get("user_id"),
-                    file_content=contents,
-                    file_ext=file_ext.lstrip('.'),
-                    bucket_name="input-images"
-                )
-            except Exception as e:
-                logger.warning(f"Failed to upload input image: {e}")
-
-        # Save uploaded image temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_ext) as tmp_file:
-            tmp_file.write(contents)
-            tmp_path = tmp_file.name
-        
-        # Run weed detection
-        # Run inference in a thread to avoid blocking the event loop
-        import asyncio
-        
-        # Run model inference
-        results = await asyncio.to_thread(model, tmp_path)
-        result = results[0]
-        
-        # Save annotated image
-        annotated_img = result.plot()
-        
-        # Save to temporary output file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as output_file:
-            output_path = output_file.name
-        
-        # Perform blocking I/O in a thread
-        await asyncio.to_thread(cv2.imwrite, output_path, annotated_img)
-        
-        # Convert to base64
-        def read_and_encode(path):
-            with open(path, "rb") as img_file:
-                return base64.b64encode(img_file.read()).decode('utf-8')
-
-        img_data = await asyncio.to_thread(read_and_encode, output_path)
-        
-        # Upload output image to Supabase Storage
-        output_image_url = None
-        if user.get("user_id"):
-            try:
-                # Need to read the file content again for upload since we read it inside the thread function
-                with open(output_path, "rb") as f:
-                    output_content = f.read()
-                    
-                output_image_url = await SupabaseDB.upload_weed_image(
-                    user_id=user.get("user_id"),
-                    file_content=output_content,
-                    file_ext="jpg",
-                    bucket_name="output-images"
+    # Stream the upload, rejecting on size (16MB max), magic bytes or header dimensions
+    max_size = WEED_UPLOAD_MAX_BYTES
+    # The upload is the first copy in the working set, so its size is reserved before
+    # it is read, on cache hits as well as misses. A miss tops the reservation up to the
+    # full estimate. Both are held until the response is encoded and the images are uploaded
+    upload_bytes = max_size if image.size is None else min(image.size, max_size)
+    async with AsyncExitStack() as memory:
+        await memory.enter_async_context(image_memory_budget.reserve(upload_bytes))
+        with memory_profiler.stage("weed.read_upload"):
+            upload = await read_upload(image, max_bytes=max_size, limit_label="16MB")
+        contents = upload.data
+
+        if tiled and tile_count(upload.width, upload.height, tile_size, tile_overlap) > MAX_TILES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Image needs more than {MAX_TILES} tiles at tile_size={tile_size}; use a larger tile_size or less overlap"
+            )
+
+        try:
+            # Ensure user metadata exists (idempotent upsert)
+            if user.get("user_id"):
+                try:
+                    await SupabaseDB.store_user_metadata(
+                        user_id=user.get("user_id"),
+                        email=user.get("email")
+                    )
+                except Exception as e:
+                    logger.warning(f"Failed to upsert user metadata: {e}")
+
+            # Pin the active model version; a hot reload waits for this request to drain
+            with model_registry.acquire("weed") as handle:
+                if handle is None:
+                    raise RuntimeError("Weed detection model not available")
+                model_version = handle.version
+
+                # Identical bytes + model version -> reuse the previous result
+                variant = f"tiled{tile_size}x{tile_overlap:g}" if tiled else ""
+                cache_key = WeedResultCache.make_key(upload.sha256, model_version, variant)
+                cached = await asyncio.to_thread(weed_result_cache.get, cache_key)
+
+                if cached is None:
+                    # Inference runs on the bounded admission pool, ahead of device and batch work,
+                    # once the decoded frames fit in the image memory budget
+                    estimate = estimate_image_bytes(
+                        len(upload), upload.width, upload.height, tile_size=tile_size if tiled else None
+                    )
+                    await memory.enter_async_context(image_memory_budget.reserve(
+                        image_memory_budget.top_up(estimate, upload_bytes), holding=True
+                    ))
+                    detection = await inference_admission.run(
+                        "interactive",
+                        user.get("user_id"),
+                        run_weed_detection,
+                        handle.model,
+                        contents,
+                        tile_size=tile_size if tiled else None,
+                        tile_overlap=tile_overlap
+                    )
+                    cached = await asyncio.to_thread(
+                        weed_result_cache.put,
+                        cache_key,
+                        detections=detection["detections"],
+                        annotated_jpeg=detection["annotated_jpeg"],
+                        classes=detection["classes"],
+                        confidences=detection["confidences"]
+                    )
+                else:
+                    logger.info("Weed detection cache hit for %s", cache_key)
+
+            detection_count = cached["detections"]
+            output_content = cached["annotated_jpeg"]
+            # Re-uploading the same photo (a cache hit) is counted once per user
+            weed_stats.record(
+                detection_count, cached["classes"], cached["confidences"], user_id=user.get("user_id"),
+                dedup_key=f"{user.get('user_id')}:{upload.sha256}"
+            )
+            with memory_profiler.stage("weed.response_encode"):
+                img_data = base64.b64encode(output_content).decode('utf-8')
+
+            # Upload input/output images to Supabase Storage (skipped if this user already stored them)
+            input_image_url = None
+            output_image_url = None
+            if user.get("user_id"):
+                previous_uploads = cached["uploads"].get(user.get("user_id"))
+                if previous_uploads:
+                    input_image_url = previous_uploads.get("input")
+                    output_image_url = previous_uploads.get("output")
+
+                if not input_image_url:
+                    try:
+                        input_image_url = await SupabaseDB.upload_weed_image(
+                            user_id=user.get("user_id"),
+                            file_content=contents,
+                            # Keyed by content, so .jpg/.jpeg copies of one image share an object
+                            file_ext="png" if upload.format == "png" else "jpg",
+                            bucket_name="input-images",
+                            content_hash=upload.sha256
+                        )
+                    except Exception as e:
+                        logger.warning(f"Failed to upload input image: {e}")
+
+                if not output_image_url:
+                    try:
+                        output_image_url = await SupabaseDB.upload_weed_image(
+                            user_id=user.get("user_id"),
+                            file_content=output_content,
+                            file_ext="jpg",
+                            bucket_name="output-images"
+                        )
+                    except Exception as e:
+                        logger.warning(f"Failed to upload output image: {e}")
+
+                await asyncio.to_thread(
+                    weed_result_cache.remember_uploads,
+                    cache_key,
+                    user.get("user_id"),
+                    input_image_url,
+                    output_image_url
                 )
-            except Exception as e:
-                logger.warning(f"Failed to upload output image: {e}")
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Weed detection failed: {str(e)}")
+
+    # Store in history (optional, non-blocking)
+    if user.get("user_id"):
+        try:
+            await SupabaseDB.store_weed_detection(
+                user_id=user.get("user_id"),
+                filename=image.filename,
+                detections=detection_count,
+                input_image_url=input_image_url,
+                output_image_url=output_image_url,
+                model_version=model_version
+            )
+        except Exception as e:
+            logger.warning(f"Failed to store weed detection history: {e}")
+
+    return WeedDetectionResponse(
+        result_image=img_data,
+        detections=detection_count,
+        message="Weed detection completed successfully",
+        input_image_url=input_image_url,
+        output_image_url=output_image_url,
+        model_version=model_version
+    )
 
-        # Get detection count
-        detection_count = len(result.boxes) if result.boxes else 0
-        
-        # Store in history (optional, non-blocking)
-        if user.get("user_id"):
-            try:
-                await SupabaseDB.store_weed_detection(
-                    user_id=user.get("user_id"),
-                    filename=image.filename,
-                    detections=detection_count,
-                    input_image_url=input_image_url,
-                    output_image_url=output_image_url
-                )
-            except Exception as e:
-                logger.warning(f"Failed to store weed detection history: {e}")
-        
-        # Clean up temporary files
-        os.remove(tmp_path)
-        os.remove(output_path)
-        
-        return WeedDetectionResponse(
-            result_image=img_data,
-            detections=detection_count,
-            message="Weed detection completed successfully",
-            input_image_url=input_image_url,
-            output_image_url=output_image_url
-        )
-    
-    except Exception as e:
-        # Clean up on error
-        if 'tmp_path' in locals() and os.path.exists(tmp_path):
-            os.remove(tmp_path)
-        if 'output_path' in locals() and os.path.exists(output_path):
-            os.remove(output_path)
-        raise HTTPException(status_code=400, detail=f"Weed detection failed: {str(e)}")
 
 @app.post(
     "/api/upload-avatar",
@@ -449,11 +760,10 @@ async def upload_avatar(
     if file_ext not in allowed_extensions:
         raise HTTPException(status_code=400, detail="Invalid file format. Allowed: JPG, PNG, GIF, WEBP")
     
-    # Validate file size (5MB max)
-    max_size = 5 * 1024 * 1024
-    contents = await file.read()
-    if len(contents) > max_size:
-        raise HTTPException(status_code=400, detail="File size exceeds 5MB limit")
+    # Stream the upload, rejecting on size (5MB max), magic bytes or header dimensions
+    max_size = AVATAR_UPLOAD_MAX_BYTES
+    upload = await read_upload(file, max_bytes=max_size, limit_label="5MB")
+    contents = upload.data
     
     try:
         avatar_url = await SupabaseDB.upload_avatar(
@@ -507,7 +817,16 @@ async def delete_avatar(
 async def http_exception_handler(request, exc):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"error": exc.detail}
+        content={"error": exc.detail},
+        headers=getattr(exc, "headers", None)
+    )
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc):
+    return JSONResponse(
+        status_code=429,
+        content={"error": f"Server busy: {exc.reason}"},
+        headers={"Retry-After": str(exc.retry_after)}
     )
 
 @app.exception_handler(Exception)
@@ -519,4 +838,8 @@ async def general_exception_handler(request, exc):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=5000, reload=True)
+    if os.getenv("ENVIRONMENT", "development").lower() == "production":
+        # Single process without the reloader; use gunicorn_conf.py for multiple workers
+        uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "5000")))
+    else:
+        uvicorn.run("main:app", host="0.0.0.0", port=5000, reload=True)
@@ -0,0 +1,251 @@
+"""
+Memory accounting for the image hot path
+A global budget on the estimated working set of in-flight image requests
+(new requests wait for memory instead of stacking 16 MB uploads until the
+process is OOM-killed), plus per-stage memory profiling reported in
+/api/metrics and logged when a stage exceeds MEMORY_LOG_THRESHOLD
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from admission import AdmissionRejected
+from tiling import TILE_BATCH_SIZE
+
+try:
+    import psutil
+except ImportError:  # optional; /proc is used on Linux
+    psutil = None
+
+logger = logging.getLogger("SmartAgriNode.memory")
+
+# Estimated bytes of image work allowed in flight at once
+IMAGE_MEMORY_BUDGET = int(os.getenv("IMAGE_MEMORY_BUDGET", str(512 * 1024 * 1024)))
+# Seconds a request may wait for budget before it is turned away with 429
+MEMORY_BUDGET_TIMEOUT = float(os.getenv("MEMORY_BUDGET_TIMEOUT", "30"))
+# "rss" (cheap, process-wide growth), "tracemalloc" (exact Python/NumPy peaks, slower) or "off"
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING", "rss").lower()
+MEMORY_LOG_THRESHOLD = int(os.getenv("MEMORY_LOG_THRESHOLD", str(256 * 1024 * 1024)))
+WINDOW_SIZE = 256
+
+
+def estimate_image_bytes(encoded_bytes: int, width: int, height: int, tile_size: Optional[int] = None) -> int:
+    """
+    Working set of one image request
+
+    The encoded upload is held alongside the annotated JPEG and its base64
+    response copy (~3x the encoded size); decoding and result.plot() each
+    produce a full BGR frame. Tiled inference adds one batch of letterboxed
+    tiles and their float32 input tensor.
+    """
+    estimate = 3 * encoded_bytes + 2 * width * height * 3
+    if tile_size:
+        estimate += TILE_BATCH_SIZE * tile_size * tile_size * 3 * (1 + 4)
+    return estimate
+
+
+class MemoryBudget:
+    """FIFO gate on the estimated bytes of image requests in flight"""
+
+    def __init__(self, limit: int = IMAGE_MEMORY_BUDGET, timeout: float = MEMORY_BUDGET_TIMEOUT):
+        self.limit = limit
+        self.timeout = timeout
+        self._in_flight = 0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self.peak = 0
+        self.admitted = 0
+        self.waited = 0
+        self.rejected = 0
+        self._wait_seconds = 0.0
+
+    @asynccontextmanager
+    async def reserve(self, nbytes: int, holding: bool = False):
+        """
+        Hold `nbytes` of the budget for the enclosed block
+
+        A request larger than the whole budget is capped at the limit, so it
+        still runs - alone.
+
+        Args:
+            nbytes: Bytes to reserve
+            holding: The caller already holds a reservation it is growing (see
+                top_up); it waits ahead of new requests so they cannot starve it
+
+        Raises:
+            AdmissionRejected: The bytes could not be reserved within `timeout`
+        """
+        if self.limit <= 0:
+            yield
+            return
+        nbytes = max(0, min(nbytes, self.limit))
+        await self._acquire(nbytes, holding)
+        try:
+            yield
+        finally:
+            self._release(nbytes)
+
+    def top_up(self, estimate: int, reserved: int) -> int:
+        """Bytes to add to a reservation of `reserved` so it covers `estimate`, within the limit"""
+        if self.limit <= 0:
+            return 0
+        return max(0, min(estimate, self.limit) - min(reserved, self.limit))
+
+    async def _acquire(self, nbytes: int, holding: bool = False) -> None:
+        self._drop_cancelled()
+        if (holding or not self._waiters) and self._in_flight + nbytes <= self.limit:
+            self._grant(nbytes)
+            return
+
+        self.waited += 1
+        started = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        if holding:
+            self._waiters.appendleft((nbytes, waiter))
+        else:
+            self._waiters.append((nbytes, waiter))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return
+            waiter.cancel()
+            self.rejected += 1
+            logger.warning(f"Image request waited {self.timeout:g}s for {nbytes} bytes of memory budget")
+            raise AdmissionRejected("Image memory budget exhausted", self.timeout / 2)
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Budget was granted just as we were cancelled; give it back
+                self._release(nbytes)
+            else:
+                waiter.cancel()
+            raise
+        finally:
+            self._wait_seconds += time.perf_counter() - started
+
+    def _grant(self, nbytes: int) -> None:
+        self._in_flight += nbytes
+        self.peak = max(self.peak, self._in_flight)
+        self.admitted += 1
+
+    def _release(self, nbytes: int) -> None:
+        self._in_flight -= nbytes
+        self._drop_cancelled()
+        # Wake waiters in arrival order while they fit
+        while self._waiters and self._in_flight + self._waiters[0][0] <= self.limit:
+            size, waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self._grant(size)
+            waiter.set_result(True)
+            self._drop_cancelled()
+
+    def _drop_cancelled(self) -> None:
+        while self._waiters and self._waiters[0][1].done():
+            self._waiters.popleft()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit_bytes": self.limit,
+            "in_flight_bytes": self._in_flight,
+            "peak_in_flight_bytes": self.peak,
+            "waiting": sum(1 for _, waiter in self._waiters if not waiter.done()),
+            "admitted": self.admitted,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "mean_wait_ms": round(self._wait_seconds / self.waited * 1000, 2) if self.waited else 0.0
+        }
+
+
+def current_rss() -> Optional[int]:
+    """Resident set size of this process in bytes (None if unavailable)"""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryProfiler:
+    """
+    Per-stage memory samples
+
+    tracemalloc mode records the peak of traced allocations inside the stage
+    (NumPy/OpenCV arrays included, torch's allocator is not). The peak counter
+    is process-wide, so concurrent stages inflate each other; use
+    INFERENCE_WORKERS=1 for clean numbers. rss mode records how much the
+    resident set grew across the stage.
+    """
+
+    def __init__(self, mode: str = MEMORY_PROFILING, window_size: int = WINDOW_SIZE,
+                 log_threshold: int = MEMORY_LOG_THRESHOLD):
+        self.mode = mode if mode in ("rss", "tracemalloc") else "off"
+        if self.mode == "rss" and current_rss() is None:
+            self.mode = "off"
+        self.log_threshold = log_threshold
+        self._samples: Dict[str, Deque[int]] = defaultdict(lambda: deque(maxlen=window_size))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._rss_high_water = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure the enclosed block; failed blocks are not recorded"""
+        if self.mode == "off":
+            yield
+            return
+        if self.mode == "tracemalloc":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            yield
+            measured = tracemalloc.get_traced_memory()[1] - baseline
+        else:
+            before = current_rss()
+            yield
+            after = current_rss()
+            measured = after - before
+            self._rss_high_water = max(self._rss_high_water, after)
+        self.record(name, max(0, measured))
+
+    def record(self, name: str, nbytes: int) -> None:
+        with self._lock:
+            self._samples[name].append(nbytes)
+            self._counts[name] += 1
+        if nbytes >= self.log_threshold:
+            logger.warning(f"Stage {name} used {nbytes / 1024 / 1024:.1f} MB ({self.mode})")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Per-stage count, mean and max bytes over the recent window"""
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+            counts = dict(self._counts)
+
+        stages = {}
+        for name, values in samples.items():
+            if not values:
+                continue
+            stages[name] = {
+                "count": counts[name],
+                "mean_bytes": int(sum(values) / len(values)),
+                "max_bytes": max(values)
+            }
+        return {
+            "mode": self.mode,
+            "rss_bytes": current_rss() if self.mode != "off" else None,
+            "rss_high_water_bytes": self._rss_high_water or None,
+            "stages": stages
+        }
+
+
+image_memory_budget = MemoryBudget()
+memory_profiler = MemoryProfiler()
@@ -0,0 +1,62 @@
+"""
+In-process metrics
+Rolling latency percentiles for inference calls
+"""
+
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Deque, Dict
+
+WINDOW_SIZE = 512
+
+
+class LatencyTracker:
+    """Keeps the last WINDOW_SIZE samples per operation and reports percentiles"""
+
+    def __init__(self, window_size: int = WINDOW_SIZE):
+        self.window_size = window_size
+        self._samples: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=self.window_size))
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def record(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._samples[name].append(seconds)
+            self._counts[name] += 1
+
+    @contextmanager
+    def track(self, name: str):
+        """Time the enclosed block; failed calls are not recorded"""
+        start = time.perf_counter()
+        yield
+        self.record(name, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """Per-operation count and p50/p95/p99/max latency in milliseconds"""
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+            counts = dict(self._counts)
+
+        report = {}
+        for name, values in samples.items():
+            if not values:
+                continue
+            report[name] = {
+                "count": counts[name],
+                "p50_ms": round(percentile(values, 50) * 1000, 2),
+                "p95_ms": round(percentile(values, 95) * 1000, 2),
+                "p99_ms": round(percentile(values, 99) * 1000, 2),
+                "max_ms": round(values[-1] * 1000, 2)
+            }
+        return report
+
+
+def percentile(sorted_values, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+latency_tracker = LatencyTracker()
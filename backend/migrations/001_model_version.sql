@@ -0,0 +1,9 @@
+-- Smart AgriNode migration 001: record the model version behind each history row
+-- Run once in the Supabase SQL Editor on installs created before model versioning.
+-- Safe to re-run; new installs already get these columns from supabase_schema.sql.
+
+ALTER TABLE crop_recommendations ADD COLUMN IF NOT EXISTS model_version TEXT;
+ALTER TABLE weed_detections ADD COLUMN IF NOT EXISTS model_version TEXT;
+
+-- Make PostgREST pick up the new columns immediately
+NOTIFY pgrst, 'reload schema';
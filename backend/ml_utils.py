@@ -1,8 +1,18 @@
 import os
+import threading
 import joblib
 import logging
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+import cv2
+import numpy as np
 from ultralytics import YOLO
 
+from memory_budget import memory_profiler
+from metrics import latency_tracker
+from model_registry import ModelRegistry, ModelSpec
+from tiling import detect_tiled, draw_detections
+
 logger = logging.getLogger("SmartAgriNode.ml")
 
 # Model paths
@@ -10,27 +20,308 @@ model_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'Models')
 crop_model_path = os.path.join(model_dir, 'crop_recommendation_model.pkl')
 weed_model_path = os.path.join(model_dir, 'weed_detection_model.onnx')
 
-crop_model = None
-weed_model = None
+# Input size used for the weed model warm-up pass
+WARMUP_IMAGE_SIZE = 640
+
+# Crop prediction cache: LRU of probability vectors for quantized inputs
+CROP_FEATURES = ("N", "P", "K", "temperature", "humidity", "ph", "rainfall")
+CROP_CACHE_SIZE = int(os.getenv("CROP_CACHE_SIZE", "4096"))
+# Decimal places kept per feature before lookup, e.g. "ph=1,rainfall=0"
+CROP_CACHE_PRECISION = os.getenv("CROP_CACHE_PRECISION", "N=0,P=0,K=0,temperature=1,humidity=0,ph=1,rainfall=0")
+
+# Intra-op threads for the weed model's ONNX Runtime session (0 = ONNX Runtime default,
+# all physical cores); gunicorn_conf.py sets the per-worker share, autotune may override it
+weed_onnx_threads = int(os.getenv("ORT_NUM_THREADS") or os.getenv("TORCH_NUM_THREADS") or os.getenv("OMP_NUM_THREADS") or "0")
+
+def _load_crop(path: str):
+    return joblib.load(path)
+
+def _load_weed(path: str):
+    return YOLO(path, task='detect')
+
+def _warm_crop(model) -> None:
+    model.predict_proba(np.zeros((1, 7)))
+
+def _warm_weed(model) -> None:
+    dummy = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+    # The first call creates the ONNX Runtime session; rebuild it with the configured threads
+    model(dummy, verbose=False)
+    if weed_onnx_threads and set_onnx_threads(model, weed_onnx_threads):
+        model(dummy, verbose=False)
+
+def set_onnx_threads(model, threads: int) -> bool:
+    """
+    Rebuild a YOLO model's ONNX Runtime session with `threads` intra-op threads
+    (0 = ONNX Runtime default). torch.set_num_threads does not reach it.
+    The session only exists after the first predict call.
+
+    Returns:
+        True if the model runs on ONNX Runtime and its session was rebuilt
+    """
+    predictor = getattr(model, "predictor", None)
+    backend = getattr(getattr(predictor, "model", None), "backend", None)
+    session = getattr(backend, "session", None)
+    if session is None or not hasattr(session, "get_providers"):
+        return False
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    # Concurrency comes from the admission pool, not from parallel graph branches
+    options.inter_op_num_threads = 1
+    backend.session_options = options
+    backend.session = onnxruntime.InferenceSession(
+        session._model_path, options, providers=session.get_providers()
+    )
+    return True
+
+def set_weed_threads(threads: int) -> None:
+    """Use `threads` intra-op threads for the active weed model and any model loaded later"""
+    global weed_onnx_threads
+    weed_onnx_threads = threads
+    model = get_weed_model()
+    if model is not None:
+        _warm_weed(model)
+
+model_registry = ModelRegistry(model_dir, [
+    ModelSpec("crop", crop_model_path, (".pkl", ".joblib"), _load_crop, _warm_crop),
+    ModelSpec("weed", weed_model_path, (".onnx", ".pt"), _load_weed, _warm_weed)
+])
 
 def get_crop_model():
-    global crop_model
-    if crop_model is None and os.path.exists(crop_model_path):
-        try:
-            crop_model = joblib.load(crop_model_path)
-            logger.info("Crop recommendation model loaded successfully")
-        except Exception:
-            logger.exception("Error loading crop recommendation model")
-            crop_model = None
-    return crop_model
+    handle = model_registry.get("crop")
+    return handle.model if handle else None
 
 def get_weed_model():
-    global weed_model
-    if weed_model is None and os.path.exists(weed_model_path):
+    handle = model_registry.get("weed")
+    return handle.model if handle else None
+
+def get_crop_model_version() -> str:
+    """Version tag of the active crop model ("unloaded" if none)."""
+    handle = model_registry.current("crop")
+    return handle.version if handle else "unloaded"
+
+def get_weed_model_version() -> str:
+    """Version tag of the active weed model ("unloaded" if none)."""
+    handle = model_registry.current("weed")
+    return handle.version if handle else "unloaded"
+
+def warm_up_models() -> dict:
+    """
+    Run one dummy inference through each loaded model (blocking; call via a thread)
+    so graph initialization is paid at startup rather than by the first request
+
+    Returns:
+        Dictionary of model name -> warm-up seconds (None if the model is unavailable)
+    """
+    timings = {"crop": None, "weed": None}
+    for kind in timings:
+        handle = model_registry.get(kind)
+        if handle is None:
+            continue
         try:
-            weed_model = YOLO(weed_model_path, task='detect')
-            logger.info("Weed detection model loaded successfully")
+            timings[kind] = round(model_registry.warm_up(handle), 4)
         except Exception:
-            logger.exception("Error loading weed detection model")
-            weed_model = None
-    return weed_model
+            logger.exception(f"{kind} model warm-up failed")
+
+    logger.info("Model warm-up finished: %s", timings)
+    return timings
+
+def model_status() -> dict:
+    """Actual loaded/warm state of both models"""
+    crop = model_registry.current("crop")
+    weed = model_registry.current("weed")
+    return {
+        "crop_model_loaded": crop is not None,
+        "weed_model_loaded": weed is not None,
+        "crop_model_warm": crop is not None and crop.warm,
+        "weed_model_warm": weed is not None and weed.warm,
+        "crop_model_version": crop.version if crop else None,
+        "weed_model_version": weed.version if weed else None
+    }
+
+def run_weed_detection(model, contents: bytes, tile_size: Optional[int] = None, tile_overlap: float = 0.2) -> dict:
+    """
+    Run weed detection on encoded image bytes (blocking; call via a thread)
+
+    Args:
+        model: Loaded YOLO model
+        contents: Encoded JPG/PNG bytes
+        tile_size: If set, run tiled inference with this tile edge (see tiling.py)
+        tile_overlap: Overlap fraction between neighbouring tiles
+
+    Returns:
+        Dictionary with the detection count, the class name and confidence of
+        each detection, and the annotated image as JPEG bytes
+    """
+    with memory_profiler.stage("weed.decode"):
+        img = cv2.imdecode(np.frombuffer(contents, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+
+    if tile_size and max(img.shape[:2]) > tile_size:
+        with latency_tracker.track("weed_inference_tiled"), memory_profiler.stage("weed.inference_tiled"):
+            detections = detect_tiled(model, img, tile_size=tile_size, overlap=tile_overlap)
+        detection_count = len(detections["boxes"])
+        class_ids, confidences = detections["classes"], detections["scores"]
+        with memory_profiler.stage("weed.annotate"):
+            annotated_img = draw_detections(img, detections, model.names)
+    else:
+        with latency_tracker.track("weed_inference"), memory_profiler.stage("weed.inference"):
+            result = model(img, verbose=False)[0]
+        detection_count = len(result.boxes) if result.boxes else 0
+        if detection_count:
+            class_ids, confidences = result.boxes.cls.cpu().numpy(), result.boxes.conf.cpu().numpy()
+        else:
+            class_ids, confidences = np.zeros(0), np.zeros(0)
+        with memory_profiler.stage("weed.annotate"):
+            annotated_img = result.plot()
+        # The result keeps its own reference to the decoded frame
+        del result
+    # Free the decoded frame before encoding so it is not held alongside the annotated copy
+    del img
+
+    with memory_profiler.stage("weed.encode"):
+        ok, buffer = cv2.imencode('.jpg', annotated_img)
+    if not ok:
+        raise ValueError("Could not encode annotated image")
+
+    return {
+        "detections": detection_count,
+        "classes": [str(model.names.get(int(c), int(c))) for c in class_ids],
+        "confidences": [round(float(c), 4) for c in confidences],
+        "annotated_jpeg": buffer.tobytes()
+    }
+
+def parse_precision(spec: str) -> List[int]:
+    """Per-feature decimal places from "name=digits,..." (unlisted features keep 2)"""
+    digits = dict.fromkeys(CROP_FEATURES, 2)
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, value = part.partition("=")
+        if name.strip() not in digits:
+            raise ValueError(f"Unknown crop feature in CROP_CACHE_PRECISION: {name}")
+        digits[name.strip()] = int(value)
+    return [digits[name] for name in CROP_FEATURES]
+
+class CropPredictionCache:
+    """
+    LRU of crop class-probability vectors keyed by quantized feature rows
+
+    Sensor readings that differ only in insignificant decimals share an
+    entry. The cache is tied to one model version and empties itself when
+    a different version is seen, so a reload never serves stale results.
+    """
+
+    def __init__(self, max_entries: int = CROP_CACHE_SIZE, precision: Sequence[int] = None):
+        self.max_entries = max_entries
+        self.precision = np.array(precision or parse_precision(CROP_CACHE_PRECISION))
+        self._scale = 10.0 ** self.precision
+        self._entries: "OrderedDict[tuple, np.ndarray]" = OrderedDict()
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def quantize(self, rows: Sequence[Sequence[float]]) -> np.ndarray:
+        """Round each feature column to its configured precision"""
+        return np.round(np.asarray(rows, dtype=np.float64) * self._scale) / self._scale
+
+    def lookup(self, version: str, keys: List[tuple]) -> List[Optional[np.ndarray]]:
+        with self._lock:
+            if version != self._version:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._version = version
+            found = []
+            for key in keys:
+                proba = self._entries.get(key)
+                if proba is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                found.append(proba)
+            return found
+
+    def store(self, version: str, keys: List[tuple], probas: Sequence[np.ndarray]) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if version != self._version:
+                return
+            for key, proba in zip(keys, probas):
+                self._entries[key] = proba
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "model_version": self._version,
+                "precision": dict(zip(CROP_FEATURES, self.precision.tolist())),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+crop_prediction_cache = CropPredictionCache()
+
+def recommend_crops(handle, rows: Sequence[Sequence[float]], top_k: int = 3) -> List[dict]:
+    """
+    Rank crops for one or more feature rows from a single predict_proba pass
+
+    Args:
+        handle: Pinned crop ModelHandle (see model_registry.acquire)
+        rows: Feature rows in training order (N, P, K, temperature, humidity, ph, rainfall);
+            rounded to the cache precision before prediction
+        top_k: Number of ranked crops to return per row
+
+    Returns:
+        One dictionary per row with the recommended crop, its probability and the top-k list
+    """
+    model = handle.model
+    quantized = crop_prediction_cache.quantize(rows)
+    keys = [tuple(row) for row in quantized.tolist()]
+    probas = crop_prediction_cache.lookup(handle.version, keys)
+
+    # Only rows not seen before go through the model, all in one call
+    missing = [i for i, proba in enumerate(probas) if proba is None]
+    if missing:
+        with latency_tracker.track("crop_inference"):
+            computed = model.predict_proba(quantized[missing])
+        for i, proba in zip(missing, computed):
+            probas[i] = proba
+        crop_prediction_cache.store(handle.version, [keys[i] for i in missing], computed)
+
+    classes = model.classes_
+    k = max(1, min(top_k, len(classes)))
+    matrix = np.vstack(probas)
+    # argpartition picks the k best per row without a full sort
+    top = np.argpartition(-matrix, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(matrix, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind="stable")
+    top = np.take_along_axis(top, order, axis=1)
+    top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+    results = []
+    for idx_row, score_row in zip(top, top_scores):
+        ranked = [
+            {"crop": str(classes[idx]), "probability": round(float(score), 4)}
+            for idx, score in zip(idx_row, score_row)
+        ]
+        results.append({
+            "recommended_crop": ranked[0]["crop"],
+            "confidence": ranked[0]["probability"],
+            "top_k": ranked
+        })
+    return results
@@ -0,0 +1,319 @@
+"""
+Versioned model registry with zero-downtime hot reload
+
+Artifacts live either at the legacy fixed paths in Models/ or under
+Models/<kind>/<version>/. An optional Models/registry.json selects the
+active version per kind:
+
+    {"weed": {"version": "2024-06-01"}, "crop": {"version": "v3", "path": "crop/v3/model.pkl"}}
+
+A reload loads and warms the new version in a background thread, swaps it
+in atomically for new requests, then releases the old version once its
+in-flight requests have drained.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger("SmartAgriNode.registry")
+
+MANIFEST_NAME = "registry.json"
+DRAIN_TIMEOUT = float(os.getenv("MODEL_DRAIN_TIMEOUT", "30"))
+# Version tags name a directory under Models/<kind>/, so no separators or "..": see _versioned_artifact
+VERSION_PATTERN = re.compile(r"[A-Za-z0-9._-]+")
+
+
+def file_digest(path: str) -> str:
+    """Short content hash of a model artifact, used as its version tag when none is given"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+class ModelSpec:
+    """How to find, load and warm up one kind of model"""
+
+    def __init__(self, kind: str, legacy_path: str, extensions: tuple, loader: Callable[[str], Any], warmer: Callable[[Any], None]):
+        self.kind = kind
+        self.legacy_path = legacy_path
+        self.extensions = extensions
+        self.loader = loader
+        self.warmer = warmer
+
+
+class ModelHandle:
+    """A loaded model version plus its in-flight request count"""
+
+    def __init__(self, kind: str, version: str, path: str, model: Any):
+        self.kind = kind
+        self.version = version
+        self.path = path
+        self.model = model
+        self.loaded_at = time.time()
+        self.warm = False
+        self.inflight = 0
+        # Swapped out: the model is released when the last request holding it finishes
+        self.retired = False
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "path": self.path,
+            "loaded_at": self.loaded_at,
+            "warm": self.warm,
+            "inflight": self.inflight
+        }
+
+
+class ModelRegistry:
+    """Holds the active ModelHandle per kind and swaps versions without downtime"""
+
+    def __init__(self, model_dir: str, specs: List[ModelSpec]):
+        self.model_dir = model_dir
+        self.specs = {spec.kind: spec for spec in specs}
+        self._current: Dict[str, Optional[ModelHandle]] = {kind: None for kind in self.specs}
+        self._lock = threading.Lock()
+        self._reload_locks: Dict[str, asyncio.Lock] = {}
+        self._watch_task: Optional[asyncio.Task] = None
+        self._signatures: Dict[str, Any] = {}
+
+    # -- lookup ---------------------------------------------------------
+
+    def current(self, kind: str) -> Optional[ModelHandle]:
+        return self._current[kind]
+
+    def get(self, kind: str) -> Optional[ModelHandle]:
+        """Current handle, loading the active version on first use"""
+        handle = self._current[kind]
+        if handle is None:
+            with self._lock:
+                handle = self._current[kind]
+                if handle is None:
+                    handle = self._load(kind)
+                    self._current[kind] = handle
+        return handle
+
+    @contextmanager
+    def acquire(self, kind: str):
+        """Pin the current version for the duration of a request"""
+        with self._lock:
+            handle = self._current[kind]
+            if handle is not None:
+                handle.inflight += 1
+        if handle is None:
+            handle = self.get(kind)
+            if handle is not None:
+                with self._lock:
+                    handle.inflight += 1
+        try:
+            yield handle
+        finally:
+            if handle is not None:
+                with self._lock:
+                    handle.inflight -= 1
+                    self._release_if_retired(handle)
+
+    @staticmethod
+    def _release_if_retired(handle: ModelHandle) -> None:
+        # Caller holds self._lock
+        if handle.retired and handle.inflight == 0:
+            handle.model = None
+
+    # -- artifact resolution --------------------------------------------
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.model_dir, MANIFEST_NAME)
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(self._manifest_path(), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception:
+            logger.exception("Unreadable model manifest, falling back to legacy paths")
+            return {}
+
+    def available_versions(self, kind: str) -> List[str]:
+        kind_dir = os.path.join(self.model_dir, kind)
+        if not os.path.isdir(kind_dir):
+            return []
+        return sorted(name for name in os.listdir(kind_dir) if os.path.isdir(os.path.join(kind_dir, name)))
+
+    def _versioned_artifact(self, kind: str, version: str) -> str:
+        if not VERSION_PATTERN.fullmatch(version) or version in (".", ".."):
+            raise ValueError(f"Invalid model version {version!r}; use letters, digits, '.', '_' and '-'")
+        spec = self.specs[kind]
+        version_dir = os.path.join(self.model_dir, kind, version)
+        if os.path.isdir(version_dir):
+            for ext in spec.extensions:
+                for name in sorted(os.listdir(version_dir)):
+                    if name.endswith(ext):
+                        return os.path.join(version_dir, name)
+        raise FileNotFoundError(f"No {kind} artifact for version {version}")
+
+    def resolve(self, kind: str, version: Optional[str] = None):
+        """
+        Path and version tag of the artifact to load
+
+        An explicit version wins, then the manifest entry, then the legacy
+        fixed path (tagged with its content hash).
+        """
+        if version:
+            return self._versioned_artifact(kind, version), version
+
+        entry = self._read_manifest().get(kind)
+        if entry and entry.get("version"):
+            if entry.get("path"):
+                return os.path.join(self.model_dir, entry["path"]), entry["version"]
+            return self._versioned_artifact(kind, entry["version"]), entry["version"]
+
+        path = self.specs[kind].legacy_path
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return path, file_digest(path)
+
+    # -- loading --------------------------------------------------------
+
+    def _load(self, kind: str, version: Optional[str] = None, strict: bool = False) -> Optional[ModelHandle]:
+        try:
+            path, version = self.resolve(kind, version)
+        except ValueError:
+            if strict:
+                raise
+            logger.exception(f"Error resolving {kind} model")
+            return None
+        except FileNotFoundError:
+            if strict:
+                raise
+            return None
+        try:
+            model = self.specs[kind].loader(path)
+        except FileNotFoundError:
+            if strict:
+                raise
+            return None
+        except Exception:
+            logger.exception(f"Error loading {kind} model")
+            return None
+        logger.info(f"Loaded {kind} model version {version} from {path}")
+        self._signatures[kind] = self._signature(kind)
+        return ModelHandle(kind, version, path, model)
+
+    def warm_up(self, handle: ModelHandle) -> float:
+        """Run the kind's warm-up inference (blocking) and return its duration"""
+        start = time.perf_counter()
+        self.specs[handle.kind].warmer(handle.model)
+        handle.warm = True
+        return time.perf_counter() - start
+
+    def _load_and_warm(self, kind: str, version: Optional[str]) -> ModelHandle:
+        handle = self._load(kind, version, strict=True)
+        if handle is None:
+            raise RuntimeError(f"Could not load {kind} model" + (f" version {version}" if version else ""))
+        self.warm_up(handle)
+        return handle
+
+    async def reload(self, kind: str, version: Optional[str] = None, force: bool = False) -> Dict[str, Any]:
+        """
+        Load, warm and swap in a new version without interrupting requests
+
+        Returns:
+            Dictionary with previous and current versions
+        """
+        lock = self._reload_locks.setdefault(kind, asyncio.Lock())
+        async with lock:
+            old = self._current[kind]
+            if not force and old is not None and version is None:
+                try:
+                    _, target = await asyncio.to_thread(self.resolve, kind)
+                except FileNotFoundError:
+                    target = None
+                if target == old.version:
+                    return {"model": kind, "previous": old.version, "current": old.version, "changed": False}
+
+            new = await asyncio.to_thread(self._load_and_warm, kind, version)
+            with self._lock:
+                self._current[kind] = new
+
+            previous = old.version if old else None
+            logger.info(f"Swapped {kind} model {previous} -> {new.version}")
+            if old is not None:
+                await self._drain(old)
+            return {"model": kind, "previous": previous, "current": new.version, "changed": True}
+
+    async def _drain(self, handle: ModelHandle) -> None:
+        """
+        Release an old version once no request still holds it
+
+        The model is never dropped under a live request: past DRAIN_TIMEOUT the
+        registry stops waiting and the last request to finish releases it.
+        """
+        with self._lock:
+            handle.retired = True
+            self._release_if_retired(handle)
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while handle.model is not None and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if handle.model is not None:
+            logger.warning(
+                f"{handle.kind} model {handle.version} still has {handle.inflight} requests after drain timeout; "
+                "it is released when the last one finishes"
+            )
+
+    # -- file watcher ---------------------------------------------------
+
+    def _signature(self, kind: str):
+        paths = [self._manifest_path(), self.specs[kind].legacy_path]
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def start_watcher(self, interval: float) -> None:
+        """Poll the manifest and legacy artifacts and reload on change"""
+        if interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch(interval))
+
+    async def stop_watcher(self) -> None:
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    async def _watch(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            for kind in self.specs:
+                signature = await asyncio.to_thread(self._signature, kind)
+                if signature == self._signatures.get(kind):
+                    continue
+                self._signatures[kind] = signature
+                try:
+                    result = await self.reload(kind)
+                    if result["changed"]:
+                        logger.info(f"Watcher reloaded {kind} model: {result}")
+                except Exception:
+                    logger.exception(f"Watcher failed to reload {kind} model")
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            kind: {
+                "current": handle.describe() if handle else None,
+                "available_versions": self.available_versions(kind)
+            }
+            for kind, handle in self._current.items()
+        }
@@ -0,0 +1,248 @@
+"""
+Content-addressed result cache for weed detection
+Identical images (ESP32-CAM retries, repeated uploads) skip inference,
+rendering and storage uploads
+
+The optional disk tier (WEED_CACHE_DIR) may be shared by several gunicorn
+workers: files are written under unique temp names and the directory is
+bounded by WEED_CACHE_DISK_MAX_MB, evicting the least recently used entries
+(oldest mtime; disk hits refresh it). Disk I/O is blocking, so async callers
+run get/put/remember_uploads through asyncio.to_thread.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("SmartAgriNode.cache")
+
+
+class WeedResultCache:
+    """LRU cache bounded by entry count and bytes, with an optional on-disk tier"""
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 max_disk_bytes: int = 512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size in self._disk_entries().values())
+
+    @classmethod
+    def from_env(cls) -> "WeedResultCache":
+        """Build the cache from WEED_CACHE_* environment variables"""
+        return cls(
+            max_entries=int(os.getenv("WEED_CACHE_MAX_ENTRIES", "256")),
+            max_bytes=int(float(os.getenv("WEED_CACHE_MAX_MB", "64")) * 1024 * 1024),
+            disk_dir=os.getenv("WEED_CACHE_DIR") or None,
+            max_disk_bytes=int(float(os.getenv("WEED_CACHE_DISK_MAX_MB", "512")) * 1024 * 1024)
+        )
+
+    @staticmethod
+    def hash_image(contents: bytes) -> str:
+        """SHA-256 hex digest of the raw image bytes"""
+        return hashlib.sha256(contents).hexdigest()
+
+    @staticmethod
+    def make_key(digest: str, model_version: str, variant: str = "") -> str:
+        """Cache key: results are only reusable for the same bytes, model and inference mode"""
+        if variant:
+            return f"{model_version}-{variant}-{digest}"
+        return f"{model_version}-{digest}"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached result
+
+        Returns:
+            Entry with detections, classes, confidences, annotated_jpeg and
+            uploads, or None on miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key: str, detections: int, annotated_jpeg: bytes, classes: Optional[List[str]] = None,
+            confidences: Optional[List[float]] = None) -> Dict[str, Any]:
+        """Store a fresh inference result and return the new entry"""
+        entry = {
+            "detections": int(detections),
+            "classes": list(classes or []),
+            "confidences": list(confidences or []),
+            "annotated_jpeg": annotated_jpeg,
+            "uploads": {}
+        }
+        with self._lock:
+            self._insert(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def remember_uploads(self, key: str, user_id: str, input_url: Optional[str], output_url: Optional[str]) -> None:
+        """Record storage URLs so a repeated upload by the same user is not re-stored"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["uploads"][user_id] = {"input": input_url, "output": output_url}
+        self._write_disk(key, entry, metadata_only=True)
+
+    def stats(self) -> Dict[str, Any]:
+        """Current size and hit/miss counters"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_tier": bool(self.disk_dir),
+                "disk_bytes": self._disk_bytes,
+                "disk_evictions": self.disk_evictions
+            }
+
+    def _insert(self, key: str, entry: Dict[str, Any]) -> None:
+        size = len(entry["annotated_jpeg"])
+        if size > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous["annotated_jpeg"])
+        self._entries[key] = entry
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted["annotated_jpeg"])
+
+    def _disk_paths(self, key: str):
+        return (
+            os.path.join(self.disk_dir, f"{key}.jpg"),
+            os.path.join(self.disk_dir, f"{key}.json")
+        )
+
+    def _read_disk(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.disk_dir:
+            return None
+        image_path, meta_path = self._disk_paths(key)
+        try:
+            with open(meta_path, "r") as f:
+                meta = json.load(f)
+            with open(image_path, "rb") as f:
+                annotated_jpeg = f.read()
+            # A hit makes the entry the most recently used one on disk
+            os.utime(meta_path)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Discarding unreadable cache entry %s", key)
+            return None
+        return {
+            "detections": int(meta.get("detections", 0)),
+            "classes": meta.get("classes", []),
+            "confidences": meta.get("confidences", []),
+            "annotated_jpeg": annotated_jpeg,
+            "uploads": meta.get("uploads", {})
+        }
+
+    def _write_file(self, path: str, data: bytes) -> int:
+        # A unique temp name per write: workers sharing the directory never write the same file
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            try:
+                previous = os.path.getsize(path)
+            except FileNotFoundError:
+                previous = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        return len(data) - previous
+
+    def _write_disk(self, key: str, entry: Dict[str, Any], metadata_only: bool = False) -> None:
+        if not self.disk_dir:
+            return
+        image_path, meta_path = self._disk_paths(key)
+        meta = json.dumps({
+            "detections": entry["detections"],
+            "classes": entry["classes"],
+            "confidences": entry["confidences"],
+            "uploads": entry["uploads"]
+        }).encode()
+        try:
+            # The image goes first: an entry is only visible once its metadata exists
+            added = 0 if metadata_only else self._write_file(image_path, entry["annotated_jpeg"])
+            added += self._write_file(meta_path, meta)
+        except Exception:
+            logger.warning("Failed to persist cache entry %s", key)
+            return
+        with self._disk_lock:
+            self._disk_bytes += added
+            if self._disk_bytes > self.max_disk_bytes:
+                self._prune_disk()
+
+    def _disk_entries(self) -> Dict[str, Any]:
+        """Cache key -> (last use, bytes) for the entries in the disk tier"""
+        entries: Dict[str, Any] = {}
+        for name in os.listdir(self.disk_dir):
+            if name.startswith("."):
+                continue
+            key, ext = os.path.splitext(name)
+            if ext not in (".jpg", ".json"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.disk_dir, name))
+            except FileNotFoundError:
+                continue
+            mtime, size = entries.get(key, (0.0, 0))
+            entries[key] = (max(mtime, stat.st_mtime), size + stat.st_size)
+        return entries
+
+    def _prune_disk(self) -> None:
+        """Evict the least recently used disk entries until the tier fits its budget (caller holds _disk_lock)"""
+        entries = self._disk_entries()
+        total = sum(size for _, size in entries.values())
+        for key, (_, size) in sorted(entries.items(), key=lambda item: item[1][0]):
+            if total <= self.max_disk_bytes:
+                break
+            # Metadata first, so a concurrent reader never sees metadata without its image
+            for path in reversed(self._disk_paths(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            self.disk_evictions += 1
+        self._disk_bytes = total
+
+
+weed_result_cache = WeedResultCache.from_env()
@@ -2,33 +2,70 @@ import asyncio
 import base64
 import logging
 import os
-import tempfile
+import time
+from contextlib import AsyncExitStack
 import cv2
-from fastapi import APIRouter, BackgroundTasks, Depends, File, HTTPException, UploadFile, Request
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, File, Header, HTTPException, Query, UploadFile, Request
 from pydantic import BaseModel
 from database import SupabaseDB
-from ml_utils import get_crop_model, get_weed_model
+from ml_utils import get_crop_model, get_weed_model, model_registry, run_weed_detection
+from result_cache import WeedResultCache, weed_result_cache
+from admission import AdmissionRejected, inference_admission
 from auth import verify_supabase_token
+from uploads import UPLOAD_MAX_CHUNK_BYTES, IngestedImage, UploadSpool, read_request_body, read_request_chunk
+from frame_stream import DEVICE_STREAMS, MJPEGFrameSplitter, StreamCapacityError, get_device_stream
+from memory_budget import estimate_image_bytes, image_memory_budget
+from scan_jobs import scan_orchestrator
+from serialization import FastJSONResponse
+from telemetry_store import (
+    METRICS, RECORD_DTYPE, TELEMETRY_BULK_MAX_BYTES, TelemetryStoreFull, decode_records, telemetry_store
+)
+from weed_stats import weed_stats
 
 router = APIRouter(prefix="/api/device", tags=["device"])
 logger = logging.getLogger("SmartAgriNode.device")
 
+# Upper bound for a single camera frame
+DEVICE_MAX_IMAGE_BYTES = 16 * 1024 * 1024
+
 # In-memory queue for commands
-# Map: device_id -> command
+# Map: device_id -> command ('default' is picked up by whichever device polls first)
 COMMAND_QUEUE = {}
 
+# Scan jobs waiting for a device to pick up their START_WEED_SCAN command
+# Map: device_id the command was queued for -> job id
+PENDING_SCAN_JOBS = {}
+
 # In-memory storage for latest sensor readings (for polling)
 LATEST_SENSOR_DATA = {}
 
 # In-memory storage for weed scan results (list of 8 images)
 WEED_SCAN_RESULTS = {}
 
+# Cache keys of frames already in the current scan (drops camera retries)
+WEED_SCAN_FRAME_KEYS = {}
+
+# Partial frames from resumable chunked uploads
+upload_spool = UploadSpool(max_bytes=DEVICE_MAX_IMAGE_BYTES)
+
+def get_device_id(x_device_id: Optional[str] = Header(None)) -> str:
+    """Device identity from the X-Device-ID header (single-node setups use 'default')"""
+    return (x_device_id or "default").strip() or "default"
+
 class TelemetryInput(BaseModel):
     N: float
     P: float
     K: float
     ph: float
 
+class ChunkedUploadInput(BaseModel):
+    size: int
+    sha256: Optional[str] = None
+
+class ChunkedUploadComplete(BaseModel):
+    sha256: Optional[str] = None
+
 @router.post("/command/sensors")
 async def trigger_sensor_measurement(background_tasks: BackgroundTasks, user: dict = Depends(verify_supabase_token)):
     """
@@ -51,16 +88,25 @@ async def trigger_sensor_measurement(background_tasks: BackgroundTasks, user: di
     return {"message": "Sensor measurement requested"}
 
 @router.post("/command/weed-scan")
-async def trigger_weed_scan(background_tasks: BackgroundTasks, user: dict = Depends(verify_supabase_token)):
+async def trigger_weed_scan(
+    background_tasks: BackgroundTasks,
+    device_id: str = Query("default", description="Camera to scan with; 'default' lets the first polling camera take it"),
+    user: dict = Depends(verify_supabase_token)
+):
     """
     Frontend calls this to request a full weed scan (8 images).
     """
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    COMMAND_QUEUE['default'] = "START_WEED_SCAN"
+    COMMAND_QUEUE[device_id] = "START_WEED_SCAN"
     # Clear previous results
     WEED_SCAN_RESULTS['default'] = []
+    WEED_SCAN_FRAME_KEYS['default'] = set()
+    # Frames uploaded from now on are queued on this job and processed by the scan workers;
+    # the job moves to the camera that picks up the command (see check_command)
+    job = await scan_orchestrator.create_job(device_id, user.get("user_id"))
+    PENDING_SCAN_JOBS[device_id] = job["id"]
     
     # Check if fallback is enabled
     use_fallback = os.getenv("USE_HARDWARE_FALLBACK", "True").lower() == "true"
@@ -69,7 +115,7 @@ async def trigger_weed_scan(background_tasks: BackgroundTasks, user: dict = Depe
         # Simulate hardware response if offline (Fallback)
         background_tasks.add_task(simulate_weed_scan)
     
-    return {"message": "Weed scan requested"}
+    return {"message": "Weed scan requested", "job_id": job["id"]}
 
 async def simulate_sensor_data():
     """Fallback: Simulate sensor data after a short delay"""
@@ -116,25 +162,101 @@ async def simulate_weed_scan():
         })
 
 @router.get("/check-command")
-async def check_command():
+async def check_command(device_id: str = Depends(get_device_id)):
     """
     ESP32 polls this endpoint to see if it needs to do anything.
     """
-    cmd = COMMAND_QUEUE.get('default', "STOP")
+    # A command for this device first, then one for any device
+    queue_key = device_id if COMMAND_QUEUE.get(device_id, "STOP") != "STOP" else 'default'
+    cmd = COMMAND_QUEUE.get(queue_key, "STOP")
     # Clear command after reading if it's a trigger
     if cmd in ["MEASURE_SENSORS", "START_WEED_SCAN"]:
-        COMMAND_QUEUE['default'] = "STOP"
+        COMMAND_QUEUE[queue_key] = "STOP"
+    job_id = PENDING_SCAN_JOBS.pop(queue_key, None) if cmd == "START_WEED_SCAN" else None
+    if job_id is not None and queue_key != device_id:
+        # Frames arrive under the polling camera's X-Device-ID, so the job is keyed by it
+        await scan_orchestrator.assign_device(job_id, device_id)
     return cmd
 
 @router.post("/update-sensors")
-async def update_sensors(data: TelemetryInput):
+async def update_sensors(data: TelemetryInput, device_id: str = Depends(get_device_id)):
     """
     ESP32 sends sensor data here.
     """
     # Store in memory for frontend polling
     LATEST_SENSOR_DATA['default'] = data.dict()
+    # Keep the reading in the device's history for trend charts
+    try:
+        telemetry_store.append(device_id, data.dict())
+    except TelemetryStoreFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     return {"status": "received"}
 
+@router.post("/update-sensors/bulk")
+async def update_sensors_bulk(request: Request, device_id: str = Depends(get_device_id)):
+    """
+    ESP32 uploads buffered readings in one request (e.g. after being offline).
+    Body: application/octet-stream of packed little-endian "<dffff" records
+    (unix timestamp, N, P, K, ph), 24 bytes each.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > TELEMETRY_BULK_MAX_BYTES:
+        raise HTTPException(status_code=400, detail=f"Payload exceeds {TELEMETRY_BULK_MAX_BYTES} bytes")
+
+    payload = bytearray()
+    async for chunk in request.stream():
+        payload.extend(chunk)
+        if len(payload) > TELEMETRY_BULK_MAX_BYTES:
+            raise HTTPException(status_code=400, detail=f"Payload exceeds {TELEMETRY_BULK_MAX_BYTES} bytes")
+
+    try:
+        timestamps, values, rejected = decode_records(bytes(payload))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        telemetry_store.append_many(device_id, timestamps, values)
+    except TelemetryStoreFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    if len(timestamps):
+        newest = int(timestamps.argmax())
+        LATEST_SENSOR_DATA['default'] = {metric: float(values[metric][newest]) for metric in METRICS}
+
+    return {
+        "status": "received",
+        "accepted": int(len(timestamps)),
+        "rejected": rejected,
+        "record_size": RECORD_DTYPE.itemsize
+    }
+
+@router.get("/telemetry")
+async def get_telemetry(
+    device_id: str = "default",
+    start: Optional[float] = Query(None, description="Window start (unix seconds); default 7 days before end"),
+    end: Optional[float] = Query(None, description="Window end (unix seconds); default now"),
+    buckets: int = Query(200, ge=1, le=5000, description="Number of downsampled points"),
+    user: dict = Depends(verify_supabase_token)
+):
+    """
+    Frontend charts: sensor history downsampled to per-bucket min/max/mean.
+    Only devices the caller has run scans on are readable.
+    """
+    end = time.time() if end is None else end
+    start = end - 7 * 24 * 3600 if start is None else start
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    # Someone else's device looks the same as an unknown one
+    user_id = user.get("user_id")
+    owned = user_id is not None and await asyncio.to_thread(
+        scan_orchestrator.store.device_scanned_by, device_id, user_id
+    )
+    if not owned:
+        raise HTTPException(status_code=404, detail=f"No telemetry for device {device_id}")
+    try:
+        return telemetry_store.query(device_id, start, end, buckets)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No telemetry for device {device_id}")
+
 @router.get("/sensors/latest")
 async def get_latest_sensors(user: dict = Depends(verify_supabase_token)):
     """
@@ -145,67 +267,215 @@ async def get_latest_sensors(user: dict = Depends(verify_supabase_token)):
         return {"status": "pending"}
     return {"status": "complete", "data": data}
 
-@router.post("/upload-image")
-async def upload_image(request: Request):
+def upload_reservation(declared_size: Optional[int]) -> int:
+    """Budget bytes to hold for a frame's encoded bytes before they are read (the cap if unknown)"""
+    if declared_size is None:
+        return DEVICE_MAX_IMAGE_BYTES
+    return min(declared_size, DEVICE_MAX_IMAGE_BYTES)
+
+async def process_device_frame(upload: IngestedImage, device_id: str, reserved: int = 0) -> dict:
     """
-    ESP32-CAM uploads raw JPEG data.
+    Run a validated camera frame through weed detection and record it in the current scan.
+    Shared by single-request and resumable chunked uploads; `reserved` is the memory
+    budget the caller already holds for the encoded frame.
     """
-    body = await request.body()
-    if not body:
-        raise HTTPException(status_code=400, detail="Empty body")
+    body = upload.data
     
-    # Save to temp file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-        tmp_file.write(body)
-        tmp_path = tmp_file.name
-        
     try:
-        model = get_weed_model()
-        if not model:
-            raise HTTPException(status_code=500, detail="Model not loaded")
-            
-        # Run inference
-        results = await asyncio.to_thread(model, tmp_path)
-        result = results[0]
-        
-        # Save annotated image
-        annotated_img = result.plot()
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as output_file:
-            output_path = output_file.name
-        await asyncio.to_thread(cv2.imwrite, output_path, annotated_img)
-        
-        # Convert to base64 for immediate display
-        def read_and_encode(path):
-            with open(path, "rb") as img_file:
-                return base64.b64encode(img_file.read()).decode('utf-8')
+        # A cache miss keeps its reservation until the base64 copy below exists
+        async with AsyncExitStack() as memory:
+            with model_registry.acquire("weed") as handle:
+                if handle is None:
+                    raise HTTPException(status_code=500, detail="Model not loaded")
+                model_version = handle.version
 
-        img_data = await asyncio.to_thread(read_and_encode, output_path)
-        weed_count = len(result.boxes) if result.boxes else 0
+                # Camera retries resend identical frames; reuse the cached result
+                cache_key = WeedResultCache.make_key(upload.sha256, model_version)
+                cached = await asyncio.to_thread(weed_result_cache.get, cache_key)
+                if cached is None:
+                    # Run inference (device priority, behind interactive dashboard requests),
+                    # waiting for memory if other image requests already hold the budget
+                    estimate = estimate_image_bytes(len(upload), upload.width, upload.height)
+                    await memory.enter_async_context(image_memory_budget.reserve(
+                        image_memory_budget.top_up(estimate, reserved), holding=reserved > 0
+                    ))
+                    detection = await inference_admission.run("device", device_id, run_weed_detection, handle.model, body)
+                    cached = await asyncio.to_thread(
+                        weed_result_cache.put,
+                        cache_key,
+                        detections=detection["detections"],
+                        annotated_jpeg=detection["annotated_jpeg"],
+                        classes=detection["classes"],
+                        confidences=detection["confidences"]
+                    )
+
+            # Convert to base64 for immediate display
+            img_data = base64.b64encode(cached["annotated_jpeg"]).decode('utf-8')
+        weed_count = cached["detections"]
         
-        # Store result in memory list
+        # Store result in memory list (a retried frame is only stored once)
         if 'default' not in WEED_SCAN_RESULTS:
             WEED_SCAN_RESULTS['default'] = []
+        seen_frames = WEED_SCAN_FRAME_KEYS.setdefault('default', set())
+        if cache_key in seen_frames:
+            return {"status": "duplicate", "weed_count": weed_count, "model_version": model_version}
+        seen_frames.add(cache_key)
+        weed_stats.record(weed_count, cached["classes"], cached["confidences"], device_id=device_id)
             
         WEED_SCAN_RESULTS['default'].append({
             "image": img_data,
-            "weed_count": weed_count
+            "weed_count": weed_count,
+            "model_version": model_version
         })
         
-        return {"status": "processed", "weed_count": weed_count}
+        return {"status": "processed", "weed_count": weed_count, "model_version": model_version}
         
+    except (HTTPException, AdmissionRejected):
+        raise
     except Exception as e:
         logger.error(f"Error processing device image: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if os.path.exists(tmp_path):
-            os.remove(tmp_path)
-        if 'output_path' in locals() and os.path.exists(output_path):
-            os.remove(output_path)
+
+@router.post("/upload-image")
+async def upload_image(request: Request, device_id: str = Depends(get_device_id)):
+    """
+    ESP32-CAM uploads raw JPEG data.
+    """
+    content_length = request.headers.get("content-length")
+    reserved = upload_reservation(int(content_length) if content_length and content_length.isdigit() else None)
+    # The frame's bytes count against the memory budget from the moment they are read
+    async with image_memory_budget.reserve(reserved):
+        # Stream the body, rejecting oversized or non-image payloads early
+        upload = await read_request_body(request, max_bytes=DEVICE_MAX_IMAGE_BYTES, limit_label="16MB")
+        # Frames for an open scan are queued; anything else is processed immediately
+        queued = await scan_orchestrator.submit_frame(device_id, upload)
+        if queued is not None:
+            return queued
+        return await process_device_frame(upload, device_id, reserved)
+
+@router.post("/uploads")
+async def create_chunked_upload(data: ChunkedUploadInput, device_id: str = Depends(get_device_id)):
+    """
+    ESP32-CAM starts a resumable upload for one frame of `size` bytes.
+    Chunks then go to PUT /uploads/{upload_id}?offset=N; after a dropped
+    connection, GET /uploads/{upload_id} returns the offset to resume from.
+    """
+    session = upload_spool.create(device_id, data.size, data.sha256)
+    return session.describe()
+
+@router.get("/uploads/{upload_id}")
+async def get_chunked_upload(upload_id: str, device_id: str = Depends(get_device_id)):
+    """
+    Current offset of a resumable upload.
+    """
+    return upload_spool.get(upload_id, device_id).describe()
+
+@router.put("/uploads/{upload_id}")
+async def append_upload_chunk(
+    upload_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="Byte offset this chunk starts at"),
+    device_id: str = Depends(get_device_id)
+):
+    """
+    Append one chunk (raw body) to a resumable upload; 409 with the expected offset if out of sync.
+    """
+    session = upload_spool.get(upload_id, device_id)
+    chunk = await read_request_chunk(request, UPLOAD_MAX_CHUNK_BYTES)
+    new_offset = await upload_spool.append(session, offset, chunk)
+    return {"upload_id": upload_id, "offset": new_offset, "size": session.size}
+
+@router.post("/uploads/{upload_id}/complete")
+async def complete_chunked_upload(
+    upload_id: str,
+    data: Optional[ChunkedUploadComplete] = None,
+    device_id: str = Depends(get_device_id)
+):
+    """
+    Verify the checksum of a fully received upload and run it through weed detection.
+    """
+    session = upload_spool.get(upload_id, device_id)
+    reserved = upload_reservation(session.size)
+    # Completing reads the spooled frame into memory
+    async with image_memory_budget.reserve(reserved):
+        upload = await upload_spool.complete(session, data.sha256 if data else None, limit_label="16MB")
+        result = await scan_orchestrator.submit_frame(device_id, upload)
+        if result is None:
+            result = await process_device_frame(upload, device_id, reserved)
+    upload_spool.finish(session)
+    return result
 
 @router.get("/weed-scan/results")
 async def get_weed_scan_results(user: dict = Depends(verify_supabase_token)):
     """
     Frontend polls this to get the list of images.
     """
+    if user.get("user_id"):
+        job = await scan_orchestrator.latest_user_status(user["user_id"], include_images=True)
+    else:
+        job = await scan_orchestrator.latest_status('default', include_images=True)
+    if job is not None and job["frames"]:
+        results = [
+            {"image": frame["image"], "weed_count": frame["weed_count"], "model_version": frame["model_version"]}
+            for frame in job["frames"] if "image" in frame
+        ]
+        summary = {k: v for k, v in job.items() if k != "frames"}
+        return FastJSONResponse({"count": len(results), "results": results, "job": summary})
+    # No frames from hardware yet (or simulated fallback)
     results = WEED_SCAN_RESULTS.get('default', [])
-    return {"count": len(results), "results": results}
+    return FastJSONResponse({"count": len(results), "results": results})
+
+@router.get("/weed-scan/jobs/{job_id}")
+async def get_weed_scan_job(job_id: str, include_images: bool = False, user: dict = Depends(verify_supabase_token)):
+    """
+    Progress and per-frame results of a scan job.
+    """
+    job = await scan_orchestrator.job_status(job_id, include_images=include_images)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Scan job not found")
+    return FastJSONResponse(job)
+
+@router.post("/stream")
+async def ingest_stream(request: Request, device_id: str = Depends(get_device_id)):
+    """
+    ESP32-CAM pushes a continuous MJPEG (multipart/x-mixed-replace) or chunked JPEG stream.
+    Frames are skipped while inference is backlogged and near-duplicates are dropped,
+    so the model only sees frames that add information.
+    """
+    try:
+        stream = get_device_stream(device_id)
+    except StreamCapacityError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    splitter = MJPEGFrameSplitter()
+    outcomes = {"queued": 0, "skipped_backlog": 0, "skipped_duplicate": 0, "invalid": 0}
+
+    stream.connections += 1
+    try:
+        async for chunk in request.stream():
+            for frame in splitter.feed(chunk):
+                outcomes[await stream.offer(frame)] += 1
+    finally:
+        stream.connections -= 1
+
+    return {"status": "closed", "frames": outcomes, "stats": stream.stats()}
+
+@router.get("/stream/stats")
+async def get_stream_stats(
+    device_id: Optional[str] = None,
+    include_frame: bool = False,
+    user: dict = Depends(verify_supabase_token)
+):
+    """
+    Frontend polls this for rolling per-device weed counts from streaming cameras.
+    """
+    streams = [DEVICE_STREAMS[device_id]] if device_id in DEVICE_STREAMS else []
+    if device_id is None:
+        streams = list(DEVICE_STREAMS.values())
+
+    devices = []
+    for stream in streams:
+        stats = stream.stats()
+        if include_frame and stream.latest:
+            stats["latest_image"] = base64.b64encode(stream.latest["annotated_jpeg"]).decode('utf-8')
+        devices.append(stats)
+    return {"count": len(devices), "devices": devices}
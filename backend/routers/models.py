@@ -0,0 +1,45 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from ml_utils import model_registry
+from auth import verify_admin_token
+
+router = APIRouter(prefix="/api/models", tags=["models"])
+
+class ModelReloadInput(BaseModel):
+    model: Optional[str] = None
+    version: Optional[str] = None
+    force: bool = False
+
+@router.get("")
+async def list_models(admin: bool = Depends(verify_admin_token)):
+    """
+    Active model versions, their in-flight request counts and the versions available in Models/.
+    """
+    return model_registry.describe()
+
+@router.post("/reload")
+async def reload_models(data: ModelReloadInput, admin: bool = Depends(verify_admin_token)):
+    """
+    Load (and warm up) a new model version in the background, then swap it in
+    without dropping requests. Without a version, re-reads Models/registry.json
+    and the default artifacts; only changed models are swapped.
+    """
+    kinds = [data.model] if data.model else list(model_registry.specs)
+    unknown = [kind for kind in kinds if kind not in model_registry.specs]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown model: {', '.join(unknown)}")
+    if data.version and len(kinds) != 1:
+        raise HTTPException(status_code=400, detail="Specify the model when reloading a specific version")
+
+    results = []
+    for kind in kinds:
+        try:
+            results.append(await model_registry.reload(kind, version=data.version, force=data.force))
+        except FileNotFoundError as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Reload of {kind} model failed: {str(e)}")
+    return {"results": results}
@@ -0,0 +1,563 @@
+"""
+Durable weed-scan jobs
+A weed scan triggered from the dashboard becomes a job; every frame the
+camera uploads for it is spooled to disk and queued as a task in a local
+SQLite database. A pool of async workers takes the queued frames through
+weed detection and the job is aggregated into its field_scans record once
+all frames are in. Queue state survives restarts: tasks that were running
+when the process stopped are re-queued on startup.
+
+The workers overlap frame I/O, caching and storage with inference, but
+inference itself goes through the shared admission pool into one model
+whose ultralytics predictor runs a single call at a time, so more
+SCAN_WORKERS do not add model throughput.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+from admission import AdmissionRejected, inference_admission
+from database import SupabaseDB
+from local_storage import INSTANCE_DIR, connect, utc_now
+from memory_budget import estimate_image_bytes, image_memory_budget
+from ml_utils import model_registry, run_weed_detection
+from result_cache import WeedResultCache, weed_result_cache
+from uploads import IngestedImage, image_dimensions
+from weed_stats import weed_stats
+
+logger = logging.getLogger("SmartAgriNode.scan_jobs")
+
+SCAN_DB_PATH = os.getenv("SCAN_DB_PATH", os.path.join(INSTANCE_DIR, 'scan_jobs.db'))
+SCAN_FRAME_DIR = os.getenv("SCAN_FRAME_DIR", os.path.join(INSTANCE_DIR, 'scan_frames'))
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "2"))
+# Frames per scan (the turret captures 8 positions)
+SCAN_FRAMES_PER_JOB = int(os.getenv("SCAN_FRAMES_PER_JOB", "8"))
+# A scan that stops receiving frames is closed with what it has after this many seconds
+SCAN_JOB_TIMEOUT = float(os.getenv("SCAN_JOB_TIMEOUT", "300"))
+SCAN_TASK_MAX_ATTEMPTS = int(os.getenv("SCAN_TASK_MAX_ATTEMPTS", "3"))
+# Finished jobs (and their frames) are kept this long for the results view
+SCAN_RETENTION = float(os.getenv("SCAN_RETENTION", str(7 * 24 * 3600)))
+SWEEP_INTERVAL = 15.0
+# Back-off before retrying a task the admission controller turned away
+ADMISSION_RETRY_DELAY = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scan_jobs (
+    id TEXT PRIMARY KEY,
+    device_id TEXT NOT NULL,
+    user_id TEXT,
+    field_scan_id TEXT,
+    status TEXT NOT NULL,
+    expected_frames INTEGER NOT NULL,
+    received INTEGER NOT NULL DEFAULT 0,
+    weed_count INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    started REAL NOT NULL,
+    completed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_scan_jobs_device_time ON scan_jobs(device_id, created_at DESC);
+
+CREATE TABLE IF NOT EXISTS scan_tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL REFERENCES scan_jobs(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    frame_key TEXT NOT NULL,
+    frame_path TEXT NOT NULL,
+    output_path TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    weed_count INTEGER,
+    model_version TEXT,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    UNIQUE (job_id, frame_key)
+);
+CREATE INDEX IF NOT EXISTS idx_scan_tasks_status ON scan_tasks(status, id);
+CREATE INDEX IF NOT EXISTS idx_scan_tasks_job ON scan_tasks(job_id, seq);
+"""
+
+# Job lifecycle: collecting -> processing -> completed | failed
+OPEN_STATUSES = ("collecting", "processing")
+
+
+class ScanJobStore:
+    """SQLite persistence for jobs and their frame tasks (one serialized connection)"""
+
+    def __init__(self, path: str = SCAN_DB_PATH):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = connect(self.path, autocommit=True)
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def query(self, sql: str, params: tuple = ()) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [dict(row) for row in self._connection().execute(sql, params).fetchall()]
+
+    def execute(self, sql: str, params: tuple = ()) -> int:
+        with self._lock:
+            return self._connection().execute(sql, params).rowcount
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # -- jobs -------------------------------------------------------------
+
+    def create_job(self, device_id: str, user_id: Optional[str], field_scan_id: Optional[str],
+                   expected_frames: int) -> Dict[str, Any]:
+        now = utc_now()
+        job_id = str(uuid.uuid4())
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # A new scan supersedes one still collecting on the same device
+                conn.execute(
+                    "UPDATE scan_jobs SET status = 'processing', updated_at = ? WHERE device_id = ? AND status = 'collecting'",
+                    (now, device_id)
+                )
+                conn.execute(
+                    "INSERT INTO scan_jobs (id, device_id, user_id, field_scan_id, status, expected_frames, "
+                    "created_at, updated_at, started) VALUES (?, ?, ?, ?, 'collecting', ?, ?, ?, ?)",
+                    (job_id, device_id, user_id, field_scan_id, expected_frames, now, now, time.time())
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get_job(job_id)
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        rows = self.query("SELECT * FROM scan_jobs WHERE id = ?", (job_id,))
+        return rows[0] if rows else None
+
+    def device_scanned_by(self, device_id: str, user_id: str) -> bool:
+        """Whether `user_id` has started a scan on `device_id` (how devices are tied to users)"""
+        return bool(self.query(
+            "SELECT 1 FROM scan_jobs WHERE device_id = ? AND user_id = ? LIMIT 1", (device_id, user_id)
+        ))
+
+    def latest_job(self, device_id: str) -> Optional[Dict[str, Any]]:
+        rows = self.query(
+            "SELECT * FROM scan_jobs WHERE device_id = ? ORDER BY created_at DESC LIMIT 1", (device_id,)
+        )
+        return rows[0] if rows else None
+
+    def latest_user_job(self, user_id: str) -> Optional[Dict[str, Any]]:
+        rows = self.query(
+            "SELECT * FROM scan_jobs WHERE user_id = ? ORDER BY created_at DESC LIMIT 1", (user_id,)
+        )
+        return rows[0] if rows else None
+
+    def assign_device(self, job_id: str, device_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Move a job that has not received frames yet to the device that picked up its command
+
+        Returns:
+            The updated job, or None if it already started collecting elsewhere
+        """
+        now = utc_now()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE scan_jobs SET status = 'processing', updated_at = ? "
+                    "WHERE device_id = ? AND status = 'collecting' AND id != ?",
+                    (now, device_id, job_id)
+                )
+                moved = conn.execute(
+                    "UPDATE scan_jobs SET device_id = ?, updated_at = ? WHERE id = ? AND status = 'collecting' AND received = 0",
+                    (device_id, now, job_id)
+                ).rowcount
+                conn.execute("COMMIT" if moved else "ROLLBACK")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return self.get_job(job_id) if moved else None
+
+    def add_task(self, device_id: str, frame_key: str, frame_path: str) -> Optional[Dict[str, Any]]:
+        """
+        Queue a frame on the device's collecting job
+
+        Returns:
+            The task, {"duplicate": True, ...} for a frame already in the job,
+            or None when no scan is collecting frames
+        """
+        now = utc_now()
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                job = conn.execute(
+                    "SELECT * FROM scan_jobs WHERE device_id = ? ORDER BY created_at DESC LIMIT 1", (device_id,)
+                ).fetchone()
+                if job is None or job["status"] not in OPEN_STATUSES:
+                    conn.execute("ROLLBACK")
+                    return None
+                # Camera retries of a frame already queued (even the last one) are dropped
+                existing = conn.execute(
+                    "SELECT * FROM scan_tasks WHERE job_id = ? AND frame_key = ?", (job["id"], frame_key)
+                ).fetchone()
+                if existing is not None:
+                    conn.execute("ROLLBACK")
+                    return {**dict(existing), "duplicate": True}
+                if job["status"] != "collecting":
+                    conn.execute("ROLLBACK")
+                    return None
+
+                seq = job["received"]
+                cursor = conn.execute(
+                    "INSERT INTO scan_tasks (job_id, seq, frame_key, frame_path, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job["id"], seq, frame_key, frame_path, now, now)
+                )
+                # The job stops collecting once the last expected frame is in
+                status = "processing" if seq + 1 >= job["expected_frames"] else "collecting"
+                conn.execute(
+                    "UPDATE scan_jobs SET received = received + 1, status = ?, updated_at = ? WHERE id = ?",
+                    (status, now, job["id"])
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {"id": cursor.lastrowid, "job_id": job["id"], "seq": seq, "status": "queued", "duplicate": False}
+
+    # -- tasks ------------------------------------------------------------
+
+    def claim_task(self) -> Optional[Dict[str, Any]]:
+        """Atomically move the oldest queued task to running"""
+        rows = self.query(
+            "UPDATE scan_tasks SET status = 'running', attempts = attempts + 1, updated_at = ? "
+            "WHERE id = (SELECT id FROM scan_tasks WHERE status = 'queued' ORDER BY id LIMIT 1) RETURNING *",
+            (utc_now(),)
+        )
+        return rows[0] if rows else None
+
+    def finish_task(self, task_id: int, **fields) -> None:
+        fields["updated_at"] = utc_now()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        self.execute(f"UPDATE scan_tasks SET {assignments} WHERE id = ?", tuple(fields.values()) + (task_id,))
+
+    def requeue_interrupted(self) -> int:
+        """Tasks left running by a previous process go back to the queue"""
+        return self.execute("UPDATE scan_tasks SET status = 'queued', updated_at = ? WHERE status = 'running'", (utc_now(),))
+
+    def job_tasks(self, job_id: str) -> List[Dict[str, Any]]:
+        return self.query("SELECT * FROM scan_tasks WHERE job_id = ? ORDER BY seq", (job_id,))
+
+    def ready_to_finalize(self) -> List[Dict[str, Any]]:
+        """Jobs no longer collecting whose tasks have all finished"""
+        return self.query(
+            "SELECT * FROM scan_jobs j WHERE status = 'processing' AND NOT EXISTS "
+            "(SELECT 1 FROM scan_tasks t WHERE t.job_id = j.id AND t.status IN ('queued', 'running'))"
+        )
+
+    def close_stale(self, timeout: float) -> int:
+        """Stop collecting for jobs that have waited longer than `timeout` for frames"""
+        return self.execute(
+            "UPDATE scan_jobs SET status = 'processing', updated_at = ? WHERE status = 'collecting' AND started < ?",
+            (utc_now(), time.time() - timeout)
+        )
+
+    def complete_job(self, job_id: str, status: str, weed_count: int) -> int:
+        now = utc_now()
+        return self.execute(
+            "UPDATE scan_jobs SET status = ?, weed_count = ?, completed_at = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'processing'",
+            (status, weed_count, now, now, job_id)
+        )
+
+    def expired_jobs(self, retention: float) -> List[str]:
+        rows = self.query(
+            "SELECT id FROM scan_jobs WHERE status NOT IN ('collecting', 'processing') AND started < ?",
+            (time.time() - retention,)
+        )
+        return [row["id"] for row in rows]
+
+    def delete_job(self, job_id: str) -> None:
+        self.execute("DELETE FROM scan_jobs WHERE id = ?", (job_id,))
+
+    def counts(self) -> Dict[str, int]:
+        rows = self.query("SELECT status, COUNT(*) AS n FROM scan_tasks GROUP BY status")
+        return {row["status"]: row["n"] for row in rows}
+
+
+class ScanOrchestrator:
+    """Creates jobs, spools incoming frames and runs the task worker pool"""
+
+    def __init__(self, store: ScanJobStore, frame_dir: str = SCAN_FRAME_DIR, workers: int = SCAN_WORKERS):
+        self.store = store
+        self.frame_dir = frame_dir
+        self.workers = max(1, workers)
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def _frame_path(self, job_id: str, name: str) -> str:
+        return os.path.join(self.frame_dir, job_id, name)
+
+    def _notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def start(self) -> None:
+        """Resume interrupted work and start the workers (called from the app lifespan)"""
+        if self._tasks:
+            return
+        requeued = await asyncio.to_thread(self.store.requeue_interrupted)
+        if requeued:
+            logger.info(f"Re-queued {requeued} scan frames interrupted by the last shutdown")
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._sweeper()))
+        self._wakeup.set()
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Running tasks are re-queued by the next start(); nothing to flush
+        await asyncio.to_thread(self.store.close)
+
+    # -- API --------------------------------------------------------------
+
+    async def create_job(self, device_id: str, user_id: Optional[str],
+                         expected_frames: int = SCAN_FRAMES_PER_JOB) -> Dict[str, Any]:
+        """Start a scan on `device_id`, backed by a field_scans record when the user is known"""
+        field_scan_id = None
+        if user_id:
+            field_scan = await SupabaseDB.create_field_scan(user_id)
+            field_scan_id = field_scan.get("id")
+        job = await asyncio.to_thread(self.store.create_job, device_id, user_id, field_scan_id, expected_frames)
+        self._notify()
+        return job
+
+    async def submit_frame(self, device_id: str, upload: IngestedImage) -> Optional[Dict[str, Any]]:
+        """
+        Queue an uploaded frame on the device's open scan
+
+        Returns:
+            Task summary, or None when the device has no scan collecting frames
+        """
+        job = await asyncio.to_thread(self.store.latest_job, device_id)
+        if job is None or job["status"] not in OPEN_STATUSES:
+            return None
+
+        # Spool first so a queued task always has its frame on disk
+        frame_path = self._frame_path(job["id"], f"{upload.sha256}.{upload.format}")
+        await asyncio.to_thread(self._write_frame, frame_path, upload.data)
+        task = await asyncio.to_thread(self.store.add_task, device_id, upload.sha256, frame_path)
+        if task is None:
+            return None
+        self._notify()
+        return {
+            "status": "duplicate" if task["duplicate"] else "queued",
+            "job_id": task["job_id"],
+            "frame": task["seq"]
+        }
+
+    @staticmethod
+    def _write_frame(path: str, content: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    async def job_status(self, job_id: str, include_images: bool = False) -> Optional[Dict[str, Any]]:
+        job = await asyncio.to_thread(self.store.get_job, job_id)
+        if job is None:
+            return None
+        tasks = await asyncio.to_thread(self.store.job_tasks, job_id)
+        return await asyncio.to_thread(self._describe, job, tasks, include_images)
+
+    async def assign_device(self, job_id: str, device_id: str) -> Optional[Dict[str, Any]]:
+        """Key a pending job by the device that actually runs the scan"""
+        return await asyncio.to_thread(self.store.assign_device, job_id, device_id)
+
+    async def latest_status(self, device_id: str, include_images: bool = False) -> Optional[Dict[str, Any]]:
+        job = await asyncio.to_thread(self.store.latest_job, device_id)
+        if job is None:
+            return None
+        return await self.job_status(job["id"], include_images)
+
+    async def latest_user_status(self, user_id: str, include_images: bool = False) -> Optional[Dict[str, Any]]:
+        job = await asyncio.to_thread(self.store.latest_user_job, user_id)
+        if job is None:
+            return None
+        return await self.job_status(job["id"], include_images)
+
+    @staticmethod
+    def _describe(job: Dict[str, Any], tasks: List[Dict[str, Any]], include_images: bool) -> Dict[str, Any]:
+        frames = []
+        for task in tasks:
+            frame = {
+                "frame": task["seq"],
+                "status": task["status"],
+                "weed_count": task["weed_count"],
+                "model_version": task["model_version"]
+            }
+            if task["error"]:
+                frame["error"] = task["error"]
+            if include_images and task["output_path"] and os.path.exists(task["output_path"]):
+                with open(task["output_path"], "rb") as f:
+                    frame["image"] = base64.b64encode(f.read()).decode('utf-8')
+            frames.append(frame)
+        done = [t for t in tasks if t["status"] == "done"]
+        return {
+            "job_id": job["id"],
+            "device_id": job["device_id"],
+            "field_scan_id": job["field_scan_id"],
+            "status": job["status"],
+            "expected_frames": job["expected_frames"],
+            "received": job["received"],
+            "processed": len(done),
+            "failed": sum(1 for t in tasks if t["status"] == "failed"),
+            "weed_count": sum(t["weed_count"] or 0 for t in done),
+            "created_at": job["created_at"],
+            "completed_at": job["completed_at"],
+            "frames": frames
+        }
+
+    async def stats(self) -> Dict[str, Any]:
+        """Worker count and queued/running/done/failed task totals for /api/metrics"""
+        return {"workers": self.workers, "tasks": await asyncio.to_thread(self.store.counts)}
+
+    # -- workers ----------------------------------------------------------
+
+    async def _worker(self, index: int) -> None:
+        while True:
+            task = await asyncio.to_thread(self.store.claim_task)
+            if task is None:
+                self._wakeup.clear()
+                # Re-check after clearing so a notify between claim and clear is not lost
+                task = await asyncio.to_thread(self.store.claim_task)
+                if task is None:
+                    await self._wakeup.wait()
+                    continue
+            # Let the other idle workers pick up the rest of the queue
+            self._wakeup.set()
+            try:
+                await self._process(task)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f"Scan worker {index} failed on task {task['id']}")
+
+    @staticmethod
+    def _read_frame(path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def _process(self, task: Dict[str, Any]) -> None:
+        try:
+            body = await asyncio.to_thread(self._read_frame, task["frame_path"])
+        except OSError as e:
+            await asyncio.to_thread(self.store.finish_task, task["id"], status="failed", error=f"Frame missing: {e}")
+            await self._finalize_ready()
+            return
+
+        try:
+            with model_registry.acquire("weed") as handle:
+                if handle is None:
+                    raise RuntimeError("Model not loaded")
+                model_version = handle.version
+                cache_key = WeedResultCache.make_key(task["frame_key"], model_version)
+                cached = await asyncio.to_thread(weed_result_cache.get, cache_key)
+                if cached is None:
+                    dimensions = image_dimensions(body) or (0, 0)
+                    # Workers already bound a scan's concurrency, so no per-user limit here
+                    async with image_memory_budget.reserve(estimate_image_bytes(len(body), *dimensions)):
+                        detection = await inference_admission.run("device", None, run_weed_detection, handle.model, body)
+                    cached = await asyncio.to_thread(
+                        weed_result_cache.put,
+                        cache_key,
+                        detections=detection["detections"],
+                        annotated_jpeg=detection["annotated_jpeg"],
+                        classes=detection["classes"],
+                        confidences=detection["confidences"]
+                    )
+        except AdmissionRejected:
+            # Overloaded: give the attempt back and retry shortly
+            await asyncio.to_thread(
+                self.store.finish_task, task["id"], status="queued", attempts=task["attempts"] - 1
+            )
+            await asyncio.sleep(ADMISSION_RETRY_DELAY)
+            return
+        except Exception as e:
+            final = task["attempts"] >= SCAN_TASK_MAX_ATTEMPTS
+            logger.warning(f"Scan frame {task['job_id']}/{task['seq']} failed (attempt {task['attempts']}): {e}")
+            await asyncio.to_thread(
+                self.store.finish_task, task["id"], status="failed" if final else "queued", error=str(e)
+            )
+            if final:
+                await self._finalize_ready()
+            return
+
+        output_path = self._frame_path(task["job_id"], f"{task['seq']}_annotated.jpg")
+        await asyncio.to_thread(self._write_frame, output_path, cached["annotated_jpeg"])
+        await asyncio.to_thread(
+            self.store.finish_task, task["id"], status="done", weed_count=cached["detections"],
+            model_version=model_version, output_path=output_path, error=None
+        )
+        job = await asyncio.to_thread(self.store.get_job, task["job_id"])
+        if job is not None:
+            weed_stats.record(
+                cached["detections"], cached["classes"], cached["confidences"],
+                device_id=job["device_id"], user_id=job["user_id"], scan_id=job["id"]
+            )
+        await self._finalize_ready()
+
+    async def _finalize_ready(self) -> None:
+        for job in await asyncio.to_thread(self.store.ready_to_finalize):
+            tasks = await asyncio.to_thread(self.store.job_tasks, job["id"])
+            done = [t for t in tasks if t["status"] == "done"]
+            weed_count = sum(t["weed_count"] for t in done)
+            status = "completed" if done else "failed"
+            # Only one caller wins the processing -> final transition
+            if not await asyncio.to_thread(self.store.complete_job, job["id"], status, weed_count):
+                continue
+            logger.info(f"Scan {job['id']} {status}: {len(done)}/{len(tasks)} frames, {weed_count} weeds")
+            if job["field_scan_id"]:
+                await SupabaseDB.update_field_scan(job["field_scan_id"], {"status": status, "weed_count": weed_count})
+
+    async def _sweeper(self) -> None:
+        """Close scans that stopped receiving frames and drop expired ones"""
+        while True:
+            try:
+                await asyncio.to_thread(self.store.close_stale, SCAN_JOB_TIMEOUT)
+                # Also catches jobs whose last frame finished just before a restart
+                await self._finalize_ready()
+                for job_id in await asyncio.to_thread(self.store.expired_jobs, SCAN_RETENTION):
+                    await asyncio.to_thread(self.store.delete_job, job_id)
+                    await asyncio.to_thread(shutil.rmtree, os.path.join(self.frame_dir, job_id), True)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Scan sweep failed")
+            await asyncio.sleep(SWEEP_INTERVAL)
+
+
+scan_orchestrator = ScanOrchestrator(ScanJobStore())
@@ -0,0 +1,29 @@
+"""
+Fast JSON responses for large payloads
+History lists, scan results carrying base64 frames and batch outputs are
+rendered with orjson when it is installed (several times faster than the
+stdlib encoder and no jsonable_encoder pass when the endpoint returns the
+response directly). Falls back to the standard JSONResponse otherwise.
+"""
+
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:  # optional dependency
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+ORJSON_OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if ORJSON_AVAILABLE else 0
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson (NumPy scalars/arrays and datetimes included)"""
+
+    def render(self, content: Any) -> bytes:
+        if not ORJSON_AVAILABLE:
+            return super().render(content)
+        return orjson.dumps(content, option=ORJSON_OPTIONS)
@@ -29,6 +29,7 @@ CREATE TABLE IF NOT EXISTS crop_recommendations (
     input_data JSONB NOT NULL,
     recommended_crop TEXT NOT NULL,
     confidence FLOAT NOT NULL,
+    model_version TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
@@ -44,6 +45,7 @@ CREATE TABLE IF NOT EXISTS weed_detections (
     input_image_url TEXT,
     output_image_url TEXT,
     weed_count INTEGER NOT NULL,
+    model_version TEXT,
     created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
     FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
 );
@@ -51,6 +53,12 @@ CREATE TABLE IF NOT EXISTS weed_detections (
 -- Create index on user_id and created_at for faster history queries
 CREATE INDEX IF NOT EXISTS idx_weed_dets_user_time ON weed_detections(user_id, created_at DESC);
 
+-- Existing installs: add the model version columns without recreating tables
+-- (CREATE TABLE IF NOT EXISTS leaves an existing table's columns unchanged;
+-- the same statements are in migrations/001_model_version.sql)
+ALTER TABLE crop_recommendations ADD COLUMN IF NOT EXISTS model_version TEXT;
+ALTER TABLE weed_detections ADD COLUMN IF NOT EXISTS model_version TEXT;
+
 -- Enable Row Level Security (RLS)
 ALTER TABLE users ENABLE ROW LEVEL SECURITY;
 ALTER TABLE crop_recommendations ENABLE ROW LEVEL SECURITY;
@@ -0,0 +1,318 @@
+"""
+In-process time-series store for device telemetry
+Per-device columnar ring buffers (one NumPy array per metric plus
+timestamps) that grow with the data up to TELEMETRY_CAPACITY, a cap on
+the number of devices (ids come from an unauthenticated header), periodic
+persistence to a local .npz file (one per gunicorn
+worker, see worker_slot.py) and windowed
+min/max/mean downsampling for charts
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from worker_slot import worker_path
+
+logger = logging.getLogger("SmartAgriNode.telemetry")
+
+METRICS = ("N", "P", "K", "ph")
+
+# Readings kept per device; at one reading a minute the default covers ~4 months
+TELEMETRY_CAPACITY = int(os.getenv("TELEMETRY_CAPACITY", "200000"))
+# Initial allocation per device; buffers double as readings arrive, up to the capacity
+INITIAL_ALLOCATION = 256
+# Devices tracked per process; readings from further new device ids are refused
+TELEMETRY_MAX_DEVICES = int(os.getenv("TELEMETRY_MAX_DEVICES", "1000"))
+TELEMETRY_PATH = os.getenv(
+    "TELEMETRY_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'telemetry.npz')
+)
+TELEMETRY_PERSIST_INTERVAL = float(os.getenv("TELEMETRY_PERSIST_INTERVAL", "60"))
+MAX_QUERY_BUCKETS = 5000
+
+# Bulk upload framing: little-endian struct "<dffff" per reading
+# (unix timestamp float64, then N, P, K, ph as float32) - 24 bytes, no padding
+RECORD_DTYPE = np.dtype([("t", "<f8"), ("N", "<f4"), ("P", "<f4"), ("K", "<f4"), ("ph", "<f4")])
+TELEMETRY_BULK_MAX_BYTES = int(os.getenv("TELEMETRY_BULK_MAX_BYTES", str(RECORD_DTYPE.itemsize * 50000)))
+# Oldest backlog accepted, and tolerated clock skew into the future (seconds)
+TELEMETRY_MAX_AGE = float(os.getenv("TELEMETRY_MAX_AGE", str(365 * 24 * 3600)))
+TELEMETRY_MAX_SKEW = 300.0
+# Plausible sensor ranges; readings outside them are dropped
+METRIC_RANGES = {"N": (0.0, 2000.0), "P": (0.0, 2000.0), "K": (0.0, 2000.0), "ph": (0.0, 14.0)}
+
+
+def decode_records(payload: bytes, now: Optional[float] = None):
+    """
+    Parse and validate a bulk telemetry payload in one vectorized pass
+
+    Args:
+        payload: Concatenated RECORD_DTYPE records
+        now: Reference time for timestamp checks (default: current time)
+
+    Returns:
+        (timestamps, values per metric, number of rejected records)
+
+    Raises:
+        ValueError: Payload is not a whole number of records
+    """
+    if len(payload) % RECORD_DTYPE.itemsize:
+        raise ValueError(f"Payload length {len(payload)} is not a multiple of the {RECORD_DTYPE.itemsize}-byte record size")
+    records = np.frombuffer(payload, dtype=RECORD_DTYPE)
+    now = time.time() if now is None else now
+
+    timestamps = records["t"]
+    valid = np.isfinite(timestamps) & (timestamps >= now - TELEMETRY_MAX_AGE) & (timestamps <= now + TELEMETRY_MAX_SKEW)
+    for metric, (low, high) in METRIC_RANGES.items():
+        column = records[metric]
+        valid &= np.isfinite(column) & (column >= low) & (column <= high)
+
+    kept = records[valid]
+    values = {metric: kept[metric].astype(np.float32) for metric in METRICS}
+    return kept["t"].astype(np.float64), values, int(len(records) - len(kept))
+
+
+class DeviceSeries:
+    """Ring buffer of timestamped readings for one device, grown on demand up to `capacity`"""
+
+    def __init__(self, capacity: int = TELEMETRY_CAPACITY):
+        self.capacity = capacity
+        self.allocated = min(capacity, INITIAL_ALLOCATION)
+        self.timestamps = np.zeros(self.allocated, dtype=np.float64)
+        self.values = {metric: np.zeros(self.allocated, dtype=np.float32) for metric in METRICS}
+        self.head = 0      # next write position
+        self.size = 0
+        self.ordered = True  # False once an older reading arrives after a newer one
+        self.last_timestamp = -np.inf
+
+    def append_many(self, timestamps: np.ndarray, values: Dict[str, np.ndarray]) -> None:
+        """Append a block of readings; only the newest `capacity` are kept"""
+        count = len(timestamps)
+        if count == 0:
+            return
+        if count > self.capacity:
+            order = np.argsort(timestamps, kind="stable")[-self.capacity:]
+            timestamps = timestamps[order]
+            values = {metric: values[metric][order] for metric in METRICS}
+            count = self.capacity
+
+        if self.size + count > self.allocated < self.capacity:
+            self._grow(min(self.capacity, max(2 * self.allocated, self.size + count)))
+
+        if timestamps[0] < self.last_timestamp or np.any(np.diff(timestamps) < 0):
+            self.ordered = False
+        self.last_timestamp = max(self.last_timestamp, float(timestamps.max()))
+
+        # At most two slices: up to the end of the buffer, then wrapped to the start
+        first = min(count, self.allocated - self.head)
+        for column, source in [(self.timestamps, timestamps)] + [(self.values[m], values[m]) for m in METRICS]:
+            column[self.head:self.head + first] = source[:first]
+            column[:count - first] = source[first:]
+        self.head = (self.head + count) % self.allocated
+        self.size = min(self.allocated, self.size + count)
+
+    def _grow(self, allocated: int) -> None:
+        """Move the readings oldest-first into larger buffers"""
+        start = (self.head - self.size) % self.allocated
+        index = (start + np.arange(self.size)) % self.allocated
+        timestamps = np.zeros(allocated, dtype=np.float64)
+        timestamps[:self.size] = self.timestamps[index]
+        self.timestamps = timestamps
+        for metric in METRICS:
+            column = np.zeros(allocated, dtype=np.float32)
+            column[:self.size] = self.values[metric][index]
+            self.values[metric] = column
+        self.allocated = allocated
+        self.head = self.size % allocated
+
+    def _linearize(self) -> None:
+        """Rewrite the buffer oldest-first (sorting if readings arrived out of order)"""
+        start = (self.head - self.size) % self.allocated
+        index = (start + np.arange(self.size)) % self.allocated
+        if not self.ordered:
+            index = index[np.argsort(self.timestamps[index], kind="stable")]
+        self.timestamps[:self.size] = self.timestamps[index]
+        for metric in METRICS:
+            self.values[metric][:self.size] = self.values[metric][index]
+        self.head = self.size % self.allocated
+        self.ordered = True
+
+    def ordered_view(self):
+        """Timestamps and metric columns oldest-first"""
+        start = (self.head - self.size) % self.allocated
+        if not self.ordered or start + self.size > self.allocated:
+            self._linearize()
+            start = 0
+        end = start + self.size
+        return self.timestamps[start:end], {metric: self.values[metric][start:end] for metric in METRICS}
+
+
+class TelemetryStoreFull(Exception):
+    """A reading arrived from a new device while TELEMETRY_MAX_DEVICES are already tracked"""
+
+
+class TelemetryStore:
+    """Device id -> DeviceSeries, with persistence and downsampled queries"""
+
+    def __init__(self, path: str = TELEMETRY_PATH, capacity: int = TELEMETRY_CAPACITY,
+                 max_devices: int = TELEMETRY_MAX_DEVICES):
+        self.path = path
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.series: Dict[str, DeviceSeries] = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._persist_task: Optional[asyncio.Task] = None
+
+    def _device(self, device_id: str) -> DeviceSeries:
+        series = self.series.get(device_id)
+        if series is None:
+            if len(self.series) >= self.max_devices:
+                raise TelemetryStoreFull(f"Telemetry is already tracked for {self.max_devices} devices")
+            series = DeviceSeries(self.capacity)
+            self.series[device_id] = series
+        return series
+
+    def append(self, device_id: str, reading: Dict[str, float], timestamp: Optional[float] = None) -> None:
+        """Append one reading (timestamped now unless given)"""
+        self.append_many(
+            device_id,
+            np.array([time.time() if timestamp is None else timestamp], dtype=np.float64),
+            {metric: np.array([reading[metric]], dtype=np.float32) for metric in METRICS}
+        )
+
+    def append_many(self, device_id: str, timestamps: np.ndarray, values: Dict[str, np.ndarray]) -> None:
+        """
+        Raises:
+            TelemetryStoreFull: device_id is new and the device cap is reached
+        """
+        with self._lock:
+            self._device(device_id).append_many(timestamps, values)
+            self._dirty = True
+
+    def devices(self) -> List[str]:
+        return sorted(self.series)
+
+    def query(self, device_id: str, start: float, end: float, buckets: int) -> Dict:
+        """
+        Downsample a device's readings in [start, end) into equal-width buckets
+
+        Returns:
+            Dictionary with the bucket width and, per non-empty bucket, its start
+            time, reading count and min/max/mean of every metric
+        """
+        buckets = max(1, min(buckets, MAX_QUERY_BUCKETS))
+        bucket_seconds = max((end - start) / buckets, 1e-6)
+        with self._lock:
+            series = self.series.get(device_id)
+            if series is None:
+                raise KeyError(device_id)
+            timestamps, values = series.ordered_view()
+            lo, hi = np.searchsorted(timestamps, [start, end], side="left")
+            timestamps = timestamps[lo:hi].copy()
+            values = {metric: column[lo:hi].copy() for metric, column in values.items()}
+
+        points = []
+        if len(timestamps):
+            bucket_ids = np.minimum(((timestamps - start) // bucket_seconds).astype(np.int64), buckets - 1)
+            # Readings are sorted, so each bucket is a contiguous run starting at these offsets
+            offsets = np.flatnonzero(np.r_[True, np.diff(bucket_ids) != 0])
+            counts = np.diff(np.r_[offsets, len(timestamps)])
+            stats = {
+                metric: (
+                    np.minimum.reduceat(column, offsets),
+                    np.maximum.reduceat(column, offsets),
+                    np.add.reduceat(column.astype(np.float64), offsets) / counts
+                )
+                for metric, column in values.items()
+            }
+            for i, bucket in enumerate(bucket_ids[offsets].tolist()):
+                point = {"t": round(start + bucket * bucket_seconds, 3), "count": int(counts[i])}
+                for metric, (mins, maxs, means) in stats.items():
+                    point[metric] = {
+                        "min": round(float(mins[i]), 3),
+                        "max": round(float(maxs[i]), 3),
+                        "mean": round(float(means[i]), 3)
+                    }
+                points.append(point)
+
+        return {
+            "device_id": device_id,
+            "start": start,
+            "end": end,
+            "bucket_seconds": round(bucket_seconds, 3),
+            "readings": int(len(timestamps)),
+            "points": points
+        }
+
+    # -- persistence ----------------------------------------------------
+
+    def save(self) -> bool:
+        """Write all series to this worker's file atomically; skipped when nothing changed"""
+        with self._lock:
+            if not self._dirty:
+                return False
+            arrays = {"devices": np.array(list(self.series), dtype=str)}
+            for i, series in enumerate(self.series.values()):
+                timestamps, values = series.ordered_view()
+                arrays[f"d{i}_t"] = timestamps.copy()
+                for metric, column in values.items():
+                    arrays[f"d{i}_{metric}"] = column.copy()
+            self._dirty = False
+
+        path = worker_path(self.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        return True
+
+    def load(self) -> int:
+        """Restore series saved by `save`; returns the number of devices loaded"""
+        path = worker_path(self.path)
+        if not os.path.exists(path):
+            return 0
+        try:
+            with np.load(path) as data:
+                devices = list(data["devices"])
+                for i, device_id in enumerate(devices):
+                    self.append_many(
+                        str(device_id),
+                        data[f"d{i}_t"],
+                        {metric: data[f"d{i}_{metric}"] for metric in METRICS}
+                    )
+        except TelemetryStoreFull:
+            logger.warning(f"{path} has more than {self.max_devices} devices; the rest were not loaded")
+            devices = list(self.series)
+        except Exception:
+            logger.exception(f"Could not load telemetry from {path}")
+            return 0
+        self._dirty = False
+        return len(devices)
+
+    def start_persistence(self, interval: float = TELEMETRY_PERSIST_INTERVAL) -> None:
+        if interval > 0 and self._persist_task is None:
+            self._persist_task = asyncio.create_task(self._persist(interval))
+
+    async def stop_persistence(self) -> None:
+        if self._persist_task is not None:
+            self._persist_task.cancel()
+            self._persist_task = None
+        await asyncio.to_thread(self.save)
+
+    async def _persist(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.save)
+            except Exception:
+                logger.exception("Telemetry persistence failed")
+
+
+telemetry_store = TelemetryStore()
@@ -0,0 +1,90 @@
+import asyncio
+import threading
+
+import pytest
+
+from admission import AdmissionRejected, InferenceAdmission
+
+
+def blocking(event: threading.Event, result=None):
+    event.wait(5)
+    return result
+
+
+def test_per_user_limit_rejects_extra_concurrent_request():
+    async def scenario():
+        admission = InferenceAdmission(workers=2, per_user_limit=1, budgets={"interactive": 5, "device": 5, "batch": 5})
+        release = threading.Event()
+        first = asyncio.create_task(admission.run("interactive", "alice", blocking, release, "a"))
+        await asyncio.sleep(0.05)
+        with pytest.raises(AdmissionRejected):
+            await admission.run("interactive", "alice", blocking, release)
+        # Other users are unaffected
+        other = asyncio.create_task(admission.run("interactive", "bob", blocking, release, "b"))
+        await asyncio.sleep(0.05)
+        release.set()
+        results = await asyncio.gather(first, other)
+        admission.shutdown()
+        return results, admission.rejected["interactive"]
+
+    results, rejected = asyncio.run(scenario())
+    assert results == ["a", "b"]
+    assert rejected == 1
+
+
+def test_queue_time_budget_rejects_waiting_request():
+    async def scenario():
+        admission = InferenceAdmission(workers=1, budgets={"interactive": 5, "device": 0.1, "batch": 5})
+        # Keep the estimate under the budget so the request queues and then times out
+        admission._service_time = 0.01
+        release = threading.Event()
+        running = asyncio.create_task(admission.run("interactive", None, blocking, release))
+        await asyncio.sleep(0.05)
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await admission.run("device", None, blocking, release)
+        release.set()
+        await running
+        admission.shutdown()
+        return excinfo.value, admission.stats()
+
+    error, stats = asyncio.run(scenario())
+    assert error.reason == "Queue-time budget exceeded"
+    assert error.retry_after >= 1
+    assert stats["queued"] == 0 and stats["running"] == 0
+
+
+def test_backlog_estimate_over_budget_rejects_immediately():
+    async def scenario():
+        admission = InferenceAdmission(workers=1, budgets={"interactive": 5, "device": 1, "batch": 5})
+        admission._service_time = 2.0
+        release = threading.Event()
+        running = asyncio.create_task(admission.run("interactive", None, blocking, release))
+        await asyncio.sleep(0.05)
+        with pytest.raises(AdmissionRejected) as excinfo:
+            await admission.run("device", None, blocking, release)
+        release.set()
+        await running
+        admission.shutdown()
+        return excinfo.value
+
+    assert asyncio.run(scenario()).reason == "Inference backlog exceeds queue-time budget"
+
+
+def test_interactive_requests_are_served_before_device_requests():
+    async def scenario():
+        admission = InferenceAdmission(workers=1, budgets={"interactive": 5, "device": 5, "batch": 5})
+        admission._service_time = 0.01
+        release = threading.Event()
+        order = []
+        running = asyncio.create_task(admission.run("batch", None, blocking, release))
+        await asyncio.sleep(0.05)
+        device = asyncio.create_task(admission.run("device", None, order.append, "device"))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(admission.run("interactive", None, order.append, "interactive"))
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(running, device, interactive)
+        admission.shutdown()
+        return order
+
+    assert asyncio.run(scenario()) == ["interactive", "device"]
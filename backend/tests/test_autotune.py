@@ -0,0 +1,26 @@
+from autotune import candidate_configs, is_current, select
+
+
+def test_candidates_tune_only_intra_op_threads():
+    assert candidate_configs(6) == [{"intra_op_threads": n} for n in (1, 2, 4, 6)]
+    assert candidate_configs(1) == [{"intra_op_threads": 1}]
+
+
+def test_select_prefers_throughput_within_target():
+    results = [
+        {"intra_op_threads": 1, "weed": {"throughput_rps": 2.0, "p95_ms": 600}},
+        {"intra_op_threads": 2, "weed": {"throughput_rps": 3.5, "p95_ms": 400}},
+        {"intra_op_threads": 4, "weed": {"throughput_rps": 4.0, "p95_ms": 900}}
+    ]
+    assert select(results, 800)["intra_op_threads"] == 2
+    # Nothing meets the target: lowest p95 wins
+    assert select(results, 100)["intra_op_threads"] == 2
+
+
+def test_saved_result_must_match_cpus_and_models():
+    versions = {"weed": "v2", "crop": "v1"}
+    report = {"cpu_count": 4, "model_versions": versions, "selected": {"intra_op_threads": 2}}
+    assert is_current(report, 4, versions)
+    assert not is_current(report, 8, versions)
+    assert not is_current(report, 4, {"weed": "v3", "crop": "v1"})
+    assert not is_current(None, 4, versions)
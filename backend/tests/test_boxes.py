@@ -0,0 +1,37 @@
+import numpy as np
+
+from boxes import batched_nms, box_ios, box_iou, nms
+
+
+def test_iou_and_ios():
+    box = np.array([0, 0, 10, 10], dtype=np.float64)
+    others = np.array([[0, 0, 10, 10], [5, 0, 15, 10], [20, 20, 30, 30], [2, 2, 4, 4]], dtype=np.float64)
+    assert np.allclose(box_iou(box, others), [1.0, 50 / 150, 0.0, 4 / 100])
+    # A small box fully inside a large one overlaps it completely by the smaller-box measure
+    assert np.allclose(box_ios(box, others), [1.0, 0.5, 0.0, 1.0])
+
+
+def test_nms_keeps_highest_score_and_orders_by_score():
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [50, 50, 60, 60]], dtype=np.float64)
+    scores = np.array([0.6, 0.9, 0.7])
+    assert nms(boxes, scores, 0.5).tolist() == [1, 2]
+
+
+def test_batched_nms_does_not_suppress_across_classes():
+    boxes = np.array([[0, 0, 10, 10], [0, 0, 10, 10], [1, 1, 10, 10]], dtype=np.float64)
+    scores = np.array([0.9, 0.8, 0.7])
+    classes = np.array([0, 1, 0])
+    assert sorted(batched_nms(boxes, scores, classes, 0.5).tolist()) == [0, 1]
+
+
+def test_batched_nms_ios_merges_box_cut_at_tile_edge():
+    # The same weed seen whole in one tile and clipped by the edge of its neighbour
+    boxes = np.array([[100, 100, 140, 140], [120, 100, 140, 140]], dtype=np.float64)
+    scores = np.array([0.8, 0.85])
+    classes = np.array([0, 0])
+    assert batched_nms(boxes, scores, classes, 0.6, metric="iou").tolist() == [1, 0]
+    assert batched_nms(boxes, scores, classes, 0.6, metric="ios").tolist() == [1]
+
+
+def test_batched_nms_empty():
+    assert batched_nms(np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64), 0.5).tolist() == []
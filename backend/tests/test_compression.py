@@ -0,0 +1,139 @@
+import gzip
+import json
+from datetime import datetime, timezone
+
+import numpy as np
+import pytest
+from fastapi import FastAPI, Response
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import serialization
+from compression import SelectiveGZipMiddleware
+from serialization import FastJSONResponse
+
+MIN_SIZE = 1024
+BIG = {"values": list(range(600))}
+JPEG = b"\xff\xd8\xff" + bytes(4000) + b"\xff\xd9"
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(SelectiveGZipMiddleware, minimum_size=MIN_SIZE)
+
+    @app.get("/big")
+    async def big():
+        return FastJSONResponse(BIG)
+
+    @app.get("/exact")
+    async def exact():
+        # Body of exactly MIN_SIZE bytes: {"pad":"..."} is 10 bytes plus the padding
+        return FastJSONResponse({"pad": "x" * (MIN_SIZE - 10)})
+
+    @app.get("/small")
+    async def small():
+        return FastJSONResponse({"ok": True})
+
+    @app.get("/jpeg")
+    async def jpeg():
+        return Response(JPEG, media_type="image/jpeg")
+
+    @app.get("/stream")
+    async def stream():
+        async def parts():
+            for _ in range(3):
+                yield json.dumps(BIG).encode()
+        return StreamingResponse(parts(), media_type="application/json")
+
+    @app.get("/empty", status_code=204)
+    async def empty():
+        return Response(status_code=204)
+
+    @app.get("/not-modified")
+    async def not_modified():
+        return Response(status_code=304, headers={"Content-Type": "application/json"})
+
+    return TestClient(app)
+
+
+def raw_get(client, path, encoding="gzip"):
+    """Status, headers and the body bytes as sent (not decompressed)"""
+    with client.stream("GET", path, headers={"Accept-Encoding": encoding}) as response:
+        return response.status_code, response.headers, b"".join(response.iter_raw())
+
+
+def test_large_json_is_gzipped_with_length_and_vary(client):
+    status, headers, body = raw_get(client, "/big")
+    assert status == 200
+    assert headers["content-encoding"] == "gzip"
+    assert headers["content-length"] == str(len(body))
+    assert "accept-encoding" in headers["vary"].lower()
+    assert json.loads(gzip.decompress(body)) == BIG
+
+
+def test_threshold_is_inclusive(client):
+    status, headers, body = raw_get(client, "/exact")
+    assert headers["content-encoding"] == "gzip"
+    assert len(gzip.decompress(body)) == MIN_SIZE
+
+
+def test_small_json_is_left_alone(client):
+    status, headers, body = raw_get(client, "/small")
+    assert "content-encoding" not in headers
+    assert json.loads(body) == {"ok": True}
+    assert "accept-encoding" in headers["vary"].lower()
+
+
+def test_clients_without_gzip_get_identity(client):
+    status, headers, body = raw_get(client, "/big", encoding="identity")
+    assert "content-encoding" not in headers
+    assert json.loads(body) == BIG
+
+
+def test_jpeg_passes_through_unchanged(client):
+    status, headers, body = raw_get(client, "/jpeg")
+    assert "content-encoding" not in headers
+    assert headers["content-length"] == str(len(JPEG))
+    assert body == JPEG
+
+
+def test_streamed_response_is_not_buffered_or_compressed(client):
+    status, headers, body = raw_get(client, "/stream")
+    assert status == 200
+    assert "content-encoding" not in headers
+    assert body == json.dumps(BIG).encode() * 3
+
+
+@pytest.mark.parametrize("path,status", [("/empty", 204), ("/not-modified", 304)])
+def test_bodiless_statuses_pass_through(client, path, status):
+    code, headers, body = raw_get(client, path)
+    assert code == status
+    assert "content-encoding" not in headers
+    assert body == b""
+
+
+@pytest.mark.skipif(not serialization.ORJSON_AVAILABLE, reason="orjson not installed")
+def test_fast_json_renders_numpy_and_datetimes():
+    content = {
+        "count": np.int64(3),
+        "score": np.float32(0.5),
+        "boxes": np.array([[1, 2], [3, 4]], dtype=np.int32),
+        "at": datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc),
+        7: "non-string key"
+    }
+    body = json.loads(FastJSONResponse(content).body)
+    assert body == {
+        "count": 3,
+        "score": 0.5,
+        "boxes": [[1, 2], [3, 4]],
+        "at": "2024-05-01T12:30:00+00:00",
+        "7": "non-string key"
+    }
+
+
+def test_fast_json_falls_back_to_the_standard_encoder(monkeypatch):
+    monkeypatch.setattr(serialization, "ORJSON_AVAILABLE", False)
+    response = FastJSONResponse({"items": [1, 2], "name": "weed"})
+    assert json.loads(response.body) == {"items": [1, 2], "name": "weed"}
+    assert response.media_type == "application/json"
@@ -0,0 +1,66 @@
+import pandas as pd
+
+import crop_neighbors
+from crop_neighbors import CropNeighborIndex
+from ml_utils import CROP_FEATURES
+
+
+def write_dataset(path, rows):
+    pd.DataFrame(rows, columns=list(CROP_FEATURES) + ["label"]).to_csv(path, index=False)
+
+
+ROWS = [
+    [90, 42, 43, 20.8, 82.0, 6.5, 202.9, "rice"],
+    [85, 58, 41, 21.7, 80.3, 7.0, 226.6, "rice"],
+    [20, 67, 20, 22.6, 63.7, 5.7, 87.7, "maize"],
+    [22, 60, 18, 26.1, 65.0, 6.0, 80.1, "maize"],
+    [40, 72, 77, 17.0, 16.9, 7.4, 88.5, "chickpea"]
+]
+
+
+def test_query_returns_nearest_samples_first(tmp_path):
+    csv_path = tmp_path / "crops.csv"
+    write_dataset(csv_path, ROWS)
+    index = CropNeighborIndex(str(csv_path), str(tmp_path / "index" / "crops.joblib"))
+    assert index.load() == len(ROWS)
+
+    rows = [ROWS[2][:-1], ROWS[0][:-1]]
+    results = index.query(rows, k=3)
+    assert [r["crop"] for r in results[0][:2]] == ["maize", "maize"]
+    assert results[0][0]["sample"] == 2 and results[0][0]["distance"] == 0.0
+    assert results[1][0]["crop"] == "rice"
+    for neighbours in results:
+        distances = [n["distance"] for n in neighbours]
+        assert distances == sorted(distances)
+    assert results[0][0]["features"]["N"] == 20
+    assert index.stats() == {"loaded": True, "samples": len(ROWS), "queries": 2}
+
+
+def test_k_is_capped(tmp_path, monkeypatch):
+    csv_path = tmp_path / "crops.csv"
+    write_dataset(csv_path, ROWS)
+    index = CropNeighborIndex(str(csv_path), str(tmp_path / "crops.joblib"))
+    index.load()
+    assert len(index.query([ROWS[0][:-1]], k=100)[0]) == len(ROWS)
+    monkeypatch.setattr(crop_neighbors, "MAX_NEIGHBORS", 2)
+    assert len(index.query([ROWS[0][:-1]], k=100)[0]) == 2
+    assert len(index.query([ROWS[0][:-1]], k=0)[0]) == 1
+
+
+def test_index_is_rebuilt_when_dataset_changes(tmp_path):
+    csv_path = tmp_path / "crops.csv"
+    index_path = str(tmp_path / "crops.joblib")
+    write_dataset(csv_path, ROWS[:3])
+    assert CropNeighborIndex(str(csv_path), index_path).load() == 3
+
+    write_dataset(csv_path, ROWS)
+    index = CropNeighborIndex(str(csv_path), index_path)
+    assert index.load() == len(ROWS)
+    assert index.query([ROWS[4][:-1]], k=1)[0][0]["crop"] == "chickpea"
+
+
+def test_missing_dataset_disables_lookups(tmp_path):
+    index = CropNeighborIndex(str(tmp_path / "missing.csv"), str(tmp_path / "crops.joblib"))
+    assert index.load() == 0
+    assert not index.ready
+    assert index.stats()["loaded"] is False
@@ -0,0 +1,135 @@
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+from sklearn.linear_model import LogisticRegression
+
+import main
+import ml_utils
+from auth import verify_supabase_token
+from ml_utils import CropPredictionCache, recommend_crops
+
+ROWS = [
+    [90, 42, 43, 20.8, 82.0, 6.5, 202.9],
+    [85, 58, 41, 21.7, 80.3, 7.0, 226.6],
+    [20, 67, 20, 22.6, 63.7, 5.7, 87.7],
+    [22, 60, 18, 26.1, 65.0, 6.0, 80.1],
+    [40, 72, 77, 17.0, 16.9, 7.4, 88.5],
+    [43, 70, 80, 18.2, 15.0, 7.1, 90.3]
+]
+LABELS = ["rice", "rice", "maize", "maize", "chickpea", "chickpea"]
+
+
+class Handle:
+    def __init__(self, model, version="v1"):
+        self.model = model
+        self.version = version
+
+
+@pytest.fixture
+def handle(monkeypatch):
+    monkeypatch.setattr(ml_utils, "crop_prediction_cache", CropPredictionCache(max_entries=16))
+    model = LogisticRegression(max_iter=2000).fit(np.array(ROWS), LABELS)
+    return Handle(model)
+
+
+def test_top_k_is_ordered_by_probability(handle):
+    results = recommend_crops(handle, ROWS[:3], top_k=3)
+    assert len(results) == 3
+    for result in results:
+        probabilities = [entry["probability"] for entry in result["top_k"]]
+        assert probabilities == sorted(probabilities, reverse=True)
+        assert len({entry["crop"] for entry in result["top_k"]}) == 3
+        assert result["recommended_crop"] == result["top_k"][0]["crop"]
+        assert result["confidence"] == result["top_k"][0]["probability"]
+    assert [result["recommended_crop"] for result in results] == LABELS[:3]
+
+
+def test_top_k_is_capped_at_the_number_of_classes(handle):
+    result = recommend_crops(handle, ROWS[:1], top_k=10)[0]
+    assert len(result["top_k"]) == 3
+
+
+def test_probabilities_match_predict_proba(handle):
+    row = [60.3, 55.2, 50.4, 21.04, 70.2, 6.53, 150.7]
+    result = recommend_crops(handle, [row], top_k=3)[0]
+    # The model sees the row rounded to the cache precision
+    expected = handle.model.predict_proba(ml_utils.crop_prediction_cache.quantize([row]))[0]
+    by_crop = dict(zip(handle.model.classes_, expected))
+    for entry in result["top_k"]:
+        assert entry["probability"] == round(float(by_crop[entry["crop"]]), 4)
+
+
+def test_single_recommendation_goes_through_admission(handle, monkeypatch):
+    admitted = []
+
+    async def run(priority_class, user_key, fn, *args, **kwargs):
+        admitted.append((priority_class, user_key))
+        return fn(*args, **kwargs)
+
+    class Registry:
+        def acquire(self, kind):
+            class Context:
+                def __enter__(self):
+                    return handle
+
+                def __exit__(self, *exc):
+                    return False
+            return Context()
+
+    monkeypatch.setattr(main, "get_crop_model", lambda: handle.model)
+    monkeypatch.setattr(main, "model_registry", Registry())
+    monkeypatch.setattr(main.inference_admission, "run", run)
+    main.app.dependency_overrides[verify_supabase_token] = lambda: {"user_id": None}
+    try:
+        features = dict(zip(["N", "P", "K", "temperature", "humidity", "ph", "rainfall"], ROWS[2]))
+        response = TestClient(main.app).post("/api/crop-recommendation", params={"top_k": 2}, json=features)
+    finally:
+        main.app.dependency_overrides.clear()
+
+    assert response.status_code == 200
+    assert admitted == [("interactive", None)]
+    body = response.json()
+    assert body["recommended_crop"] == "maize"
+    assert len(body["top_k"]) == 2 and body["model_version"] == "v1"
+
+
+def test_nearby_inputs_share_a_cache_entry(handle):
+    cache = ml_utils.crop_prediction_cache
+    precision = dict(zip(ml_utils.CROP_FEATURES, cache.precision.tolist()))
+    assert precision["N"] == 0 and precision["temperature"] == 1
+
+    recommend_crops(handle, [[60.2, 55, 50, 21.04, 70, 6.53, 150.3]])
+    # Differences below each column's precision round to the same key
+    recommend_crops(handle, [[59.8, 55, 50, 20.96, 70, 6.47, 149.9]])
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_distinct_inputs_get_their_own_entries(handle):
+    cache = ml_utils.crop_prediction_cache
+    recommend_crops(handle, [[60, 55, 50, 21.0, 70, 6.5, 150]])
+    recommend_crops(handle, [[61, 55, 50, 21.0, 70, 6.5, 150], [60, 55, 50, 21.2, 70, 6.5, 150]])
+    stats = cache.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"]) == (3, 0, 3)
+
+
+def test_cache_empties_when_the_model_version_changes(handle):
+    cache = ml_utils.crop_prediction_cache
+    row = [60, 55, 50, 21.0, 70, 6.5, 150]
+    recommend_crops(handle, [row])
+    recommend_crops(handle, [row])
+    assert cache.stats()["hits"] == 1
+
+    # A reloaded model with different weights must not be served the old probabilities
+    retrained = LogisticRegression(max_iter=2000, C=0.01).fit(np.array(ROWS), LABELS)
+    result = recommend_crops(Handle(retrained, version="v2"), [row], top_k=3)[0]
+    stats = cache.stats()
+    assert stats["invalidations"] == 1
+    assert stats["model_version"] == "v2"
+    assert (stats["entries"], stats["hits"]) == (1, 1)
+    expected = retrained.predict_proba(cache.quantize([row]))[0].max()
+    assert result["confidence"] == round(float(expected), 4)
+
+    # Results computed against the old version are not stored under the new one
+    cache.store("v1", [tuple(row)], [np.zeros(3)])
+    assert cache.stats()["entries"] == 1
@@ -0,0 +1,100 @@
+import hashlib
+
+import pytest
+from storage3.exceptions import StorageApiError
+
+import database
+from database import ObjectIndex, content_key, insert_history
+
+
+class FakeTable:
+    def __init__(self, client, name):
+        self.client, self.name = client, name
+
+    def insert(self, data):
+        self.client.inserts.append((self.name, dict(data)))
+        self.data = data
+        return self
+
+    def execute(self):
+        if "model_version" in self.data and self.name in self.client.missing_column:
+            raise Exception(f"Could not find the 'model_version' column of '{self.name}' in the schema cache")
+        return self.data
+
+
+class FakeSupabase:
+    def __init__(self, missing_column=()):
+        self.missing_column = set(missing_column)
+        self.inserts = []
+
+    def table(self, name):
+        return FakeTable(self, name)
+
+
+def test_insert_history_keeps_model_version_when_column_exists(monkeypatch):
+    monkeypatch.setattr(database, "supabase", FakeSupabase())
+    monkeypatch.setattr(database, "TABLES_WITHOUT_MODEL_VERSION", set())
+    assert insert_history("weed_detections", {"weed_count": 1, "model_version": "v1"})["model_version"] == "v1"
+
+
+def test_insert_history_drops_model_version_on_unmigrated_schema(monkeypatch):
+    client = FakeSupabase(missing_column={"weed_detections"})
+    monkeypatch.setattr(database, "supabase", client)
+    monkeypatch.setattr(database, "TABLES_WITHOUT_MODEL_VERSION", set())
+
+    assert insert_history("weed_detections", {"weed_count": 1, "model_version": "v1"}) == {"weed_count": 1}
+    # Later rows skip the column without a failed round trip first
+    insert_history("weed_detections", {"weed_count": 2, "model_version": "v1"})
+    assert client.inserts[-1] == ("weed_detections", {"weed_count": 2})
+    assert len(client.inserts) == 3
+
+
+def test_content_key_is_sharded_by_hash_under_the_owner():
+    digest = hashlib.sha256(b"frame").hexdigest()
+    assert content_key("alice", b"frame", "jpg") == f"alice/objects/{digest[:2]}/{digest}.jpg"
+    # A hash computed during ingest is used as is
+    assert content_key("alice", b"ignored", "png", content_hash=digest) == f"alice/objects/{digest[:2]}/{digest}.png"
+    # The same image from two users is two objects
+    assert content_key("bob", b"frame", "jpg") != content_key("alice", b"frame", "jpg")
+
+
+class FakeStorage:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def create_bucket(self, name, options=None):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.mark.parametrize("error, known", [
+    (None, True),
+    (StorageApiError("The resource already exists", "Duplicate", "409"), True),
+    (StorageApiError("new row violates row-level security policy", "Unauthorized", 403), False),
+    (RuntimeError("connection reset"), False)
+])
+def test_ensure_bucket_trusts_the_status_code(monkeypatch, error, known):
+    storage = FakeStorage(error)
+    monkeypatch.setattr(database, "supabase", type("Client", (), {"storage": storage})())
+    monkeypatch.setattr(database, "KNOWN_BUCKETS", set())
+    database.ensure_bucket("input-images")
+    database.ensure_bucket("input-images")
+    # A known bucket is not created again; an unknown one is retried on the next upload
+    assert storage.calls == (1 if known else 2)
+
+
+def test_object_index_evicts_least_recently_used():
+    index = ObjectIndex(max_entries=2)
+    index.add("weed-images", "a")
+    index.add("weed-images", "b")
+    assert index.contains("weed-images", "a")
+    index.add("weed-images", "c")
+    assert not index.contains("weed-images", "b")
+    assert index.contains("weed-images", "a") and index.contains("weed-images", "c")
+    assert not index.contains("crop-images", "a")
+
+    index.record(uploaded=True, size=100)
+    index.record(uploaded=False, size=100)
+    assert index.stats() == {"known_objects": 2, "uploads": 1, "deduplicated": 1, "bytes_saved": 100}
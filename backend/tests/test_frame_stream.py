@@ -0,0 +1,144 @@
+import asyncio
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+import frame_stream
+from frame_stream import DeviceStream, MJPEGFrameSplitter, shutdown_streams
+
+
+def jpeg(value=0):
+    ok, buffer = cv2.imencode('.jpg', np.full((32, 32, 3), value, dtype=np.uint8))
+    return buffer.tobytes()
+
+
+def test_splitter_extracts_frames_across_chunks():
+    a, b = jpeg(0), jpeg(255)
+    stream = b"--frame\r\nContent-Type: image/jpeg\r\n\r\n" + a + b"\r\n--frame\r\n\r\n" + b
+    splitter = MJPEGFrameSplitter()
+    frames = []
+    for i in range(0, len(stream), 7):
+        frames += splitter.feed(stream[i:i + 7])
+    assert frames == [a, b]
+
+
+class FakeStats:
+    def __init__(self):
+        self.calls = []
+
+    def record(self, weed_count, classes, confidences, **scopes):
+        self.calls.append((weed_count, list(classes), scopes))
+
+
+class FakeBudget:
+    def __init__(self):
+        self.reserved = []
+
+    def reserve(self, nbytes):
+        budget = self
+
+        class Reservation:
+            async def __aenter__(self):
+                budget.reserved.append(nbytes)
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Reservation()
+
+
+def test_worker_uses_memory_budget_and_records_stats(monkeypatch):
+    stats, budget = FakeStats(), FakeBudget()
+    monkeypatch.setattr(frame_stream, "weed_stats", stats)
+    monkeypatch.setattr(frame_stream, "image_memory_budget", budget)
+
+    class Handle:
+        model = object()
+
+    class Registry:
+        def acquire(self, kind):
+            class Context:
+                def __enter__(self):
+                    return Handle()
+
+                def __exit__(self, *exc):
+                    return False
+            return Context()
+
+    async def run(priority, key, fn, model, frame):
+        return {"detections": 2, "annotated_jpeg": b"x", "classes": ["weed", "weed"], "confidences": [0.9, 0.8]}
+
+    monkeypatch.setattr(frame_stream, "model_registry", Registry())
+    monkeypatch.setattr(frame_stream.inference_admission, "run", run)
+
+    async def scenario():
+        stream = DeviceStream("cam-1")
+        assert await stream.offer(jpeg(0)) == "queued"
+        await stream.queue.join()
+        await stream.shutdown()
+        return stream
+
+    stream = asyncio.run(scenario())
+    assert stream.processed == 1
+    assert budget.reserved and budget.reserved[0] > 32 * 32 * 3
+    assert stats.calls == [(2, ["weed", "weed"], {"device_id": "cam-1"})]
+
+
+def test_shutdown_streams_cancels_idle_workers(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(frame_stream, "DEVICE_STREAMS", {})
+        stream = frame_stream.get_device_stream("cam-2")
+        # A worker waiting on an empty queue until the stream window expires
+        stream.ensure_worker()
+        worker = stream.worker
+        await asyncio.sleep(0)
+        await shutdown_streams()
+        return worker, stream
+
+    worker, stream = asyncio.run(scenario())
+    assert worker.cancelled()
+    assert stream.worker is None
+
+
+def test_offer_hashes_off_the_event_loop_and_drops_duplicates(monkeypatch):
+    hashed_on = []
+    real_dhash = frame_stream.dhash
+
+    def dhash(frame):
+        hashed_on.append(threading.get_ident())
+        return real_dhash(frame)
+
+    monkeypatch.setattr(frame_stream, "dhash", dhash)
+    monkeypatch.setattr(DeviceStream, "ensure_worker", lambda self: None)
+
+    async def scenario():
+        stream = DeviceStream("cam-3")
+        first = await stream.offer(jpeg(0))
+        stream.queue.get_nowait()
+        # The stride resets after the first accepted frame
+        second = await stream.offer(jpeg(0))
+        return first, second, threading.get_ident()
+
+    first, second, loop_thread = asyncio.run(scenario())
+    assert (first, second) == ("queued", "skipped_duplicate")
+    assert hashed_on and loop_thread not in hashed_on
+
+
+def test_idle_streams_are_evicted_and_new_devices_capped(monkeypatch):
+    monkeypatch.setattr(frame_stream, "DEVICE_STREAMS", {})
+    monkeypatch.setattr(frame_stream, "STREAM_MAX_DEVICES", 2)
+    monkeypatch.setattr(frame_stream, "STREAM_IDLE_SECONDS", 60)
+
+    busy = frame_stream.get_device_stream("cam-a")
+    busy.connections = 1
+    stale = frame_stream.get_device_stream("cam-b")
+    with pytest.raises(frame_stream.StreamCapacityError):
+        frame_stream.get_device_stream("cam-c")
+
+    # Once cam-b has been quiet past the idle timeout it makes room for a new device
+    stale.last_active -= 120
+    busy.last_active -= 120
+    assert frame_stream.get_device_stream("cam-c").device_id == "cam-c"
+    assert sorted(frame_stream.DEVICE_STREAMS) == ["cam-a", "cam-c"]
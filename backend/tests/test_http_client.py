@@ -0,0 +1,90 @@
+import asyncio
+
+import httpx
+import pytest
+
+import database
+import http_client
+from database import SupabaseBackend
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    """Clients built by http_client answer from a mock transport; records clients and requests"""
+    created, requests = [], []
+    real_client = httpx.AsyncClient
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(200, json={"id": "user-1", "email": "a@example.com"})
+
+    def make_client(**kwargs):
+        client = real_client(transport=httpx.MockTransport(handler), **kwargs)
+        created.append(client)
+        return client
+
+    monkeypatch.setattr(http_client.httpx, "AsyncClient", make_client)
+    monkeypatch.setattr(http_client, "_async_client", None)
+    monkeypatch.setattr(database, "SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.setattr(database, "SUPABASE_ANON_KEY", "anon")
+    return created, requests
+
+
+def test_token_verification_reuses_the_started_client(pool):
+    created, requests = pool
+
+    async def scenario():
+        client = await http_client.start_http_client()
+        users = [await SupabaseBackend.verify_jwt(f"token-{i}") for i in range(3)]
+        return client, users
+
+    client, users = asyncio.run(scenario())
+    assert [user["id"] for user in users] == ["user-1"] * 3
+    assert len(requests) == 3
+    assert created == [client]
+    assert http_client.get_http_client() is client
+
+
+def test_start_is_idempotent_and_shutdown_closes_the_pool(pool):
+    created, _ = pool
+
+    async def scenario():
+        first = await http_client.start_http_client()
+        second = await http_client.start_http_client()
+        await http_client.close_http_client()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is second and created == [first]
+    assert first.is_closed
+    assert http_client._async_client is None
+
+
+def test_client_is_recreated_after_shutdown(pool):
+    created, _ = pool
+
+    async def scenario():
+        before = http_client.get_http_client()
+        await http_client.close_http_client()
+        # Calls after shutdown (scripts, tests) get a fresh pool instead of a closed one
+        after = http_client.get_http_client()
+        await http_client.close_http_client()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    assert before is not after and before.is_closed and after.is_closed
+    assert created == [before, after]
+
+
+def test_sync_client_is_shared(monkeypatch):
+    monkeypatch.setattr(http_client, "_sync_client", None)
+    client = http_client.get_sync_client()
+    try:
+        assert http_client.get_sync_client() is client
+        assert client.timeout == http_client.STORAGE_TIMEOUT
+    finally:
+        client.close()
+    # A closed pool is replaced on next use
+    replacement = http_client.get_sync_client()
+    assert replacement is not client
+    replacement.close()
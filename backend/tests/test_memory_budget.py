@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionRejected
+from memory_budget import MemoryBudget, estimate_image_bytes
+
+
+def test_memory_budget_waits_then_rejects():
+    async def scenario():
+        budget = MemoryBudget(limit=100, timeout=0.1)
+        async with budget.reserve(80):
+            with pytest.raises(AdmissionRejected):
+                async with budget.reserve(40):
+                    pass
+        async with budget.reserve(40):
+            in_flight = budget.stats()["in_flight_bytes"]
+        return in_flight, budget.stats()
+
+    in_flight, stats = asyncio.run(scenario())
+    assert in_flight == 40
+    assert stats["in_flight_bytes"] == 0
+    assert stats["rejected"] == 1 and stats["peak_in_flight_bytes"] == 80
+
+
+def test_memory_budget_wakes_waiter_on_release():
+    async def scenario():
+        budget = MemoryBudget(limit=100, timeout=1)
+        order = []
+
+        async def hold(nbytes, name, seconds):
+            async with budget.reserve(nbytes):
+                order.append(name)
+                await asyncio.sleep(seconds)
+
+        await asyncio.gather(hold(70, "first", 0.05), hold(70, "second", 0))
+        return order, budget.stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order == ["first", "second"]
+    assert stats["waited"] == 1 and stats["peak_in_flight_bytes"] == 70
+
+
+def test_oversized_request_is_capped_at_the_budget():
+    async def scenario():
+        budget = MemoryBudget(limit=100, timeout=0.1)
+        async with budget.reserve(10_000):
+            return budget.stats()["in_flight_bytes"]
+
+    assert asyncio.run(scenario()) == 100
+
+
+def test_estimate_adds_tile_batch():
+    base = estimate_image_bytes(1000, 100, 100)
+    assert base == 3 * 1000 + 2 * 100 * 100 * 3
+    assert estimate_image_bytes(1000, 100, 100, tile_size=64) > base
+
+
+def test_top_up_stays_within_the_limit():
+    budget = MemoryBudget(limit=100, timeout=0.1)
+    assert budget.top_up(60, 20) == 40
+    assert budget.top_up(500, 20) == 80
+    assert budget.top_up(10, 20) == 0
+    assert MemoryBudget(limit=0).top_up(60, 20) == 0
+
+
+def test_growing_reservation_is_served_before_new_requests():
+    async def scenario():
+        budget = MemoryBudget(limit=100, timeout=1)
+        order = []
+        other_done = asyncio.Event()
+
+        async def other():
+            async with budget.reserve(50):
+                await other_done.wait()
+
+        async def newcomer():
+            async with budget.reserve(50):
+                order.append("newcomer")
+
+        async def holder():
+            async with budget.reserve(40):
+                await asyncio.sleep(0.02)
+                # Grows after the newcomer queued, but is served first
+                async with budget.reserve(20, holding=True):
+                    order.append("holder")
+
+        tasks = [asyncio.create_task(other()), asyncio.create_task(holder())]
+        await asyncio.sleep(0.01)
+        tasks.append(asyncio.create_task(newcomer()))
+        await asyncio.sleep(0.03)
+        other_done.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(scenario()) == ["holder", "newcomer"]
@@ -0,0 +1,13 @@
+from metrics import percentile
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 95) == 95
+    assert percentile(values, 100) == 100
+
+
+def test_percentile_small_samples_stay_in_range():
+    assert percentile([7], 99) == 7
+    assert percentile([1, 2], 0) == 1
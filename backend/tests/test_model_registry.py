@@ -0,0 +1,57 @@
+import asyncio
+import os
+
+import pytest
+
+from model_registry import ModelRegistry, ModelSpec
+
+
+@pytest.fixture
+def registry(tmp_path):
+    version_dir = tmp_path / "weed" / "v1.2_rc-1"
+    version_dir.mkdir(parents=True)
+    (version_dir / "model.onnx").write_bytes(b"onnx")
+    spec = ModelSpec("weed", str(tmp_path / "weed_detection_model.onnx"), (".onnx",), lambda path: path, lambda model: None)
+    return ModelRegistry(str(tmp_path), [spec])
+
+
+def test_versioned_artifact_resolves_version_dir(registry, tmp_path):
+    path, version = registry.resolve("weed", "v1.2_rc-1")
+    assert version == "v1.2_rc-1"
+    assert path == os.path.join(str(tmp_path), "weed", "v1.2_rc-1", "model.onnx")
+
+
+@pytest.mark.parametrize("version", ["../weed", "..", ".", "v1/../../etc", "/etc", "v1\\x", "v 1", ""])
+def test_versioned_artifact_rejects_path_like_versions(registry, version):
+    with pytest.raises(ValueError):
+        registry._versioned_artifact("weed", version)
+
+
+def test_strict_load_raises_on_invalid_version(registry):
+    with pytest.raises(ValueError):
+        registry._load("weed", "../../secrets", strict=True)
+    assert registry._load("weed", "../../secrets") is None
+
+
+def test_retired_model_is_kept_until_its_last_request_finishes(registry, monkeypatch):
+    import model_registry
+
+    monkeypatch.setattr(model_registry, "DRAIN_TIMEOUT", 0.05)
+    asyncio.run(registry.reload("weed", "v1.2_rc-1"))
+    old = registry.current("weed")
+    with registry.acquire("weed") as held:
+        assert held is old
+        asyncio.run(registry.reload("weed", "v1.2_rc-1"))
+        # Drain timed out with the request still running; its model must stay usable
+        assert registry.current("weed") is not old
+        assert held.model is not None
+    assert old.model is None
+    assert old.inflight == 0
+
+
+def test_idle_model_is_released_on_swap(registry):
+    asyncio.run(registry.reload("weed", "v1.2_rc-1"))
+    old = registry.current("weed")
+    asyncio.run(registry.reload("weed", "v1.2_rc-1"))
+    assert old.model is None
+    assert registry.current("weed").model is not None
@@ -0,0 +1,75 @@
+import os
+import time
+
+from result_cache import WeedResultCache
+
+
+def put(cache, key, size=10, detections=1):
+    return cache.put(key, detections=detections, annotated_jpeg=b"j" * size, classes=["weed"], confidences=[0.9])
+
+
+def test_keys_separate_model_versions_and_variants():
+    digest = WeedResultCache.hash_image(b"frame")
+    keys = {
+        WeedResultCache.make_key(digest, "v1"),
+        WeedResultCache.make_key(digest, "v2"),
+        WeedResultCache.make_key(digest, "v1", "tiled640x0.2"),
+        WeedResultCache.make_key(digest, "v1", "tiled1024x0.2"),
+        WeedResultCache.make_key(WeedResultCache.hash_image(b"other"), "v1")
+    }
+    assert len(keys) == 5
+
+
+def test_memory_tier_evicts_least_recently_used_by_count():
+    cache = WeedResultCache(max_entries=2)
+    put(cache, "a")
+    put(cache, "b")
+    assert cache.get("a") is not None
+    put(cache, "c")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["entries"] == 2
+
+
+def test_memory_tier_evicts_by_bytes():
+    cache = WeedResultCache(max_entries=10, max_bytes=25)
+    put(cache, "a", size=10)
+    put(cache, "b", size=10)
+    put(cache, "c", size=10)
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 20
+    # An entry larger than the whole budget is not kept in memory
+    put(cache, "huge", size=30)
+    assert cache.get("huge") is None
+    assert cache.stats()["bytes"] == 20
+
+
+def test_disk_tier_roundtrip(tmp_path):
+    cache = WeedResultCache(disk_dir=str(tmp_path))
+    put(cache, "v1-abc", size=5, detections=3)
+    cache.remember_uploads("v1-abc", "alice", "https://in", "https://out")
+
+    restarted = WeedResultCache(disk_dir=str(tmp_path))
+    entry = restarted.get("v1-abc")
+    assert entry["detections"] == 3 and entry["annotated_jpeg"] == b"jjjjj"
+    assert entry["classes"] == ["weed"] and entry["confidences"] == [0.9]
+    assert entry["uploads"] == {"alice": {"input": "https://in", "output": "https://out"}}
+    assert restarted.stats()["hits"] == 1
+    # No temp files are left behind
+    assert sorted(os.listdir(tmp_path)) == ["v1-abc.jpg", "v1-abc.json"]
+
+
+def test_disk_tier_evicts_oldest_entries(tmp_path):
+    cache = WeedResultCache(disk_dir=str(tmp_path), max_disk_bytes=2500)
+    for i, key in enumerate(("a", "b", "c")):
+        put(cache, key, size=1000)
+        # Deterministic ages: a is the oldest
+        for ext in (".jpg", ".json"):
+            past = time.time() - 100 + i
+            os.utime(tmp_path / f"{key}{ext}", (past, past))
+    put(cache, "d", size=1000)
+
+    assert sorted(os.listdir(tmp_path)) == ["c.jpg", "c.json", "d.jpg", "d.json"]
+    assert cache.stats()["disk_evictions"] == 2
+    assert cache.stats()["disk_bytes"] <= 2500
+    assert WeedResultCache(disk_dir=str(tmp_path)).get("a") is None
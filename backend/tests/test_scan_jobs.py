@@ -0,0 +1,61 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import scan_jobs
+from scan_jobs import ScanJobStore
+
+
+def test_assign_device_moves_job_until_frames_arrive(tmp_path):
+    store = ScanJobStore(str(tmp_path / "scan_jobs.db"))
+    older = store.create_job("cam-2", "bob", None, 8)
+    job = store.create_job("default", "alice", None, 8)
+
+    moved = store.assign_device(job["id"], "cam-2")
+    assert moved["device_id"] == "cam-2"
+    # The camera's own unfinished scan is superseded, as when a scan is started on it directly
+    assert store.get_job(older["id"])["status"] == "processing"
+    assert store.latest_job("cam-2")["id"] == job["id"]
+    assert store.latest_user_job("alice")["id"] == job["id"]
+
+    store.add_task("cam-2", "a" * 64, str(tmp_path / "frame.jpg"))
+    assert store.assign_device(job["id"], "cam-3") is None
+    assert store.get_job(job["id"])["device_id"] == "cam-2"
+
+
+@pytest.fixture
+def device_client(tmp_path, monkeypatch):
+    import main
+    from auth import verify_supabase_token
+    from routers import device
+
+    async def create_field_scan(user_id):
+        return {}
+
+    monkeypatch.setenv("USE_HARDWARE_FALLBACK", "false")
+    monkeypatch.setattr(scan_jobs.SupabaseDB, "create_field_scan", create_field_scan)
+    monkeypatch.setattr(main.scan_orchestrator, "store", ScanJobStore(str(tmp_path / "scan_jobs.db")))
+    monkeypatch.setattr(device, "COMMAND_QUEUE", {})
+    monkeypatch.setattr(device, "PENDING_SCAN_JOBS", {})
+    main.app.dependency_overrides[verify_supabase_token] = lambda: {"user_id": "alice"}
+    yield TestClient(main.app), main.scan_orchestrator.store
+    main.app.dependency_overrides.pop(verify_supabase_token, None)
+
+
+def test_scan_job_is_keyed_by_the_polling_camera(device_client):
+    client, store = device_client
+    job_id = client.post("/api/device/command/weed-scan").json()["job_id"]
+
+    assert client.get("/api/device/check-command", headers={"X-Device-ID": "cam-7"}).json() == "START_WEED_SCAN"
+    assert store.get_job(job_id)["device_id"] == "cam-7"
+    # The command was claimed once
+    assert client.get("/api/device/check-command").json() == "STOP"
+    assert client.get(f"/api/device/weed-scan/jobs/{job_id}").json()["device_id"] == "cam-7"
+
+
+def test_scan_for_a_named_camera_waits_for_it(device_client):
+    client, store = device_client
+    job_id = client.post("/api/device/command/weed-scan", params={"device_id": "cam-9"}).json()["job_id"]
+
+    assert client.get("/api/device/check-command", headers={"X-Device-ID": "cam-1"}).json() == "STOP"
+    assert client.get("/api/device/check-command", headers={"X-Device-ID": "cam-9"}).json() == "START_WEED_SCAN"
+    assert store.get_job(job_id)["device_id"] == "cam-9"
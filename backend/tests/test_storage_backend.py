@@ -0,0 +1,19 @@
+import pytest
+
+from database import StorageBackend, SupabaseBackend
+from local_storage import LocalStorageBackend
+
+
+def test_incomplete_backend_cannot_be_constructed():
+    class Partial(StorageBackend):
+        async def verify_jwt(self, token):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_shipped_backends_implement_the_interface():
+    assert not SupabaseBackend.__abstractmethods__
+    assert not LocalStorageBackend.__abstractmethods__
+
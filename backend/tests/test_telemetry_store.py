@@ -0,0 +1,245 @@
+import time
+
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from auth import verify_supabase_token
+from routers import device
+from scan_jobs import ScanJobStore
+from telemetry_store import (
+    METRICS, RECORD_DTYPE, TELEMETRY_MAX_AGE, DeviceSeries, TelemetryStore, TelemetryStoreFull, decode_records
+)
+
+
+def block(timestamps, offset=0.0):
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+    return timestamps, {metric: (timestamps + offset).astype(np.float32) for metric in METRICS}
+
+
+def test_ring_wraps_and_keeps_newest():
+    series = DeviceSeries(capacity=5)
+    for start in (0, 3, 6):
+        series.append_many(*block(np.arange(start, start + 3)))
+    timestamps, values = series.ordered_view()
+    assert timestamps.tolist() == [4, 5, 6, 7, 8]
+    assert values["ph"].tolist() == [4, 5, 6, 7, 8]
+    assert series.size == 5
+
+
+def test_block_larger_than_capacity_keeps_newest():
+    series = DeviceSeries(capacity=4)
+    series.append_many(*block([9, 1, 8, 2, 7, 3]))
+    timestamps, _ = series.ordered_view()
+    assert timestamps.tolist() == [3, 7, 8, 9]
+
+
+def test_out_of_order_readings_are_sorted_on_read():
+    series = DeviceSeries(capacity=6)
+    series.append_many(*block([10, 11, 12]))
+    series.append_many(*block([5, 13]))
+    timestamps, values = series.ordered_view()
+    assert timestamps.tolist() == [5, 10, 11, 12, 13]
+    assert values["N"].tolist() == [5, 10, 11, 12, 13]
+
+
+def test_query_downsamples_into_buckets():
+    store = TelemetryStore(path="unused.npz", capacity=100)
+    store.append_many("d1", *block(np.arange(0, 10)))
+    result = store.query("d1", 0, 10, buckets=2)
+    assert result["bucket_seconds"] == 5
+    assert result["readings"] == 10
+    first, second = result["points"]
+    assert (first["t"], first["count"]) == (0, 5)
+    assert first["N"] == {"min": 0, "max": 4, "mean": 2}
+    assert (second["t"], second["count"]) == (5, 5)
+    assert second["N"] == {"min": 5, "max": 9, "mean": 7}
+
+
+def test_query_skips_empty_buckets_and_window_edges():
+    store = TelemetryStore(path="unused.npz", capacity=100)
+    store.append_many("d1", *block([0, 1, 8, 9, 20]))
+    result = store.query("d1", 0, 10, buckets=5)
+    assert [(point["t"], point["count"]) for point in result["points"]] == [(0, 2), (8, 2)]
+    # end is exclusive, so the reading at t=20 is outside the window
+    assert result["readings"] == 4
+
+
+def test_save_and_load_round_trip(tmp_path, monkeypatch):
+    monkeypatch.delenv("WORKER_SLOT", raising=False)
+    store = TelemetryStore(path=str(tmp_path / "telemetry.npz"), capacity=3)
+    store.append_many("d1", *block([1, 2, 3, 4]))
+    assert store.save()
+    restored = TelemetryStore(path=str(tmp_path / "telemetry.npz"), capacity=3)
+    assert restored.load() == 1
+    assert restored.series["d1"].ordered_view()[0].tolist() == [2, 3, 4]
+
+
+def test_each_worker_persists_its_own_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "telemetry.npz")
+    for slot, device_id in (("0", "a"), ("1", "b")):
+        monkeypatch.setenv("WORKER_SLOT", slot)
+        store = TelemetryStore(path=path)
+        store.append("d-" + device_id, {metric: 1.0 for metric in METRICS}, timestamp=1.0)
+        store.save()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["telemetry.npz", "telemetry.worker1.npz"]
+    restored = TelemetryStore(path=path)
+    assert restored.load() == 1 and restored.devices() == ["d-b"]
+
+
+def test_buffers_grow_with_the_data_up_to_capacity():
+    series = DeviceSeries(capacity=1000)
+    assert series.allocated < 1000
+    series.append_many(*block(np.arange(700)))
+    assert 700 <= series.allocated < 1000
+    series.append_many(*block(np.arange(700, 1200)))
+    assert series.allocated == 1000
+    timestamps, values = series.ordered_view()
+    np.testing.assert_array_equal(timestamps, np.arange(200, 1200))
+    np.testing.assert_array_equal(values["N"], np.arange(200, 1200))
+
+
+def test_growth_keeps_wrapped_readings_in_order():
+    series = DeviceSeries(capacity=1000)
+    small = series.allocated
+    series.append_many(*block(np.arange(small - 10)))
+    series.append_many(*block(np.arange(small - 10, small + 10)))
+    timestamps, _ = series.ordered_view()
+    np.testing.assert_array_equal(timestamps, np.arange(small + 10))
+
+
+def test_store_refuses_devices_beyond_the_cap():
+    store = TelemetryStore(path="unused.npz", capacity=100, max_devices=2)
+    store.append_many("a", *block([1.0]))
+    store.append_many("b", *block([1.0]))
+    with pytest.raises(TelemetryStoreFull):
+        store.append_many("c", *block([1.0]))
+    # Known devices keep recording
+    store.append_many("a", *block([2.0]))
+    assert sorted(store.series) == ["a", "b"]
+
+
+def pack(rows):
+    """Bulk upload body from (timestamp, N, P, K, ph) tuples"""
+    return np.array(rows, dtype=RECORD_DTYPE).tobytes()
+
+
+def test_decode_records_keeps_valid_readings():
+    now = 1_700_000_000.0
+    payload = pack([(now - 60, 90, 42, 43, 6.5), (now - 30, 85, 58, 41, 7.0)])
+    timestamps, values, rejected = decode_records(payload, now=now)
+    np.testing.assert_array_equal(timestamps, [now - 60, now - 30])
+    np.testing.assert_array_equal(values["N"], [90, 85])
+    np.testing.assert_allclose(values["ph"], [6.5, 7.0])
+    assert rejected == 0
+
+
+def test_decode_records_counts_rejected_readings():
+    now = 1_700_000_000.0
+    payload = pack([
+        (now - 60, 90, 42, 43, 6.5),                   # kept
+        (now - TELEMETRY_MAX_AGE - 1, 90, 42, 43, 6.5),  # too old
+        (now + 3600, 90, 42, 43, 6.5),                 # too far in the future
+        (now - 10, 90, 42, 43, 15.0),                  # pH out of range
+        (now - 10, float("nan"), 42, 43, 6.5),         # not finite
+        (now - 10, -1, 42, 43, 6.5)                    # negative nutrient
+    ])
+    timestamps, values, rejected = decode_records(payload, now=now)
+    assert len(timestamps) == 1 and rejected == 5
+    assert all(len(values[metric]) == 1 for metric in METRICS)
+
+
+def test_decode_records_rejects_partial_records():
+    with pytest.raises(ValueError):
+        decode_records(pack([(1.0, 1, 1, 1, 7)]) + b"\x00" * 5)
+    assert len(decode_records(b"")[0]) == 0
+
+
+@pytest.fixture
+def telemetry_client(monkeypatch, tmp_path):
+    store = TelemetryStore(path="unused.npz", capacity=1000)
+    monkeypatch.setattr(device, "telemetry_store", store)
+    scans = ScanJobStore(str(tmp_path / "scan_jobs.db"))
+    scans.create_job("field-1", "alice", None, 1)
+    monkeypatch.setattr(device.scan_orchestrator, "store", scans)
+    app = FastAPI()
+    app.include_router(device.router)
+    app.dependency_overrides[verify_supabase_token] = lambda: {"user_id": "alice"}
+    return TestClient(app), store
+
+
+def test_telemetry_endpoint_downsamples(telemetry_client):
+    client, store = telemetry_client
+    store.append_many("field-1", *block(np.arange(100, 200)))
+    response = client.get("/api/device/telemetry", params={"device_id": "field-1", "start": 100, "end": 200, "buckets": 4})
+    assert response.status_code == 200
+    body = response.json()
+    assert [point["count"] for point in body["points"]] == [25, 25, 25, 25]
+    assert body["points"][3]["K"]["max"] == 199
+
+
+def test_telemetry_endpoint_errors(telemetry_client):
+    client, _ = telemetry_client
+    assert client.get("/api/device/telemetry", params={"device_id": "nope", "start": 0, "end": 1}).status_code == 404
+    assert client.get("/api/device/telemetry", params={"device_id": "nope", "start": 5, "end": 1}).status_code == 400
+
+
+def test_telemetry_endpoint_hides_other_users_devices(telemetry_client):
+    client, store = telemetry_client
+    store.append_many("field-2", *block(np.arange(100, 200)))
+    response = client.get("/api/device/telemetry", params={"device_id": "field-2", "start": 100, "end": 200})
+    assert response.status_code == 404
+
+
+def test_sensor_upload_from_new_device_is_refused_when_full(telemetry_client, monkeypatch):
+    client, store = telemetry_client
+    monkeypatch.setattr(store, "max_devices", 1)
+    monkeypatch.setattr(device, "LATEST_SENSOR_DATA", {})
+    reading = {"N": 1.0, "P": 2.0, "K": 3.0, "ph": 6.5}
+    assert client.post("/api/device/update-sensors", json=reading, headers={"X-Device-ID": "a"}).status_code == 200
+    assert client.post("/api/device/update-sensors", json=reading, headers={"X-Device-ID": "b"}).status_code == 503
+
+
+def test_bulk_upload_stores_readings_and_reports_rejects(telemetry_client, monkeypatch):
+    client, store = telemetry_client
+    monkeypatch.setattr(device, "LATEST_SENSOR_DATA", {})
+    now = time.time()
+    body = pack([(now - 120, 10, 20, 30, 6.0), (now - 60, 11, 21, 31, 6.1), (now - 90, 12, 22, 32, 99.0)])
+    response = client.post(
+        "/api/device/update-sensors/bulk", content=body,
+        headers={"X-Device-ID": "field-1", "Content-Type": "application/octet-stream"}
+    )
+    assert response.status_code == 200
+    assert response.json() == {"status": "received", "accepted": 2, "rejected": 1, "record_size": RECORD_DTYPE.itemsize}
+    timestamps, values = store.series["field-1"].ordered_view()
+    np.testing.assert_array_equal(values["N"], [10, 11])
+    # The newest reading becomes the latest sensor snapshot
+    assert device.LATEST_SENSOR_DATA["default"]["N"] == 11
+
+
+def test_bulk_upload_rejects_partial_records(telemetry_client):
+    client, store = telemetry_client
+    response = client.post("/api/device/update-sensors/bulk", content=b"\x00" * (RECORD_DTYPE.itemsize + 3))
+    assert response.status_code == 400
+    assert "multiple" in response.json()["detail"]
+    assert not store.series
+
+
+def test_bulk_upload_enforces_the_body_size_cap(telemetry_client, monkeypatch):
+    client, store = telemetry_client
+    monkeypatch.setattr(device, "TELEMETRY_BULK_MAX_BYTES", 2 * RECORD_DTYPE.itemsize)
+    now = time.time()
+    body = pack([(now - i, 10, 20, 30, 6.0) for i in range(3, 0, -1)])
+    # Declared length over the cap
+    assert client.post("/api/device/update-sensors/bulk", content=body).status_code == 400
+
+    # Chunked body without Content-Length is cut off while streaming
+    def chunks():
+        for i in range(0, len(body), RECORD_DTYPE.itemsize):
+            yield body[i:i + RECORD_DTYPE.itemsize]
+
+    response = client.post("/api/device/update-sensors/bulk", content=chunks())
+    assert response.status_code == 400
+    assert "exceeds" in response.json()["detail"]
+    assert not store.series
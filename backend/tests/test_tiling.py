@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+import tiling
+from tiling import detect_tiled, make_tiles, tile_count
+
+
+class _Boxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy, self.conf, self.cls = (_Tensor(xyxy), _Tensor(conf), _Tensor(cls))
+
+    def __len__(self):
+        return len(self.xyxy.value)
+
+
+class _Tensor:
+    def __init__(self, value):
+        self.value = np.asarray(value)
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.value
+
+
+class _Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class FakeModel:
+    """One box in the top-left corner of every tile; records batch sizes"""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, tiles, verbose=False):
+        self.batches.append(len(tiles))
+        return [_Result(_Boxes([[0, 0, 10, 10]], [0.9], [0])) for _ in tiles]
+
+
+def test_make_tiles_covers_image_edge_aligned():
+    windows = make_tiles(1000, 700, 640, 0.2)
+    assert windows == [(0, 0, 640, 640), (360, 0, 1000, 640), (0, 60, 640, 700), (360, 60, 1000, 700)]
+    assert len(windows) == tile_count(1000, 700, 640, 0.2)
+
+
+def test_make_tiles_small_image_is_one_window():
+    assert make_tiles(300, 200, 640, 0.2) == [(0, 0, 300, 200)]
+
+
+def test_make_tiles_overlap_between_neighbours():
+    windows = make_tiles(2000, 640, 640, 0.25)
+    xs = [x1 for x1, _, _, _ in windows]
+    assert xs == [0, 480, 960, 1360]
+    assert windows[-1][2] == 2000
+
+
+@pytest.mark.parametrize("width,height,size,overlap", [(4000, 3000, 640, 0.2), (7300, 5480, 160, 0.5), (640, 640, 640, 0.0)])
+def test_tile_count_matches_make_tiles(width, height, size, overlap):
+    assert tile_count(width, height, size, overlap) == len(make_tiles(width, height, size, overlap))
+
+
+def test_detect_tiled_runs_bounded_batches(monkeypatch):
+    monkeypatch.setattr(tiling, "TILE_BATCH_SIZE", 3)
+    model = FakeModel()
+    img = np.zeros((1300, 1900, 3), dtype=np.uint8)
+    n = len(make_tiles(1900, 1300, 640, 0.2))
+    result = detect_tiled(model, img, tile_size=640, overlap=0.2)
+    assert sum(model.batches) == n
+    assert max(model.batches) == 3
+    # Each tile's box is offset into image coordinates; none overlap, so all survive the merge
+    assert len(result["boxes"]) == n
+
+
+def test_detect_tiled_rejects_too_many_tiles(monkeypatch):
+    monkeypatch.setattr(tiling, "MAX_TILES", 4)
+    model = FakeModel()
+    img = np.zeros((1300, 1900, 3), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        detect_tiled(model, img, tile_size=640, overlap=0.2)
+    assert model.batches == []
@@ -0,0 +1,205 @@
+import asyncio
+import hashlib
+import struct
+
+import cv2
+import numpy as np
+import pytest
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.responses import JSONResponse
+from fastapi.testclient import TestClient
+
+from uploads import BodySizeLimitMiddleware, ImageIngest, UploadSpool, read_request_body, read_request_chunk, read_upload
+
+LIMIT = 4096
+
+
+def jpeg_bytes(width=32, height=24) -> bytes:
+    ok, buffer = cv2.imencode('.jpg', np.zeros((height, width, 3), dtype=np.uint8))
+    return buffer.tobytes()
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+
+    @app.exception_handler(HTTPException)
+    async def http_exception_handler(request, exc):
+        return JSONResponse(status_code=exc.status_code, content={"error": exc.detail})
+
+    @app.post("/multipart")
+    async def multipart(image: UploadFile = File(...)):
+        upload = await read_upload(image, max_bytes=LIMIT, limit_label="4KB")
+        return {"size": len(upload), "width": upload.width, "height": upload.height}
+
+    @app.post("/raw")
+    async def raw(request: Request):
+        upload = await read_request_body(request, max_bytes=LIMIT, limit_label="4KB")
+        return {"size": len(upload), "sha256": upload.sha256}
+
+    @app.put("/chunk")
+    async def chunk(request: Request):
+        return {"size": len(await read_request_chunk(request, max_bytes=LIMIT))}
+
+    app.add_middleware(BodySizeLimitMiddleware, limits={"/multipart": LIMIT + 1024})
+    return TestClient(app)
+
+
+def test_multipart_within_limit(client):
+    data = jpeg_bytes()
+    response = client.post("/multipart", files={"image": ("a.jpg", data, "image/jpeg")})
+    assert response.status_code == 200
+    assert response.json() == {"size": len(data), "width": 32, "height": 24}
+
+
+def test_multipart_over_content_length_rejected_before_parsing(client):
+    body = jpeg_bytes() + b"\0" * (LIMIT * 4)
+    response = client.post("/multipart", files={"image": ("a.jpg", body, "image/jpeg")})
+    assert response.status_code == 413
+
+
+def test_chunked_body_over_limit_cut_off(client):
+    def chunks():
+        for _ in range(16):
+            yield b"\0" * 1024
+
+    # A generator body is sent chunked, without Content-Length
+    response = client.post("/multipart", content=chunks(),
+                           headers={"Content-Type": "multipart/form-data; boundary=x"})
+    assert response.status_code == 413
+
+
+def test_file_over_limit_within_multipart_slack(client):
+    data = jpeg_bytes()
+    body = data + b"\0" * (LIMIT + 10 - len(data))
+    response = client.post("/multipart", files={"image": ("a.jpg", body, "image/jpeg")})
+    assert response.status_code == 413
+    assert "4KB" in response.json()["error"]
+
+
+def test_raw_body_over_limit(client):
+    response = client.post("/raw", content=jpeg_bytes() + b"\0" * LIMIT)
+    assert response.status_code == 413
+
+
+def test_raw_body_hash_matches(client):
+    data = jpeg_bytes()
+    response = client.post("/raw", content=data)
+    assert response.json()["sha256"] == hashlib.sha256(data).hexdigest()
+
+
+def test_ingest_returns_buffer_without_copy():
+    ingest = ImageIngest(LIMIT, "4KB")
+    data = jpeg_bytes()
+    ingest.feed(data[:10])
+    ingest.feed(data[10:])
+    image = ingest.finish()
+    assert image.data is ingest._buffer
+    assert bytes(image.data) == data
+
+
+def test_check_validates_in_place():
+    data = jpeg_bytes()
+    image = ImageIngest(LIMIT, "4KB").check(data)
+    assert image.data is data
+    assert (image.width, image.height, image.format) == (32, 24, "jpeg")
+
+
+def test_ingest_rejects_non_image():
+    with pytest.raises(HTTPException) as exc:
+        ImageIngest(LIMIT, "4KB").feed(b"GIF89a" + b"\0" * 20)
+    assert exc.value.status_code == 400
+
+
+def test_ingest_rejects_oversized_dimensions():
+    # PNG header declaring 100000 x 100000 pixels
+    header = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", 100000, 100000)
+    with pytest.raises(HTTPException) as exc:
+        ImageIngest(LIMIT, "4KB").feed(header)
+    assert exc.value.status_code == 400
+
+
+def test_spool_appends_at_offsets_and_verifies_checksum(tmp_path):
+    data = jpeg_bytes()
+    spool = UploadSpool(str(tmp_path), max_bytes=LIMIT)
+    session = spool.create("cam-1", len(data))
+    half = len(data) // 2
+
+    async def scenario():
+        assert await spool.append(session, 0, data[:half]) == half
+        with pytest.raises(HTTPException) as excinfo:
+            await spool.append(session, 0, data[:half])
+        assert excinfo.value.status_code == 409
+        assert excinfo.value.headers["Upload-Offset"] == str(half)
+        with pytest.raises(HTTPException) as excinfo:
+            await spool.append(session, half, data[half:] + b"extra")
+        assert excinfo.value.status_code == 400
+        with pytest.raises(HTTPException) as excinfo:
+            await spool.complete(session, hashlib.sha256(data).hexdigest(), "4KB")
+        assert excinfo.value.status_code == 409
+        assert await spool.append(session, half, data[half:]) == len(data)
+        return await spool.complete(session, hashlib.sha256(data).hexdigest().upper(), "4KB")
+
+    image = asyncio.run(scenario())
+    assert bytes(image.data) == data
+    spool.finish(session)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_spool_checksum_mismatch_discards_upload(tmp_path):
+    data = jpeg_bytes()
+    spool = UploadSpool(str(tmp_path), max_bytes=LIMIT)
+    session = spool.create("cam-1", len(data))
+
+    async def scenario():
+        await spool.append(session, 0, data)
+        await spool.complete(session, "0" * 64, "4KB")
+
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(scenario())
+    assert excinfo.value.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+    with pytest.raises(HTTPException) as excinfo:
+        spool.get(session.upload_id, "cam-1")
+    assert excinfo.value.status_code == 404
+
+
+def test_spool_rejects_bad_sizes_and_non_images(tmp_path):
+    spool = UploadSpool(str(tmp_path), max_bytes=LIMIT)
+    for size, status in ((0, 400), (LIMIT + 1, 413)):
+        with pytest.raises(HTTPException) as excinfo:
+            spool.create("cam-1", size)
+        assert excinfo.value.status_code == status
+
+    session = spool.create("cam-1", 16)
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(spool.append(session, 0, b"not an image at all"[:16]))
+    assert excinfo.value.status_code == 400
+    assert session.offset == 0
+
+
+def test_spool_session_survives_restart_and_is_device_scoped(tmp_path):
+    data = jpeg_bytes()
+    session = UploadSpool(str(tmp_path), max_bytes=LIMIT).create("cam-1", len(data))
+    asyncio.run(UploadSpool(str(tmp_path), max_bytes=LIMIT).append(session, 0, data[:10]))
+
+    restarted = UploadSpool(str(tmp_path), max_bytes=LIMIT)
+    restored = restarted.get(session.upload_id, "cam-1")
+    assert restored.describe() == {"upload_id": session.upload_id, "offset": 10, "size": len(data)}
+    with pytest.raises(HTTPException) as excinfo:
+        restarted.get(session.upload_id, "cam-2")
+    assert excinfo.value.status_code == 403
+    with pytest.raises(HTTPException) as excinfo:
+        restarted.get("../" + session.upload_id, "cam-1")
+    assert excinfo.value.status_code == 404
+
+
+def test_chunk_without_content_length_is_cut_off(client):
+    def body():
+        for _ in range(8):
+            yield b"x" * 1024
+
+    response = client.put("/chunk", content=body())
+    assert response.status_code == 413
+    assert client.put("/chunk", content=b"x" * (LIMIT + 1)).status_code == 413
+    assert client.put("/chunk", content=b"x" * LIMIT).json() == {"size": LIMIT}
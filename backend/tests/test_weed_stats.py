@@ -0,0 +1,138 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import weed_stats
+from weed_stats import WeedStatsAggregator, class_histograms
+
+DAY = 86400.0
+
+
+def test_each_worker_persists_its_own_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "weed_stats.json")
+    for slot in ("0", "2"):
+        monkeypatch.setenv("WORKER_SLOT", slot)
+        stats = WeedStatsAggregator(path=path)
+        stats.record(int(slot) + 1, device_id=f"dev-{slot}")
+        stats.save()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["weed_stats.json", "weed_stats.worker2.json"]
+
+    restored = WeedStatsAggregator(path=path)
+    assert restored.load() == 2
+    assert restored.summary("device", "dev-2")["weeds"] == 3
+    assert restored.summary("device", "dev-0")["frames"] == 0
+
+
+@pytest.fixture
+def stats_client(tmp_path, monkeypatch):
+    import main
+    from auth import verify_supabase_token
+    from scan_jobs import ScanJobStore
+
+    store = ScanJobStore(str(tmp_path / "scan_jobs.db"))
+    job = store.create_job("cam-1", "alice", None, 4)
+    monkeypatch.setattr(main.scan_orchestrator, "store", store)
+    aggregator = WeedStatsAggregator(path=str(tmp_path / "weed_stats.json"))
+    aggregator.record(3, ["weed"] * 3, [0.9, 0.8, 0.7], device_id="cam-1", user_id="alice", scan_id=job["id"])
+    monkeypatch.setattr(main, "weed_stats", aggregator)
+
+    def as_user(user_id):
+        main.app.dependency_overrides[verify_supabase_token] = lambda: {"user_id": user_id}
+        return TestClient(main.app)
+
+    yield as_user, job["id"]
+    main.app.dependency_overrides.pop(verify_supabase_token, None)
+
+
+def test_weed_stats_owner_sees_device_and_scan(stats_client):
+    as_user, scan_id = stats_client
+    client = as_user("alice")
+    assert client.get("/api/weed-stats", params={"scope": "device", "id": "cam-1"}).json()["weeds"] == 3
+    assert client.get("/api/weed-stats", params={"scope": "scan", "id": scan_id}).json()["frames"] == 1
+
+
+def test_weed_stats_hides_other_users_devices_and_scans(stats_client):
+    as_user, scan_id = stats_client
+    client = as_user("mallory")
+    assert client.get("/api/weed-stats", params={"scope": "device", "id": "cam-1"}).status_code == 404
+    assert client.get("/api/weed-stats", params={"scope": "scan", "id": scan_id}).status_code == 404
+    assert client.get("/api/weed-stats", params={"scope": "scan", "id": "missing"}).status_code == 404
+    # The caller's own (empty) aggregates are still available
+    assert client.get("/api/weed-stats", params={"scope": "user"}).json()["frames"] == 0
+
+
+def test_class_histograms_bin_confidences_per_class():
+    histograms = class_histograms(["weed", "weed", "crop"], [0.05, 1.0, 0.55])
+    assert histograms["weed"].tolist() == [1, 0, 0, 0, 0, 0, 0, 0, 0, 1]
+    assert histograms["crop"].tolist() == [0, 0, 0, 0, 0, 1, 0, 0, 0, 0]
+    assert class_histograms([], []) == {}
+
+
+def test_running_totals_and_daily_rollups(tmp_path):
+    stats = WeedStatsAggregator(path=str(tmp_path / "weed_stats.json"))
+    stats.record(2, ["weed", "weed"], [0.9, 0.7], device_id="cam-1", timestamp=2 * DAY)
+    stats.record(0, device_id="cam-1", timestamp=2 * DAY + 60)
+    # A late frame from the previous day is slotted in date order
+    stats.record(1, ["weed"], [0.5], device_id="cam-1", timestamp=DAY)
+
+    summary = stats.summary("device", "cam-1")
+    assert summary["frames"] == 3 and summary["weeds"] == 3
+    assert summary["frames_with_weeds"] == 2 and summary["max_weeds_per_frame"] == 2
+    assert summary["weeds_per_frame"] == 1.0
+    assert summary["classes"]["weed"]["count"] == 3
+    assert summary["classes"]["weed"]["mean_confidence"] == 0.7
+    assert summary["daily"] == [
+        {"date": "1970-01-02", "frames": 1, "weeds": 1},
+        {"date": "1970-01-03", "frames": 2, "weeds": 2}
+    ]
+    assert [d["date"] for d in stats.summary("device", "cam-1", days=1)["daily"]] == ["1970-01-03"]
+    assert stats.summary("global")["frames"] == 3
+
+
+def test_daily_rollups_keep_the_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(weed_stats, "WEED_STATS_DAYS", 2)
+    stats = WeedStatsAggregator(path=str(tmp_path / "weed_stats.json"))
+    for day in (1, 2, 3):
+        stats.record(1, timestamp=day * DAY)
+    # Older than every day in the window: counted in the totals only
+    stats.record(1, timestamp=0)
+
+    summary = stats.summary("global")
+    assert summary["frames"] == 4
+    assert [d["date"] for d in summary["daily"]] == ["1970-01-03", "1970-01-04"]
+
+
+def test_least_recently_updated_scope_is_evicted(tmp_path):
+    stats = WeedStatsAggregator(path=str(tmp_path / "weed_stats.json"), max_scopes=3)
+    stats.record(1, device_id="cam-1")
+    stats.record(1, device_id="cam-2")
+    stats.record(1, device_id="cam-1", scan_id="scan-1")
+    assert stats.stats()["scopes"] == {"global": 1, "device": 1, "scan": 1}
+    assert stats.summary("device", "cam-2")["frames"] == 0
+    assert stats.summary("device", "cam-1")["frames"] == 2
+
+
+def test_save_and_load_roundtrip(tmp_path, monkeypatch):
+    monkeypatch.delenv("WORKER_SLOT", raising=False)
+    path = str(tmp_path / "weed_stats.json")
+    stats = WeedStatsAggregator(path=path)
+    stats.record(2, ["weed", "crop"], [0.8, 0.4], device_id="cam-1", user_id="alice", timestamp=DAY)
+    stats.save()
+
+    restored = WeedStatsAggregator(path=path)
+    assert restored.load() == 3
+    for scope, scope_id in (("global", "all"), ("device", "cam-1"), ("user", "alice")):
+        assert restored.summary(scope, scope_id) == stats.summary(scope, scope_id)
+
+
+def test_repeated_image_is_counted_once(tmp_path):
+    stats = WeedStatsAggregator(path=str(tmp_path / "weed_stats.json"), max_seen=2)
+    assert stats.record(2, user_id="alice", dedup_key="alice:img1")
+    assert not stats.record(2, user_id="alice", dedup_key="alice:img1")
+    # The same photo from another user is theirs to count
+    assert stats.record(2, user_id="bob", dedup_key="bob:img1")
+    assert stats.summary("user", "alice")["frames"] == 1
+    assert stats.summary("global")["weeds"] == 4
+
+    # Only the most recent keys are remembered
+    stats.record(1, user_id="alice", dedup_key="alice:img2")
+    assert stats.record(2, user_id="alice", dedup_key="alice:img1")
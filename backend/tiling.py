@@ -0,0 +1,121 @@
+"""
+Tiled (sliced) weed detection for high-resolution field images
+Small weeds disappear when a large frame is downscaled to the model input
+size; running overlapping tiles at native resolution keeps them visible
+"""
+
+import os
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from boxes import batched_nms
+
+DEFAULT_TILE_SIZE = int(os.getenv("WEED_TILE_SIZE", "640"))
+DEFAULT_TILE_OVERLAP = float(os.getenv("WEED_TILE_OVERLAP", "0.2"))
+# Tiles per model call; bounds the batch tensor regardless of image size
+TILE_BATCH_SIZE = max(1, int(os.getenv("WEED_TILE_BATCH_SIZE", "8")))
+# Tiles allowed per image (a 40MP upload at 640px / 0.2 overlap needs ~170)
+MAX_TILES = int(os.getenv("WEED_MAX_TILES", "256"))
+
+# Cross-tile merge threshold (intersection over the smaller box)
+MERGE_THRESHOLD = 0.6
+
+CLASS_COLORS = [(56, 56, 255), (151, 157, 255), (31, 112, 255), (29, 178, 255)]
+
+
+def _tile_starts(length: int, tile_size: int, stride: int) -> List[int]:
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, stride))
+    # Last tile is aligned to the edge rather than padded
+    starts.append(length - tile_size)
+    return starts
+
+
+def make_tiles(width: int, height: int, tile_size: int, overlap: float) -> List[Tuple[int, int, int, int]]:
+    """
+    Overlapping tile windows covering the image
+
+    Returns:
+        List of (x1, y1, x2, y2) windows
+    """
+    stride = max(1, int(tile_size * (1.0 - overlap)))
+    return [
+        (x, y, min(x + tile_size, width), min(y + tile_size, height))
+        for y in _tile_starts(height, tile_size, stride)
+        for x in _tile_starts(width, tile_size, stride)
+    ]
+
+
+def tile_count(width: int, height: int, tile_size: int, overlap: float) -> int:
+    """Number of windows make_tiles would produce, without building them"""
+    stride = max(1, int(tile_size * (1.0 - overlap)))
+    return len(_tile_starts(width, tile_size, stride)) * len(_tile_starts(height, tile_size, stride))
+
+
+def _result_arrays(result) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    boxes = result.boxes
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+    return (
+        boxes.xyxy.cpu().numpy().astype(np.float64),
+        boxes.conf.cpu().numpy().astype(np.float64),
+        boxes.cls.cpu().numpy().astype(np.int64)
+    )
+
+
+def detect_tiled(model, img: np.ndarray, tile_size: int = DEFAULT_TILE_SIZE, overlap: float = DEFAULT_TILE_OVERLAP) -> Dict[str, np.ndarray]:
+    """
+    Run the model over overlapping tiles, TILE_BATCH_SIZE at a time, and merge the detections
+
+    Args:
+        model: Loaded YOLO model
+        img: BGR image array
+        tile_size: Tile edge length in pixels
+        overlap: Fraction of a tile shared with its neighbour (0 - 0.9)
+
+    Returns:
+        Dictionary with boxes (N, 4) in image coordinates, scores and classes
+
+    Raises:
+        ValueError: If the image needs more than MAX_TILES tiles at this size and overlap
+    """
+    height, width = img.shape[:2]
+    windows = make_tiles(width, height, tile_size, overlap)
+    if len(windows) > MAX_TILES:
+        raise ValueError(f"{len(windows)} tiles exceeds the limit of {MAX_TILES}")
+
+    all_boxes, all_scores, all_classes = [], [], []
+    for start in range(0, len(windows), TILE_BATCH_SIZE):
+        chunk = windows[start:start + TILE_BATCH_SIZE]
+        results = model([img[y1:y2, x1:x2] for x1, y1, x2, y2 in chunk], verbose=False)
+        for (x1, y1, _, _), result in zip(chunk, results):
+            boxes, scores, classes = _result_arrays(result)
+            if len(boxes):
+                all_boxes.append(boxes + np.array([x1, y1, x1, y1], dtype=np.float64))
+                all_scores.append(scores)
+                all_classes.append(classes)
+
+    if not all_boxes:
+        return {"boxes": np.zeros((0, 4)), "scores": np.zeros(0), "classes": np.zeros(0, dtype=np.int64)}
+
+    boxes = np.concatenate(all_boxes)
+    scores = np.concatenate(all_scores)
+    classes = np.concatenate(all_classes)
+    keep = batched_nms(boxes, scores, classes, MERGE_THRESHOLD, metric="ios")
+    return {"boxes": boxes[keep], "scores": scores[keep], "classes": classes[keep]}
+
+
+def draw_detections(img: np.ndarray, detections: Dict[str, np.ndarray], names: Dict[int, str]) -> np.ndarray:
+    """Annotate a copy of the image with merged detections"""
+    annotated = img.copy()
+    thickness = max(2, round(sum(img.shape[:2]) / 1000))
+    for box, score, cls in zip(detections["boxes"], detections["scores"], detections["classes"]):
+        x1, y1, x2, y2 = (int(v) for v in box)
+        color = CLASS_COLORS[int(cls) % len(CLASS_COLORS)]
+        label = f"{names.get(int(cls), int(cls))} {score:.2f}"
+        cv2.rectangle(annotated, (x1, y1), (x2, y2), color, thickness)
+        cv2.putText(annotated, label, (x1, max(y1 - 5, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5 * thickness / 2, color, max(1, thickness // 2))
+    return annotated
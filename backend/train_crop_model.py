@@ -0,0 +1,255 @@
+"""
+Reproducible training for the crop recommendation model
+Runs a process-parallel hyperparameter search over data/Crop_ds.csv and
+selects the fastest model that meets serving constraints (single-row
+predict latency, artifact size) while staying within an accuracy
+tolerance of the best candidate
+
+The artifact is written as a registry version (Models/crop/<version>/)
+together with a benchmark report; --activate points Models/registry.json
+at it so a running server picks it up on the next reload.
+
+Usage (from backend/):
+    python train_crop_model.py --jobs 4 --max-latency-ms 2 --max-bytes 500000 --activate
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import StratifiedKFold, cross_val_score, train_test_split
+from sklearn.naive_bayes import GaussianNB
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.tree import DecisionTreeClassifier
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_PATH = os.path.join(BASE_DIR, 'data', 'Crop_ds.csv')
+MODEL_DIR = os.path.join(BASE_DIR, 'Models')
+CURRENT_MODEL_PATH = os.path.join(MODEL_DIR, 'crop_recommendation_model.pkl')
+
+# Same column order the API sends (see crop_features in main.py)
+FEATURES = ["N", "P", "K", "temperature", "humidity", "ph", "rainfall"]
+LABEL = "label"
+
+
+def candidate_grid():
+    """(name, params) pairs searched; estimators are built inside the worker"""
+    grid = []
+    for n_estimators, max_depth in itertools.product([10, 25, 50, 100], [None, 8, 12]):
+        grid.append(("random_forest", {"n_estimators": n_estimators, "max_depth": max_depth}))
+        grid.append(("extra_trees", {"n_estimators": n_estimators, "max_depth": max_depth}))
+    for max_depth in [None, 8, 12, 16]:
+        grid.append(("decision_tree", {"max_depth": max_depth}))
+    grid.append(("gaussian_nb", {}))
+    for c in [1.0, 10.0, 100.0]:
+        grid.append(("logistic_regression", {"C": c}))
+    return grid
+
+
+def build_estimator(name: str, params: dict, seed: int):
+    # n_jobs=1: parallelism comes from the process pool, and serving predicts one row at a time
+    if name == "random_forest":
+        return RandomForestClassifier(random_state=seed, n_jobs=1, **params)
+    if name == "extra_trees":
+        return ExtraTreesClassifier(random_state=seed, n_jobs=1, **params)
+    if name == "decision_tree":
+        return DecisionTreeClassifier(random_state=seed, **params)
+    if name == "gaussian_nb":
+        return GaussianNB(**params)
+    if name == "logistic_regression":
+        return make_pipeline(StandardScaler(), LogisticRegression(max_iter=2000, **params))
+    raise ValueError(f"Unknown estimator: {name}")
+
+
+def evaluate_candidate(name, params, X_train, y_train, X_test, y_test, folds, seed):
+    """Cross-validate and fit one candidate (runs in a worker process)"""
+    estimator = build_estimator(name, params, seed)
+    cv = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    cv_scores = cross_val_score(estimator, X_train, y_train, cv=cv)
+    start = time.perf_counter()
+    estimator.fit(X_train, y_train)
+    fit_seconds = time.perf_counter() - start
+    return {
+        "name": name,
+        "params": params,
+        "cv_accuracy": round(float(cv_scores.mean()), 4),
+        "test_accuracy": round(float((estimator.predict(X_test) == y_test).mean()), 4),
+        "fit_seconds": round(fit_seconds, 3),
+        "model": estimator
+    }
+
+
+def artifact_bytes(model, compress: int) -> int:
+    buffer = io.BytesIO()
+    joblib.dump(model, buffer, compress=compress)
+    return buffer.tell()
+
+
+def single_row_latency(model, rows: np.ndarray, repeats: int) -> dict:
+    """p50/p95 of predict_proba on one row, the shape the API serves"""
+    model.predict_proba(rows[:1])
+    timings = []
+    for i in range(repeats):
+        row = rows[i % len(rows)][None, :]
+        start = time.perf_counter()
+        model.predict_proba(row)
+        timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "p50_ms": round(timings[len(timings) // 2] * 1000, 4),
+        "p95_ms": round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 4)
+    }
+
+
+def select(results, max_latency_ms: float, max_bytes: int, tolerance: float):
+    """
+    Fastest candidate within the constraints whose CV accuracy is within
+    `tolerance` of the best constrained candidate
+    """
+    eligible = [r for r in results if r["p95_ms"] <= max_latency_ms and r["artifact_bytes"] <= max_bytes]
+    if not eligible:
+        return None
+    best_accuracy = max(r["cv_accuracy"] for r in eligible)
+    close = [r for r in eligible if r["cv_accuracy"] >= best_accuracy - tolerance]
+    return min(close, key=lambda r: (r["p95_ms"], r["artifact_bytes"]))
+
+
+def benchmark_current(X_test, y_test, rows, repeats: int, compress: int):
+    """Same measurements for the model currently in Models/, for comparison"""
+    if not os.path.exists(CURRENT_MODEL_PATH):
+        return None
+    model = joblib.load(CURRENT_MODEL_PATH)
+    # The shipped model was fitted on a DataFrame; the API (and this script) pass arrays
+    warnings.filterwarnings("ignore", message="X does not have valid feature names")
+    return {
+        "path": CURRENT_MODEL_PATH,
+        "test_accuracy": round(float((model.predict(X_test) == y_test).mean()), 4),
+        "artifact_bytes": os.path.getsize(CURRENT_MODEL_PATH),
+        "artifact_bytes_recompressed": artifact_bytes(model, compress),
+        **single_row_latency(model, rows, repeats)
+    }
+
+
+def activate(version: str) -> str:
+    """Point the registry manifest's crop entry at `version`, keeping other entries"""
+    manifest_path = os.path.join(MODEL_DIR, 'registry.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    manifest["crop"] = {"version": version}
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return manifest_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train and select a crop recommendation model")
+    parser.add_argument("--data", default=DATA_PATH, help="Training CSV")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Worker processes for the search")
+    parser.add_argument("--folds", type=int, default=5, help="Cross-validation folds")
+    parser.add_argument("--test-size", type=float, default=0.2, help="Held-out fraction for the report")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--max-latency-ms", type=float, default=5.0, help="Max single-row predict_proba p95")
+    parser.add_argument("--max-bytes", type=int, default=2_000_000, help="Max compressed artifact size")
+    parser.add_argument("--tolerance", type=float, default=0.005,
+                        help="Accuracy the selection may give up against the best candidate for speed")
+    parser.add_argument("--repeats", type=int, default=300, help="Timed single-row predictions per candidate")
+    parser.add_argument("--compress", type=int, default=3, help="joblib compression level for the artifact")
+    parser.add_argument("--version", default=None, help="Registry version name (default: UTC timestamp)")
+    parser.add_argument("--activate", action="store_true", help="Make this version active in Models/registry.json")
+    parser.add_argument("--dry-run", action="store_true", help="Print the report without writing an artifact")
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.data)
+    X = df[FEATURES].to_numpy(dtype=np.float64)
+    y = df[LABEL].to_numpy()
+    X_train, X_test, y_train, y_test = train_test_split(
+        X, y, test_size=args.test_size, stratify=y, random_state=args.seed
+    )
+    grid = candidate_grid()
+    print(f"Loaded {len(df)} rows, {len(np.unique(y))} crops; searching {len(grid)} candidates on {args.jobs} processes")
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [
+            pool.submit(evaluate_candidate, name, params, X_train, y_train, X_test, y_test, args.folds, args.seed)
+            for name, params in grid
+        ]
+        for future in as_completed(futures):
+            results.append(future.result())
+    search_seconds = time.perf_counter() - start
+
+    # Latency is measured serially afterwards so candidates don't compete for CPU
+    for result in results:
+        result["artifact_bytes"] = artifact_bytes(result["model"], args.compress)
+        result.update(single_row_latency(result["model"], X_test, args.repeats))
+    results.sort(key=lambda r: (-r["cv_accuracy"], r["p95_ms"]))
+
+    print(f"{'candidate':<48}{'cv_acc':>8}{'test_acc':>10}{'p95_ms':>9}{'bytes':>11}")
+    for r in results:
+        label = f"{r['name']} {r['params']}"
+        print(f"{label[:47]:<48}{r['cv_accuracy']:>8}{r['test_accuracy']:>10}{r['p95_ms']:>9}{r['artifact_bytes']:>11}")
+
+    chosen = select(results, args.max_latency_ms, args.max_bytes, args.tolerance)
+    if chosen is None:
+        raise SystemExit("No candidate meets the latency and size constraints")
+    baseline = benchmark_current(X_test, y_test, X_test, args.repeats, args.compress)
+
+    version = args.version or datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    report = {
+        "version": version,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "data": os.path.relpath(args.data, BASE_DIR),
+        "rows": len(df),
+        "features": FEATURES,
+        "seed": args.seed,
+        "constraints": {
+            "max_latency_ms": args.max_latency_ms,
+            "max_bytes": args.max_bytes,
+            "tolerance": args.tolerance
+        },
+        "search_seconds": round(search_seconds, 2),
+        "selected": {k: v for k, v in chosen.items() if k != "model"},
+        "baseline": baseline,
+        "candidates": [{k: v for k, v in r.items() if k != "model"} for r in results]
+    }
+
+    print(f"\nSelected {chosen['name']} {chosen['params']}: cv_acc={chosen['cv_accuracy']} "
+          f"test_acc={chosen['test_accuracy']} p95={chosen['p95_ms']}ms size={chosen['artifact_bytes']}B")
+    if baseline:
+        print(f"Current model: test_acc={baseline['test_accuracy']} p95={baseline['p95_ms']}ms "
+              f"size={baseline['artifact_bytes']}B")
+
+    if args.dry_run:
+        return
+
+    version_dir = os.path.join(MODEL_DIR, 'crop', version)
+    os.makedirs(version_dir, exist_ok=True)
+    artifact_path = os.path.join(version_dir, 'model.joblib')
+    joblib.dump(chosen["model"], artifact_path, compress=args.compress)
+    with open(os.path.join(version_dir, 'report.json'), "w") as f:
+        json.dump(report, f, indent=2, default=str)
+    print(f"Wrote {artifact_path}")
+
+    if args.activate:
+        print(f"Activated crop version {version} in {activate(version)}")
+
+
+if __name__ == "__main__":
+    main()
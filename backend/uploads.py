@@ -0,0 +1,502 @@
+"""
+Streaming image ingestion
+Reads uploads in chunks, rejecting oversized or non-image payloads as soon as
+the limit is crossed or the header is seen, instead of after a full read.
+Multipart routes are guarded by BodySizeLimitMiddleware, since Starlette
+spools a multipart body completely before the handler runs. Also holds the
+spool for resumable chunked uploads from devices.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+import uuid
+from typing import Dict, Optional, Tuple, Union
+
+from fastapi import HTTPException, Request, UploadFile
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger("SmartAgriNode.uploads")
+
+# Decoded-size guards, checked from the image header before the payload arrives
+MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", "8192"))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", "40000000"))
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+# JPEG start-of-frame markers carrying the image dimensions
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8}
+
+
+class IngestedImage:
+    """
+    Validated image payload with its content hash and header metadata
+
+    `data` is bytes-like: bytes for multipart and spooled uploads, the
+    receive buffer itself (a bytearray) for streamed request bodies.
+    """
+
+    def __init__(self, data: Union[bytes, bytearray], sha256: str, image_format: str, width: int, height: int):
+        self.data = data
+        self.sha256 = sha256
+        self.format = image_format
+        self.width = width
+        self.height = height
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+def _sniff_format(head: bytes) -> Optional[str]:
+    """Return 'jpeg'/'png' from magic bytes, '' if more bytes are needed, None if unknown"""
+    for image_format, signature in (("jpeg", JPEG_SIGNATURE), ("png", PNG_SIGNATURE)):
+        if head[:len(signature)] == signature[:len(head)]:
+            return image_format if len(head) >= len(signature) else ""
+    return None
+
+
+def _png_dimensions(buf: bytes):
+    """Width/height from the IHDR chunk, or None if not yet received"""
+    if len(buf) < 24:
+        return None
+    if buf[12:16] != b"IHDR":
+        raise ValueError("Missing PNG IHDR chunk")
+    return struct.unpack(">II", buf[16:24])
+
+
+def _jpeg_dimensions(buf: bytes):
+    """Width/height from the first SOF segment, or None if not yet received"""
+    pos = 2
+    while True:
+        # Skip fill bytes before the marker code
+        while pos < len(buf) and buf[pos] == 0xFF:
+            pos += 1
+        if pos >= len(buf):
+            return None
+        if buf[pos - 1] != 0xFF:
+            raise ValueError("Corrupt JPEG marker")
+        marker = buf[pos]
+        pos += 1
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            raise ValueError("JPEG has no frame header")
+        if pos + 2 > len(buf):
+            return None
+        (length,) = struct.unpack(">H", buf[pos:pos + 2])
+        if length < 2:
+            raise ValueError("Corrupt JPEG segment")
+        if marker in JPEG_SOF_MARKERS:
+            if pos + 7 > len(buf):
+                return None
+            height, width = struct.unpack(">HH", buf[pos + 3:pos + 7])
+            return width, height
+        pos += length
+
+
+def image_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) from the header of already validated image bytes, None if unreadable"""
+    try:
+        image_format = _sniff_format(data[:8])
+        if image_format == "png":
+            return _png_dimensions(data)
+        if image_format == "jpeg":
+            return _jpeg_dimensions(data)
+    except ValueError:
+        pass
+    return None
+
+
+class ImageIngest:
+    """
+    Incremental upload validator
+
+    Feed chunks as they arrive; raises HTTPException on the first chunk that
+    crosses the size limit (413), has the wrong magic bytes or a header
+    declaring dimensions beyond MAX_IMAGE_DIMENSION / MAX_IMAGE_PIXELS (400).
+    A payload that is already complete in memory is checked in place with
+    check() instead, without copying it.
+    """
+
+    def __init__(self, max_bytes: int, limit_label: str, allowed_formats=("jpeg", "png")):
+        self.max_bytes = max_bytes
+        self.limit_label = limit_label
+        self.allowed_formats = allowed_formats
+        self._buffer = bytearray()
+        self._hash = hashlib.sha256()
+        self.format: Optional[str] = None
+        self.dimensions = None
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            return
+        if len(self._buffer) + len(chunk) > self.max_bytes:
+            raise_too_large(self.limit_label)
+        self._buffer.extend(chunk)
+        self._hash.update(chunk)
+        if self.dimensions is None:
+            self._inspect_header()
+
+    def check(self, data: bytes) -> IngestedImage:
+        """Validate a complete payload in place (no copy) and return it"""
+        if len(data) > self.max_bytes:
+            raise_too_large(self.limit_label)
+        self._buffer = data
+        self._hash.update(data)
+        self._inspect_header()
+        return self.finish()
+
+    def finish(self) -> IngestedImage:
+        if not self._buffer:
+            raise HTTPException(status_code=400, detail="Empty body")
+        if self.dimensions is None:
+            raise HTTPException(status_code=400, detail="Invalid or truncated image")
+        width, height = self.dimensions
+        # Hand over the receive buffer itself; bytes() would double peak memory
+        return IngestedImage(self._buffer, self._hash.hexdigest(), self.format, width, height)
+
+    def _inspect_header(self) -> None:
+        if self.format is None:
+            image_format = _sniff_format(bytes(self._buffer[:8]))
+            if image_format is None or (image_format and image_format not in self.allowed_formats):
+                raise HTTPException(status_code=400, detail="Invalid file format. Only JPG, PNG, JPEG allowed")
+            if not image_format:
+                return
+            self.format = image_format
+
+        try:
+            if self.format == "png":
+                dimensions = _png_dimensions(self._buffer)
+            else:
+                dimensions = _jpeg_dimensions(self._buffer)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+        if dimensions is None:
+            return
+
+        width, height = dimensions
+        if width == 0 or height == 0:
+            raise HTTPException(status_code=400, detail="Invalid image: zero dimensions")
+        if width > MAX_IMAGE_DIMENSION or height > MAX_IMAGE_DIMENSION or width * height > MAX_IMAGE_PIXELS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Image dimensions {width}x{height} exceed the allowed maximum"
+            )
+        self.dimensions = dimensions
+
+
+def raise_too_large(limit_label: str) -> None:
+    raise HTTPException(status_code=413, detail=f"File size exceeds {limit_label} limit")
+
+
+async def read_upload(upload: UploadFile, max_bytes: int, limit_label: str) -> IngestedImage:
+    """
+    Validate a multipart UploadFile
+
+    The body has already been spooled by Starlette (and bounded by
+    BodySizeLimitMiddleware), so it is read in one piece, like a plain
+    upload.read(), and validated in place.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise_too_large(limit_label)
+    # One extra byte is enough to tell that the file is over the limit
+    data = await upload.read(max_bytes + 1)
+    return ImageIngest(max_bytes, limit_label).check(data)
+
+
+async def read_request_body(request: Request, max_bytes: int, limit_label: str) -> IngestedImage:
+    """Stream a raw request body (ESP32-CAM uploads) through an ImageIngest"""
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise_too_large(limit_label)
+
+    ingest = ImageIngest(max_bytes, limit_label)
+    async for chunk in request.stream():
+        ingest.feed(chunk)
+    return ingest.finish()
+
+
+async def read_request_chunk(request: Request, max_bytes: int) -> bytes:
+    """
+    Read a raw request body of at most max_bytes (one resumable-upload chunk)
+
+    The body is counted as it streams in, so a chunked request without a
+    Content-Length is cut off at the cap instead of being buffered whole.
+    """
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"Chunk exceeds {max_bytes} bytes")
+
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Chunk exceeds {max_bytes} bytes")
+    return bytes(body)
+
+
+# Multipart framing (boundaries, part headers, other form fields) allowed on top of the file limit
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class BodySizeLimitMiddleware:
+    """
+    ASGI middleware: cap request bodies per path before any parsing
+
+    A declared Content-Length over the limit is answered with 413 without
+    reading the body; a chunked body is counted as it arrives and cut off
+    with 413 as soon as it crosses the limit.
+    """
+
+    def __init__(self, app: ASGIApp, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        limit = self.limits.get(scope.get("path", "")) if scope["type"] == "http" else None
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        too_large = JSONResponse(status_code=413, content={"error": f"Request body exceeds {limit} bytes"})
+        for name, value in scope.get("headers", []):
+            if name == b"content-length":
+                if value.isdigit() and int(value) > limit:
+                    await too_large(scope, receive, send)
+                    return
+                break
+
+        received = 0
+        exceeded = False
+        response_started = False
+
+        async def limited_receive() -> Message:
+            nonlocal received, exceeded
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    exceeded = True
+                    raise BodyTooLarge()
+            return message
+
+        async def guarded_send(message: Message) -> None:
+            nonlocal response_started
+            # Whatever the app makes of the aborted body (e.g. a 400 parse error) is replaced by the 413
+            if exceeded:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except BodyTooLarge:
+            pass
+        except Exception:
+            if not exceeded:
+                raise
+        if exceeded and not response_started:
+            await too_large(scope, receive, send)
+
+
+# Resumable uploads: partial files survive dropped connections and restarts
+UPLOAD_SPOOL_DIR = os.getenv(
+    "UPLOAD_SPOOL_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'upload_spool')
+)
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", "3600"))
+UPLOAD_MAX_CHUNK_BYTES = int(os.getenv("UPLOAD_MAX_CHUNK_BYTES", str(1024 * 1024)))
+
+
+class UploadSession:
+    """One resumable upload: metadata in <id>.json, bytes appended to <id>.part"""
+
+    def __init__(self, spool_dir: str, upload_id: str, device_id: str, size: int,
+                 sha256: Optional[str] = None, created_at: Optional[float] = None):
+        self.upload_id = upload_id
+        self.device_id = device_id
+        self.size = size
+        self.sha256 = sha256
+        self.created_at = created_at or time.time()
+        self.part_path = os.path.join(spool_dir, upload_id + ".part")
+        self.meta_path = os.path.join(spool_dir, upload_id + ".json")
+        self.lock = asyncio.Lock()
+
+    @property
+    def offset(self) -> int:
+        """Bytes durably received; the file on disk is the source of truth"""
+        try:
+            return os.path.getsize(self.part_path)
+        except FileNotFoundError:
+            return 0
+
+    def describe(self) -> dict:
+        return {"upload_id": self.upload_id, "offset": self.offset, "size": self.size}
+
+    def save(self) -> None:
+        with open(self.meta_path, "w") as f:
+            json.dump({
+                "upload_id": self.upload_id,
+                "device_id": self.device_id,
+                "size": self.size,
+                "sha256": self.sha256,
+                "created_at": self.created_at
+            }, f)
+        open(self.part_path, "ab").close()
+
+    def remove(self) -> None:
+        for path in (self.part_path, self.meta_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class UploadSpool:
+    """
+    Spool directory for resumable chunked uploads
+
+    Protocol: create (declared size, optional sha256) -> append chunks at the
+    current offset -> complete with the sha256 of the whole file. A client
+    that lost its connection asks for the offset and resends from there.
+    """
+
+    def __init__(self, spool_dir: str = UPLOAD_SPOOL_DIR, max_bytes: int = 16 * 1024 * 1024,
+                 ttl: float = UPLOAD_SESSION_TTL):
+        self.spool_dir = spool_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sessions: Dict[str, UploadSession] = {}
+
+    def create(self, device_id: str, size: int, sha256: Optional[str] = None) -> UploadSession:
+        if size <= 0:
+            raise HTTPException(status_code=400, detail="Upload size must be positive")
+        if size > self.max_bytes:
+            raise HTTPException(status_code=413, detail=f"Upload size exceeds {self.max_bytes} bytes")
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.purge_expired()
+        session = UploadSession(self.spool_dir, uuid.uuid4().hex, device_id, size, sha256.lower() if sha256 else None)
+        session.save()
+        self._sessions[session.upload_id] = session
+        return session
+
+    def get(self, upload_id: str, device_id: str) -> UploadSession:
+        session = self._sessions.get(upload_id)
+        if session is None:
+            session = self._restore(upload_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Unknown or expired upload")
+        if session.device_id != device_id:
+            raise HTTPException(status_code=403, detail="Upload belongs to another device")
+        return session
+
+    def _restore(self, upload_id: str) -> Optional[UploadSession]:
+        """Pick up a session spooled before a restart"""
+        if not all(c in "0123456789abcdef" for c in upload_id) or len(upload_id) != 32:
+            return None
+        try:
+            with open(os.path.join(self.spool_dir, upload_id + ".json"), "r") as f:
+                meta = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        session = UploadSession(self.spool_dir, meta["upload_id"], meta["device_id"], meta["size"],
+                                meta.get("sha256"), meta.get("created_at"))
+        self._sessions[upload_id] = session
+        return session
+
+    async def append(self, session: UploadSession, offset: int, chunk: bytes) -> int:
+        """
+        Append a chunk that starts at `offset`
+
+        Returns:
+            New offset
+
+        Raises:
+            HTTPException: 409 (with the current offset) if the chunk does not
+                start where the spool ends, 400 if it overruns the declared size
+        """
+        async with session.lock:
+            current = session.offset
+            if offset != current:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Expected offset {current}",
+                    headers={"Upload-Offset": str(current)}
+                )
+            if len(chunk) > UPLOAD_MAX_CHUNK_BYTES:
+                raise HTTPException(status_code=413, detail=f"Chunk exceeds {UPLOAD_MAX_CHUNK_BYTES} bytes")
+            if current + len(chunk) > session.size:
+                raise HTTPException(status_code=400, detail="Chunk runs past the declared upload size")
+            if current == 0 and _sniff_format(chunk[:8]) is None:
+                raise HTTPException(status_code=400, detail="Invalid file format. Only JPG, PNG, JPEG allowed")
+            with open(session.part_path, "ab") as f:
+                f.write(chunk)
+            return current + len(chunk)
+
+    def _ingest(self, session: UploadSession, limit_label: str) -> IngestedImage:
+        with open(session.part_path, "rb") as f:
+            data = f.read(self.max_bytes + 1)
+        return ImageIngest(self.max_bytes, limit_label).check(data)
+
+    async def complete(self, session: UploadSession, sha256: Optional[str], limit_label: str) -> IngestedImage:
+        """
+        Verify a fully received upload and return it as a validated image
+
+        A checksum mismatch discards the spooled bytes so the device restarts
+        the upload; any other failure leaves them in place for a retry.
+        """
+        async with session.lock:
+            expected = (sha256 or session.sha256 or "").lower()
+            if not expected:
+                raise HTTPException(status_code=400, detail="sha256 is required to complete an upload")
+            if session.offset != session.size:
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Upload incomplete: {session.offset} of {session.size} bytes",
+                    headers={"Upload-Offset": str(session.offset)}
+                )
+            image = await asyncio.to_thread(self._ingest, session, limit_label)
+            if image.sha256 != expected:
+                session.remove()
+                self._sessions.pop(session.upload_id, None)
+                raise HTTPException(status_code=400, detail="Checksum mismatch; upload discarded, restart it")
+            return image
+
+    def finish(self, session: UploadSession) -> None:
+        """Drop a session once its image has been handed on"""
+        session.remove()
+        self._sessions.pop(session.upload_id, None)
+
+    def purge_expired(self) -> int:
+        """Delete spool files of uploads idle for longer than the TTL"""
+        if not os.path.isdir(self.spool_dir):
+            return 0
+        last_activity: Dict[str, float] = {}
+        for name in os.listdir(self.spool_dir):
+            upload_id = os.path.splitext(name)[0]
+            try:
+                mtime = os.path.getmtime(os.path.join(self.spool_dir, name))
+            except FileNotFoundError:
+                continue
+            last_activity[upload_id] = max(mtime, last_activity.get(upload_id, 0.0))
+
+        cutoff = time.time() - self.ttl
+        expired = [upload_id for upload_id, mtime in last_activity.items() if mtime < cutoff]
+        for upload_id in expired:
+            UploadSession(self.spool_dir, upload_id, "", 0).remove()
+            self._sessions.pop(upload_id, None)
+        if expired:
+            logger.info(f"Purged {len(expired)} expired uploads from the spool")
+        return len(expired)
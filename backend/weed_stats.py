@@ -0,0 +1,285 @@
+"""
+Incremental weed detection statistics
+Running per-device, per-scan and per-user aggregates updated as each
+detection completes: frame and weed counts, weeds per frame, per-class
+confidence histograms and daily rollups. Summaries are read from the
+running totals, so the dashboard never re-scans weed_detections history.
+Aggregates are persisted periodically to a local JSON file (one per
+gunicorn worker, see worker_slot.py).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from worker_slot import worker_path
+
+logger = logging.getLogger("SmartAgriNode.weed_stats")
+
+SCOPES = ("global", "device", "scan", "user")
+# Equal-width confidence bins over [0, 1]
+CONFIDENCE_BINS = 10
+# Daily rollups kept per scope
+WEED_STATS_DAYS = int(os.getenv("WEED_STATS_DAYS", "90"))
+# Least recently updated scopes are dropped beyond this many (finished scans age out first)
+WEED_STATS_MAX_SCOPES = int(os.getenv("WEED_STATS_MAX_SCOPES", "10000"))
+WEED_STATS_PATH = os.getenv(
+    "WEED_STATS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'weed_stats.json')
+)
+WEED_STATS_PERSIST_INTERVAL = float(os.getenv("WEED_STATS_PERSIST_INTERVAL", "60"))
+# Recent (user, image) pairs remembered so re-uploading a photo is not counted again
+WEED_STATS_SEEN_IMAGES = int(os.getenv("WEED_STATS_SEEN_IMAGES", "50000"))
+
+
+def class_histograms(classes: Sequence[str], confidences: Sequence[float]) -> Dict[str, np.ndarray]:
+    """Per-class confidence histograms for one frame's detections"""
+    if not len(classes):
+        return {}
+    conf = np.clip(np.asarray(confidences, dtype=np.float64), 0.0, 1.0)
+    bins = np.minimum((conf * CONFIDENCE_BINS).astype(np.int64), CONFIDENCE_BINS - 1)
+    names, inverse = np.unique(np.asarray(classes, dtype=object), return_inverse=True)
+    counts = np.bincount(inverse * CONFIDENCE_BINS + bins, minlength=len(names) * CONFIDENCE_BINS)
+    return {str(name): counts[i * CONFIDENCE_BINS:(i + 1) * CONFIDENCE_BINS] for i, name in enumerate(names)}
+
+
+class RunningStats:
+    """Aggregates for one scope, updated in O(detections) per frame"""
+
+    def __init__(self):
+        self.frames = 0
+        self.weeds = 0
+        self.frames_with_weeds = 0
+        self.max_per_frame = 0
+        self.first_at: Optional[float] = None
+        self.last_at: Optional[float] = None
+        self.histograms: Dict[str, np.ndarray] = {}
+        self.confidence_sums: Dict[str, float] = {}
+        self.daily: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+
+    def add(self, timestamp: float, weed_count: int, histograms: Dict[str, np.ndarray], confidence_sums: Dict[str, float]) -> None:
+        self.frames += 1
+        self.weeds += weed_count
+        self.frames_with_weeds += 1 if weed_count else 0
+        self.max_per_frame = max(self.max_per_frame, weed_count)
+        self.first_at = timestamp if self.first_at is None else min(self.first_at, timestamp)
+        self.last_at = timestamp if self.last_at is None else max(self.last_at, timestamp)
+
+        for name, counts in histograms.items():
+            if name in self.histograms:
+                self.histograms[name] += counts
+            else:
+                self.histograms[name] = counts.copy()
+            self.confidence_sums[name] = self.confidence_sums.get(name, 0.0) + confidence_sums[name]
+
+        day = datetime.fromtimestamp(timestamp, timezone.utc).date().isoformat()
+        if day not in self.daily:
+            latest = next(reversed(self.daily), None)
+            self.daily[day] = {"frames": 0, "weeds": 0}
+            if latest is not None and day < latest:
+                # A late frame from an earlier day: keep the rollups in date order
+                self.daily = OrderedDict(sorted(self.daily.items()))
+            while len(self.daily) > WEED_STATS_DAYS:
+                self.daily.popitem(last=False)
+        # A day older than the whole window is dropped straight away
+        rollup = self.daily.get(day)
+        if rollup is not None:
+            rollup["frames"] += 1
+            rollup["weeds"] += weed_count
+
+    def summary(self, days: int = WEED_STATS_DAYS) -> Dict[str, Any]:
+        classes = {}
+        for name, counts in self.histograms.items():
+            total = int(counts.sum())
+            classes[name] = {
+                "count": total,
+                "mean_confidence": round(self.confidence_sums[name] / total, 4) if total else None,
+                "confidence_histogram": counts.tolist()
+            }
+        daily = list(self.daily.items())[-days:] if days > 0 else []
+        return {
+            "frames": self.frames,
+            "weeds": self.weeds,
+            "weeds_per_frame": round(self.weeds / self.frames, 4) if self.frames else 0.0,
+            "frames_with_weeds": self.frames_with_weeds,
+            "max_weeds_per_frame": self.max_per_frame,
+            "first_at": self.first_at,
+            "last_at": self.last_at,
+            "confidence_bins": np.linspace(0.0, 1.0, CONFIDENCE_BINS + 1).round(2).tolist(),
+            "classes": classes,
+            "daily": [{"date": day, **rollup} for day, rollup in daily]
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "frames": self.frames,
+            "weeds": self.weeds,
+            "frames_with_weeds": self.frames_with_weeds,
+            "max_per_frame": self.max_per_frame,
+            "first_at": self.first_at,
+            "last_at": self.last_at,
+            "histograms": {name: counts.tolist() for name, counts in self.histograms.items()},
+            "confidence_sums": dict(self.confidence_sums),
+            "daily": {day: dict(rollup) for day, rollup in self.daily.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RunningStats":
+        stats = cls()
+        stats.frames = int(data.get("frames", 0))
+        stats.weeds = int(data.get("weeds", 0))
+        stats.frames_with_weeds = int(data.get("frames_with_weeds", 0))
+        stats.max_per_frame = int(data.get("max_per_frame", 0))
+        stats.first_at = data.get("first_at")
+        stats.last_at = data.get("last_at")
+        stats.histograms = {
+            name: np.asarray(counts, dtype=np.int64)
+            for name, counts in data.get("histograms", {}).items()
+            if len(counts) == CONFIDENCE_BINS
+        }
+        stats.confidence_sums = {name: float(data.get("confidence_sums", {}).get(name, 0.0)) for name in stats.histograms}
+        stats.daily = OrderedDict(sorted(data.get("daily", {}).items())[-WEED_STATS_DAYS:])
+        return stats
+
+
+class WeedStatsAggregator:
+    """Scope key -> RunningStats, with persistence and O(1) summaries"""
+
+    def __init__(self, path: str = WEED_STATS_PATH, max_scopes: int = WEED_STATS_MAX_SCOPES,
+                 max_seen: int = WEED_STATS_SEEN_IMAGES):
+        self.path = path
+        self.max_scopes = max_scopes
+        self.max_seen = max_seen
+        self._scopes: "OrderedDict[Tuple[str, str], RunningStats]" = OrderedDict()
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._persist_task: Optional[asyncio.Task] = None
+        self.recorded = 0
+
+    def record(self, weed_count: int, classes: Sequence[str] = (), confidences: Sequence[float] = (),
+               device_id: Optional[str] = None, user_id: Optional[str] = None, scan_id: Optional[str] = None,
+               timestamp: Optional[float] = None, dedup_key: Optional[str] = None) -> bool:
+        """
+        Fold one completed detection into every scope it belongs to
+
+        Args:
+            weed_count: Detections in the frame
+            classes: Class name per detection
+            confidences: Confidence per detection (same order as classes)
+            device_id, user_id, scan_id: Scopes to update besides the global one
+            timestamp: When the frame was processed (default: now)
+            dedup_key: Identifies the frame (e.g. user + image hash); a key recorded
+                recently is skipped so repeated uploads are counted once
+
+        Returns:
+            False if the frame was skipped as a repeat
+        """
+        if dedup_key is not None:
+            with self._lock:
+                if dedup_key in self._seen:
+                    self._seen.move_to_end(dedup_key)
+                    return False
+                self._seen[dedup_key] = None
+                while len(self._seen) > self.max_seen:
+                    self._seen.popitem(last=False)
+        timestamp = time.time() if timestamp is None else timestamp
+        histograms = class_histograms(classes, confidences)
+        confidence_sums = {name: 0.0 for name in histograms}
+        for name, confidence in zip(classes, confidences):
+            confidence_sums[name] += float(confidence)
+
+        keys = [("global", "all")]
+        keys += [(scope, str(value)) for scope, value in (("device", device_id), ("user", user_id), ("scan", scan_id)) if value]
+        with self._lock:
+            for key in keys:
+                stats = self._scopes.get(key)
+                if stats is None:
+                    stats = self._scopes[key] = RunningStats()
+                self._scopes.move_to_end(key)
+                stats.add(timestamp, int(weed_count), histograms, confidence_sums)
+            self.recorded += 1
+            self._evict()
+        return True
+
+    def _evict(self) -> None:
+        while len(self._scopes) > self.max_scopes:
+            for key in self._scopes:
+                if key[0] != "global":
+                    del self._scopes[key]
+                    break
+            else:
+                return
+
+    def summary(self, scope: str, scope_id: str = "all", days: int = WEED_STATS_DAYS) -> Dict[str, Any]:
+        """Current aggregates for one scope (zeros if nothing was recorded for it yet)"""
+        with self._lock:
+            stats = self._scopes.get((scope, str(scope_id)))
+            result = (stats or RunningStats()).summary(days)
+        return {"scope": scope, "id": scope_id, **result}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            scopes: Dict[str, int] = {}
+            for kind, _ in self._scopes:
+                scopes[kind] = scopes.get(kind, 0) + 1
+            return {"recorded": self.recorded, "scopes": scopes}
+
+    def save(self) -> None:
+        with self._lock:
+            data = {f"{kind}:{scope_id}": stats.to_dict() for (kind, scope_id), stats in self._scopes.items()}
+        path = worker_path(self.path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load(self) -> int:
+        """Restore persisted aggregates; returns the number of scopes loaded"""
+        path = worker_path(self.path)
+        if not os.path.exists(path):
+            return 0
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Ignoring unreadable weed statistics {path}")
+            return 0
+        scopes = OrderedDict()
+        for name, values in data.items():
+            kind, _, scope_id = name.partition(":")
+            if kind in SCOPES:
+                scopes[(kind, scope_id)] = RunningStats.from_dict(values)
+        with self._lock:
+            self._scopes = scopes
+            self._evict()
+            return len(self._scopes)
+
+    def start_persistence(self, interval: float = WEED_STATS_PERSIST_INTERVAL) -> None:
+        if interval > 0 and self._persist_task is None:
+            self._persist_task = asyncio.create_task(self._persist(interval))
+
+    async def stop_persistence(self) -> None:
+        if self._persist_task is not None:
+            self._persist_task.cancel()
+            self._persist_task = None
+        await asyncio.to_thread(self.save)
+
+    async def _persist(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.save)
+            except Exception:
+                logger.exception("Weed statistics persistence failed")
+
+
+weed_stats = WeedStatsAggregator()
@@ -0,0 +1,28 @@
+"""
+Per-worker file names for state each server process persists on its own
+gunicorn_conf.py gives every worker a stable slot (WORKER_SLOT, 0 to
+workers - 1) that its replacement inherits when it is recycled, so each
+worker keeps writing - and after a restart reloads - its own telemetry and
+weed statistics instead of overwriting a file shared with the others.
+"""
+
+import os
+
+
+def worker_slot() -> int:
+    """This process's gunicorn worker slot (0 outside gunicorn)"""
+    return int(os.getenv("WORKER_SLOT") or "0")
+
+
+def worker_path(path: str) -> str:
+    """
+    `path` for slot 0 (single worker, or main.py), `<root>.worker<N><ext>` otherwise
+
+    Read at save/load time rather than import time, since the app is imported
+    in the gunicorn master before the workers fork.
+    """
+    slot = worker_slot()
+    if slot == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.worker{slot}{ext}"
@@ -1,3 +1,4 @@
+import argparse
 import logging
 import os
 import shutil
@@ -18,13 +19,13 @@ REACT_DIR = os.path.join(PROJECT_ROOT, 'frontend-react')
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 logger = logging.getLogger("SmartAgriNode.start_servers")
 
-def start_backend():
+def start_backend(skip_install=False):
     """Start the backend FastAPI server"""
     global backend_process
     logger.info("Starting Backend Server (FastAPI)...")
     try:
         # Check and install Python dependencies
-        if os.path.exists(os.path.join(BACKEND_DIR, 'requirements.txt')):
+        if not skip_install and os.path.exists(os.path.join(BACKEND_DIR, 'requirements.txt')):
             logger.info("Checking backend dependencies...")
             subprocess.run([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"], 
                          cwd=BACKEND_DIR, check=True, capture_output=True)
@@ -40,6 +41,45 @@ def start_backend():
     except Exception:
         logger.exception("Backend server error")
 
+def start_backend_production(workers=None):
+    """
+    Start the backend for production: no dependency install, no reloader.
+    Uses gunicorn with preloaded models (see backend/gunicorn_conf.py) where available,
+    otherwise falls back to uvicorn's own multi-process mode.
+    """
+    global backend_process
+    env = os.environ.copy()
+    env.setdefault("ENVIRONMENT", "production")
+    if workers:
+        env["WEB_CONCURRENCY"] = str(workers)
+    if int(env.get("WEB_CONCURRENCY", "1")) > 1:
+        logger.warning(
+            "Running several backend workers: device commands, sensor readings, scan results and "
+            "chunked uploads are per-worker, so each device must be pinned to one worker"
+        )
+
+    try:
+        import gunicorn  # noqa: F401
+        has_gunicorn = os.name != 'nt'
+    except ImportError:
+        has_gunicorn = False
+
+    if has_gunicorn:
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn_conf.py', 'main:app']
+        logger.info("Starting Backend Server (gunicorn, preloaded models)...")
+    else:
+        worker_count = str(workers or env.get("WEB_CONCURRENCY", "1"))
+        cmd = [sys.executable, '-m', 'uvicorn', 'main:app', '--host', '0.0.0.0', '--port', env.get("PORT", "5000"), '--workers', worker_count]
+        logger.warning("gunicorn not available; starting uvicorn workers without model preloading")
+
+    try:
+        backend_process = subprocess.Popen(cmd, cwd=BACKEND_DIR, env=env)
+        backend_process.wait()
+    except KeyboardInterrupt:
+        logger.info("Backend server stopped")
+        if backend_process:
+            backend_process.terminate()
+
 def start_react_frontend():
     """Start the React (Vite) development server"""
     global react_process
@@ -112,12 +152,29 @@ def stop_servers():
         react_process.terminate()
         logger.info("React process terminated")
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Start SmartAgriNode servers")
+    parser.add_argument("--prod", action="store_true",
+                        help="Production backend only: gunicorn, preloaded models, no dependency install")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Backend worker processes in --prod mode (default: WEB_CONCURRENCY or 1; "
+                             "device state is per-process, see README)")
+    parser.add_argument("--skip-install", action="store_true",
+                        help="Do not pip install backend requirements before starting (dev mode)")
+    return parser.parse_args()
+
 def main():
+    args = parse_args()
+    if args.prod:
+        logger.info("SmartAgriNode - Starting Backend (production)...")
+        start_backend_production(workers=args.workers)
+        return
+
     logger.info("SmartAgriNode - Starting Servers...")
     logger.info("=" * 50)
     
     # Start backend in a separate thread
-    backend_thread = Thread(target=start_backend)
+    backend_thread = Thread(target=start_backend, kwargs={"skip_install": args.skip_install})
     backend_thread.start()
     
     # Give backend time to start